@@ -1,15 +1,29 @@
 import os
+import sys
 import datetime
 import imaplib
 import email
 import re
+import base64
+import quopri
+import json
+import csv
+import queue
+import sqlite3
+import hashlib
+import ast
+import html
+from array import array
+from itertools import islice
+from decimal import Decimal
+from contextlib import closing, contextmanager
 import threading
-import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
-import platform
-import subprocess
+import select
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
 from email.header import decode_header
-from email.utils import parsedate_to_datetime
+from email.utils import parsedate_to_datetime, parseaddr
 from openpyxl import load_workbook
 
 # =========================
@@ -19,11 +33,95 @@ from openpyxl import load_workbook
 EMAIL_USER = "" # Replace with your Gmail
 EMAIL_PASS = ""  # Use App Password if 2FA is enabled
 
-DEFAULT_EXCEL_FILE = os.path.join(os.path.dirname(__file__), "Expenses", "Feb 25.xlsx")
-SHEET_NAME = "Feb 25"
-
-LOG_FILE = os.path.join(os.path.dirname(__file__), "log.txt")
+# Several accounts, or alert labels besides the inbox, go in ACCOUNTS_FILE instead,
+# a JSON list of accounts (only "user" and "password" are required):
+#   [{"user": "me@gmail.com", "password": "app password", "folders": ["inbox", "Banks/HDFC"],
+#     "max_sessions": 2, "max_rate": 5}]
+# max_sessions and max_rate default to IMAP_POOL_SIZE and IMAP_MAX_COMMANDS_PER_SEC;
+# "host", "port" and "ssl" to IMAP_HOST, IMAP_PORT and IMAP_SSL. Without the file,
+# EMAIL_USER's IMAP_FOLDER is the only mailbox.
+ACCOUNTS_FILE = os.path.join(os.path.dirname(__file__), "accounts.json")
+# Accounts are fetched side by side; one that makes no progress for this long is left
+# for the next fetch, unless it's the last one still going
+MAILBOX_STALL_SECONDS = 300
+
+# With SHEET_NAME = AUTO_SHEET every transaction books into the month sheet for its
+# date ("Feb 25") and Food into that year's daily sheet ("Daily 2025"). When the Excel
+# path is a folder, each month gets its own workbook there ("Feb 25.xlsx").
+# Missing sheets and workbooks are made from EXCEL_TEMPLATE_FILE if it exists,
+# else from the nearest existing month.
+EXCEL_DIR = os.path.join(os.path.dirname(__file__), "Expenses")
+DEFAULT_EXCEL_FILE = EXCEL_DIR
+AUTO_SHEET = "auto"
+SHEET_NAME = AUTO_SHEET
+MONTH_SHEET_FORMAT = "%b %y"
+DAILY_SHEET_FORMAT = "Daily %Y"
+EXCEL_TEMPLATE_FILE = os.path.join(EXCEL_DIR, "Template.xlsx")
+
+# Category cells hold "=a + b + ..." formulas; past FORMULA_MAX_TERMS terms the
+# older numbers are folded into one base value, keeping the FORMULA_KEEP_TERMS latest.
+FORMULA_COMPACTION = True
+FORMULA_MAX_TERMS = 30
+FORMULA_KEEP_TERMS = 10
+
+# Every Excel update is appended to RUN_JOURNAL_FILE as one JSON line. The
+# journal is moved aside once it passes RUN_JOURNAL_MAX_BYTES or a new month
+# starts, keeping the newest RUN_JOURNAL_KEEP old ones; RUN_LATEST_FILE holds
+# just the newest run's summary. `python UPIx.py log` prints them as text.
+RUN_JOURNAL_FILE = os.path.join(os.path.dirname(__file__), "run_journal.jsonl")
+RUN_LATEST_FILE = os.path.join(os.path.dirname(__file__), "run_latest.json")
+RUN_JOURNAL_MAX_BYTES = 5 * 1024 * 1024
+RUN_JOURNAL_KEEP = 12
+
+# Only read now, to migrate installs from before sync_state.json existed
 LAST_PROCESSED_FILE = os.path.join(os.path.dirname(__file__), "last_processed_time.txt")
+SYNC_STATE_FILE = os.path.join(os.path.dirname(__file__), "sync_state.json")
+
+IMAP_FOLDER = "inbox"
+IMAP_HOST = "imap.gmail.com"
+IMAP_PORT = 993
+IMAP_SSL = True  # False only for a local test server, e.g. benchmarks/imap_stub.py
+
+# Parsed transactions (and optionally the mail text they came from) are kept here
+CACHE_DB_FILE = os.path.join(os.path.dirname(__file__), "upix_cache.sqlite3")
+CACHE_STORE_BODIES = False
+
+# Every transaction written to a workbook, so a re-run can never book it twice
+LEDGER_DB_FILE = os.path.join(os.path.dirname(__file__), "booked_ledger.sqlite3")
+
+# The category last booked for each VPA, VPA family and party name, used to pre-fill new rows
+CATEGORY_INDEX_FILE = os.path.join(os.path.dirname(__file__), "category_index.sqlite3")
+
+# Parallel ingestion: logged-in sessions kept open, and UID commands/second allowed on each
+IMAP_POOL_SIZE = 4
+IMAP_MAX_COMMANDS_PER_SEC = 5
+# A server that goes this long without sending anything it owes us is taken to be gone
+IMAP_TIMEOUT_SECONDS = 120
+
+# How often (ms) the window picks up rows and progress queued by background workers
+UI_TICK_MS = 50
+
+# Watch mode: re-issue IDLE this often (servers may drop one after 30 minutes),
+# and wait this long before reconnecting after the connection is lost
+IMAP_IDLE_RENEW_SECONDS = 29 * 60
+WATCH_RECONNECT_SECONDS = 30
+
+# Every fetch and Excel update writes its stage timings and counters here (latest of
+# each kind). With PROFILE_RUNS a cProfile dump of each run also goes to PROFILE_DIR.
+RUN_REPORT_FILE = os.path.join(os.path.dirname(__file__), "run_report.json")
+PROFILE_RUNS = False
+PROFILE_DIR = os.path.join(os.path.dirname(__file__), "profiles")
+
+# How many message IDs to request per IMAP FETCH round-trip
+FETCH_BATCH_SIZE = 200
+
+# Phase one of a fetch only pulls these; bodies are fetched for survivors only
+HEADER_FETCH_PARTS = "(INTERNALDATE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (DATE FROM MESSAGE-ID)])"
+
+# Bank statements are read, de-duplicated and booked this many rows at a time.
+# The column header must be within the first STATEMENT_HEADER_SCAN_ROWS rows.
+STATEMENT_CHUNK_ROWS = 25000
+STATEMENT_HEADER_SCAN_ROWS = 50
 
 EXPENSE_CATEGORIES = {
     0: "Skip",
@@ -42,652 +140,3496 @@ EXPENSE_CATEGORIES = {
 }
 
 # =========================
-# DARK MODE DETECTION
+# BANK PARSERS
 # =========================
 
-def detect_dark_mode():
+class BankParser:
     """
-    Return True if the system is in Dark Mode (Windows or macOS).
-    Otherwise, return False (assume light mode).
+    How one bank's debit alerts are read. `pattern` must have named groups
+    amount, vpa, party and date; `keywords` are plain substrings that all
+    have to be in a mail before the pattern is tried at all.
     """
-    system = platform.system()
-    if system == "Darwin":
-        # macOS detection
+
+    def __init__(self, name, sender, pattern, keywords, date_format="%d-%m-%y"):
+        self.name = name
+        self.sender = sender.lower()
+        self.pattern = re.compile(pattern)
+        self.keywords = tuple(keywords)
+        self.date_format = date_format
+
+    def might_match(self, text):
+        return all(keyword in text for keyword in self.keywords)
+
+    def parse(self, text):
+        """Yield (date as dd-mm-yy, amount, vpa, party name) for each debit in `text`."""
+        for match in self.pattern.finditer(text):
+            date = match.group("date")
+            if self.date_format != "%d-%m-%y":
+                try:
+                    date = datetime.datetime.strptime(date, self.date_format).strftime("%d-%m-%y")
+                except ValueError:
+                    continue
+            amount = float(match.group("amount").replace(",", ""))
+            yield date, amount, match.group("vpa"), match.group("party").strip().lower()
+
+# Sender address -> BankParser; the IMAP search covers every sender in here
+BANK_PARSERS = {}
+
+def register_parser(parser):
+    BANK_PARSERS[parser.sender] = parser
+    return parser
+
+register_parser(BankParser(
+    "HDFC Bank", "alerts@hdfcbank.net",
+    r"Rs\.\s?(?P<amount>\d+\.\d{2})\s?has been debited .*? to VPA (?P<vpa>\S+)\s(?P<party>.+?) on (?P<date>\d{2}-\d{2}-\d{2})",
+    keywords=("has been debited", "VPA")
+))
+
+def sender_search_criteria(senders=None):
+    """IMAP search key matching mail from any of `senders` (all registered ones by default)."""
+    senders = sorted(senders if senders is not None else BANK_PARSERS)
+    criteria = f'FROM "{senders[-1]}"'
+    for sender in reversed(senders[:-1]):
+        criteria = f'OR FROM "{sender}" {criteria}'
+    return criteria
+
+# =========================
+# TRANSACTIONS
+# =========================
+
+TRANSACTION_FIELDS = ("date", "amount", "vpa_id", "party_name", "email_datetime", "message_id", "uid", "category",
+                      "mailbox")
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+class Transaction:
+    """
+    One parsed debit. Fixed slots instead of a dict keep big backfills
+    small, and repeated VPAs, names and dates share one interned string.
+    Item access (txn["amount"], txn.get("category")) still works, so a
+    Transaction goes anywhere a transaction dict used to.
+    """
+    __slots__ = TRANSACTION_FIELDS
+
+    def __init__(self, date, amount, vpa_id, party_name, email_datetime=None,
+                 message_id=None, uid=None, category="", mailbox=None):
+        self.date = _intern(date)
+        self.amount = amount
+        self.vpa_id = _intern(vpa_id)
+        self.party_name = _intern(party_name)
+        self.email_datetime = email_datetime
+        self.message_id = message_id
+        self.uid = uid
+        self.category = _intern(category)
+        self.mailbox = _intern(mailbox)
+
+    def __getitem__(self, name):
+        if name not in TRANSACTION_FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in TRANSACTION_FIELDS:
+            raise KeyError(name)
+        setattr(self, name, _intern(value) if name != "message_id" else value)
+
+    def __contains__(self, name):
+        return name in TRANSACTION_FIELDS
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in TRANSACTION_FIELDS else default
+
+    def keys(self):
+        return TRANSACTION_FIELDS
+
+    def __eq__(self, other):
+        if not isinstance(other, Transaction):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in TRANSACTION_FIELDS)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Transaction(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in TRANSACTION_FIELDS) + ")"
+
+_NO_OFFSET = 1 << 30
+_timezones = {}
+
+def _timezone(offset):
+    if offset not in _timezones:
+        _timezones[offset] = datetime.timezone(datetime.timedelta(seconds=offset))
+    return _timezones[offset]
+
+class TransactionBatch:
+    """
+    Many transactions stored by column: amounts, dates, email times and
+    UIDs in typed arrays, VPAs and names as interned strings, and each
+    row's category as a small code into `category_names`. Indexing returns
+    a Transaction built from the row; change a row's category with
+    set_category(), not through that copy.
+    """
+
+    def __init__(self, transactions=()):
+        self.amounts = array("d")
+        self.days = array("l")        # transaction date as a date ordinal, 0 if unreadable
+        self.stamps = array("d")      # email time as a POSIX timestamp, NaN if unknown
+        self.offsets = array("l")     # its UTC offset in seconds, _NO_OFFSET if naive
+        self.uids = array("q")        # -1 if unknown
+        self.dates = []
+        self.vpa_ids = []
+        self.party_names = []
+        self.message_ids = []
+        self.mailboxes = []           # "<account>/<folder>" the alert came from, None if not mail
+        self.category_codes = array("H")
+        self.category_names = [""]
+        self._category_code = {"": 0}
+        self.extend(transactions)
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getitem__(self, i):
+        return Transaction(
+            self.dates[i], self.amounts[i], self.vpa_ids[i], self.party_names[i],
+            self.email_datetime(i), self.message_ids[i],
+            self.uids[i] if self.uids[i] >= 0 else None, self.category(i), self.mailboxes[i]
+        )
+
+    def append(self, txn):
+        self.amounts.append(txn["amount"])
+        date_str = txn["date"]
         try:
-            result = subprocess.run(
-                ["defaults", "read", "-g", "AppleInterfaceStyle"],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            return (result.returncode == 0 and "Dark" in result.stdout)
-        except:
-            pass
-        return False
-    elif system == "Windows":
-        # Windows detection
+            self.days.append(datetime.datetime.strptime(date_str, "%d-%m-%y").toordinal())
+        except (TypeError, ValueError):
+            self.days.append(0)
+        msg_dt = txn.get("email_datetime")
+        if msg_dt is None:
+            self.stamps.append(float("nan"))
+            self.offsets.append(_NO_OFFSET)
+        else:
+            self.stamps.append(msg_dt.timestamp())
+            offset = msg_dt.utcoffset()
+            self.offsets.append(_NO_OFFSET if offset is None else int(offset.total_seconds()))
+        uid = txn.get("uid")
+        self.uids.append(int(uid) if uid is not None else -1)
+        self.dates.append(_intern(date_str))
+        self.vpa_ids.append(_intern(txn["vpa_id"]))
+        self.party_names.append(_intern(txn["party_name"]))
+        self.message_ids.append(txn.get("message_id"))
+        self.mailboxes.append(_intern(txn.get("mailbox")))
+        self.category_codes.append(self._code(txn.get("category") or ""))
+
+    def extend(self, transactions):
+        for txn in transactions:
+            self.append(txn)
+
+    def clear(self):
+        self.__init__()
+
+    def copy(self):
+        batch = TransactionBatch()
+        for name in ("amounts", "days", "stamps", "offsets", "uids", "category_codes"):
+            setattr(batch, name, array(getattr(self, name).typecode, getattr(self, name)))
+        for name in ("dates", "vpa_ids", "party_names", "message_ids", "mailboxes", "category_names"):
+            setattr(batch, name, list(getattr(self, name)))
+        batch._category_code = dict(self._category_code)
+        return batch
+
+    def email_datetime(self, i):
+        stamp = self.stamps[i]
+        if stamp != stamp:
+            return None
+        offset = self.offsets[i]
+        if offset == _NO_OFFSET:
+            return datetime.datetime.fromtimestamp(stamp)
+        return datetime.datetime.fromtimestamp(stamp, _timezone(offset))
+
+    def _code(self, category):
+        code = self._category_code.get(category)
+        if code is None:
+            code = self._category_code[category] = len(self.category_names)
+            self.category_names.append(_intern(category))
+        return code
+
+    def category(self, i):
+        return self.category_names[self.category_codes[i]]
+
+    def set_category(self, i, category):
+        self.category_codes[i] = self._code(category or "")
+
+    @property
+    def categories(self):
+        """Every row's category, as a list."""
+        names = self.category_names
+        return [names[code] for code in self.category_codes]
+
+    def set_categories(self, categories):
+        self.category_codes = array("H", (self._code(cat or "") for cat in categories))
+
+    def total(self, indices=None):
+        if indices is None:
+            return sum(self.amounts)
+        amounts = self.amounts
+        return sum(amounts[i] for i in indices)
+
+    def _grouped_sums(self, codes, indices):
+        """
+        Sum amounts per code over `indices` (every row by default), keyed in
+        order of first appearance. Uses numpy for big batches when installed.
+        """
         try:
-            import winreg
-            with winreg.OpenKey(
-                winreg.HKEY_CURRENT_USER,
-                r"Software\Microsoft\Windows\CurrentVersion\Themes\Personalize"
-            ) as key:
-                apps_use_light_theme, _ = winreg.QueryValueEx(key, "AppsUseLightTheme")
-                return (apps_use_light_theme == 0)
-        except:
-            return False
-    return False
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None and len(self) >= 1000:
+            amounts = numpy.frombuffer(self.amounts, dtype=numpy.float64)
+            code_array = numpy.frombuffer(codes, dtype=numpy.dtype(codes.typecode))
+            if indices is not None:
+                picked = numpy.fromiter(indices, dtype=numpy.int64)
+                amounts, code_array = amounts[picked], code_array[picked]
+            labels, first, inverse = numpy.unique(code_array, return_index=True, return_inverse=True)
+            sums = numpy.bincount(inverse, weights=amounts, minlength=len(labels))
+            # Same order as the loop below: by first appearance
+            order = numpy.argsort(first)
+            return dict(zip(labels[order].tolist(), sums[order].tolist()))
+
+        sums = {}
+        rows = range(len(self)) if indices is None else indices
+        for i in rows:
+            sums[codes[i]] = sums.get(codes[i], 0) + self.amounts[i]
+        return sums
+
+    def sums_by_category(self, indices=None):
+        """{category: total amount} over `indices` (every row by default)."""
+        names = self.category_names
+        return {names[code]: total for code, total in self._grouped_sums(self.category_codes, indices).items()}
+
+    def sums_by_date(self, indices=None):
+        """{transaction date: total amount} over `indices`; unreadable dates are left out."""
+        return {
+            datetime.date.fromordinal(day): total
+            for day, total in sorted(self._grouped_sums(self.days, indices).items()) if day
+        }
 
 # =========================
-# GMAIL / EMAIL FUNCTIONS
+# INSTRUMENTATION
 # =========================
 
-def connect_gmail():
-    """Connect to Gmail via IMAP, return the mail object or None if error."""
-    try:
-        mail = imaplib.IMAP4_SSL("imap.gmail.com")
-        mail.login(EMAIL_USER, EMAIL_PASS)
-        mail.select("inbox")
-        return mail
-    except Exception as e:
-        print(f"Error connecting to Gmail: {e}")
-        return None
+_run_report_lock = threading.Lock()
 
-def get_last_processed_time():
-    if not os.path.exists(LAST_PROCESSED_FILE):
-        return None
-    try:
-        with open(LAST_PROCESSED_FILE, "r", encoding="utf-8") as f:
-            text = f.read().strip()
-            return datetime.datetime.fromisoformat(text)
-    except Exception:
-        return None
+class RunMetrics:
+    """
+    Wall time per stage and named counters for one fetch, Excel update or
+    statement import.
+    Shard threads may feed the same instance; their stage times add up, so
+    a stage can total more than the run's elapsed time. finish() writes the
+    report to RUN_REPORT_FILE.
+
+    With PROFILE_RUNS set, the thread that created the run is profiled too,
+    and so is every worker thread that runs inside profiled(); finish()
+    merges them all into one dump.
+    """
+    def __init__(self, kind):
+        self.kind = kind
+        self.started_at = datetime.datetime.now()
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.profiler = None
+        self.thread_profilers = []
+        self.profiled_threads = set()
+        self.report = None
+        if PROFILE_RUNS:
+            import cProfile
+            try:
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+                self.profiled_threads.add(threading.get_ident())
+            except ValueError as e:
+                print(f"Warning: not profiling this {kind}: {e}")
+                self.profiler = None
+
+    def add(self, stage, seconds, calls=1):
+        with self.lock:
+            total = self.stages.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += calls
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    @contextmanager
+    def profiled(self):
+        """
+        With PROFILE_RUNS, profile the calling worker thread into this run
+        as well. Does nothing on a thread that is already being profiled.
+        """
+        thread = threading.get_ident()
+        with self.lock:
+            wanted = PROFILE_RUNS and self.report is None and thread not in self.profiled_threads
+            if wanted:
+                self.profiled_threads.add(thread)
+        if not wanted:
+            yield
+            return
 
-def set_last_processed_time(dt):
-    try:
-        with open(LAST_PROCESSED_FILE, "w", encoding="utf-8") as f:
-            f.write(dt.isoformat())
-    except Exception as e:
-        print(f"Warning: could not save last processed time: {e}")
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+ allows one profiler at a time, and that one already sees every thread
+            profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            with self.lock:
+                self.profiled_threads.discard(thread)
+                if profiler is not None:
+                    self.thread_profilers.append(profiler)
+
+    def finish(self, **extra):
+        """Close the run and save its report, once; returns the report dict."""
+        if self.report is not None:
+            return self.report
+        elapsed = time.perf_counter() - self.started
+        profile_file = None
+        if self.profiler is not None:
+            self.profiler.disable()
+        with self.lock:
+            profilers = ([self.profiler] if self.profiler is not None else []) + self.thread_profilers
+        if profilers:
+            import pstats
+            stats = pstats.Stats(profilers[0])
+            for profiler in profilers[1:]:
+                stats.add(profiler)
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile_file = os.path.join(PROFILE_DIR, f"{self.kind}-{self.started_at:%Y%m%d-%H%M%S}.prof")
+            stats.dump_stats(profile_file)
+
+        with self.lock:
+            counters = dict(self.counters)
+            stages = {
+                name: {"seconds": round(seconds, 4), "calls": calls}
+                for name, (seconds, calls) in sorted(self.stages.items(), key=lambda item: -item[1][0])
+            }
+        report = {
+            "kind": self.kind,
+            "started": self.started_at.isoformat(timespec="seconds"),
+            "elapsed_s": round(elapsed, 4),
+            "stages": stages,
+            "counters": counters,
+        }
+        if counters.get("regex_tried"):
+            report["regex_hit_rate"] = round(counters.get("regex_hits", 0) / counters["regex_tried"], 4)
+        if counters.get("bytes_downloaded") and counters.get("emails_found"):
+            report["bytes_per_email"] = round(counters["bytes_downloaded"] / counters["emails_found"], 1)
+        if profile_file:
+            report["profile"] = profile_file
+        report.update(extra)
+        self.report = report
+        save_run_report(report)
+        return report
+
+def save_run_report(report):
+    """Keep `report` as the latest of its kind in RUN_REPORT_FILE."""
+    with _run_report_lock:
+        try:
+            with open(RUN_REPORT_FILE, "r", encoding="utf-8") as f:
+                reports = json.load(f)
+        except (OSError, ValueError):
+            reports = {}
+        reports[report["kind"]] = report
+        tmp_file = RUN_REPORT_FILE + ".tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(reports, f, indent=2, default=str)
+            os.replace(tmp_file, RUN_REPORT_FILE)
+        except OSError as e:
+            print(f"Warning: could not write run report: {e}")
 
-# ========================
-# EXCEL UPDATE FUNCTION
-# ========================
+# =========================
+# RUN JOURNAL
+# =========================
 
-def update_excel(transactions, category_choices, excel_file, sheet_name):
-    from datetime import datetime
+_journal_lock = threading.Lock()
 
-    total_upi_amount = round(sum(txn["amount"] for txn in transactions), 2)
-    timestamp = datetime.now().strftime("%d-%b-%Y %H:%M:%S")
-    log_entries = []
+def _journal_value(value):
+    return value.isoformat() if isinstance(value, (datetime.datetime, datetime.date)) else str(value)
 
-    # Grab last run total from the log
-    last_run_total = 0.0
+def journal_files():
+    """The journal and the rotated ones before it, newest first."""
+    folder, name = os.path.split(RUN_JOURNAL_FILE)
+    base, ext = os.path.splitext(name)
+    rotated_re = re.compile(re.escape(base) + r"-\d{8}-\d{6}" + re.escape(ext))
     try:
-        with open(LOG_FILE, "r", encoding="utf-8") as log_file:
-            lines = log_file.readlines()
-            for line in reversed(lines):
-                if "Total Expense Added Today" in line:
-                    last_run_total = round(float(line.split(":")[1].strip().replace("Rs.", "").strip()), 2)
-                    break
-    except (FileNotFoundError, ValueError):
-        pass
-
-    # If today's total is the same as last time, skip
-    if total_upi_amount == last_run_total and total_upi_amount != 0:
-        msg = (f"Expenses for this set of transactions appear to be already logged. "
-               f"(Mail total: Rs.{total_upi_amount:.2f})")
-        messagebox.showwarning("Skipped", msg)
-        with open(LOG_FILE, "a", encoding="utf-8") as log_file:
-            log_file.write(f"\n[{timestamp}] ⚠️ SKIPPED: Expenses already recorded. No duplicate booking.\n")
-            log_file.write("\n" + "=" * 50 + "\n\n")
-        return
-
+        names = os.listdir(folder or ".")
+    except OSError:
+        return []
+    rotated = sorted((n for n in names if rotated_re.fullmatch(n)), reverse=True)
+    return [os.path.join(folder, n) for n in ([name] if name in names else []) + rotated]
+
+def _rotate_journal(now):
+    """Move the journal aside once it's too big or from an earlier month, dropping the oldest."""
     try:
-        wb = load_workbook(excel_file)
-        ws_main = wb[sheet_name]
-        ws_daily = wb["Daily 2025"]
+        size = os.path.getsize(RUN_JOURNAL_FILE)
+        with open(RUN_JOURNAL_FILE, "r", encoding="utf-8") as f:
+            first = json.loads(f.readline() or "{}")
     except FileNotFoundError:
-        messagebox.showerror("Error", f"Excel file not found:\n{excel_file}")
         return
-    except KeyError:
-        messagebox.showerror("Error", f"Sheet '{sheet_name}' or 'Daily 2025' not found in workbook.")
+    except ValueError:
+        first = {}
+    month = str(first.get("time", ""))[:7]
+    if size < RUN_JOURNAL_MAX_BYTES and month in ("", now.strftime("%Y-%m")):
         return
+    base, ext = os.path.splitext(RUN_JOURNAL_FILE)
+    os.replace(RUN_JOURNAL_FILE, f"{base}-{now:%Y%m%d-%H%M%S}{ext}")
+    for old in journal_files()[RUN_JOURNAL_KEEP:]:
+        os.remove(old)
 
-    ws_main["O1"].value = datetime.now().strftime("%d-%b-%Y %I:%M%p")
+def journal_run(record):
+    """
+    Append one run to the journal, stamped with the time, and make it the
+    latest run. The sidecar leaves out the per-cell "entries" and keeps
+    the last processed time of the newest run that had one.
+    """
+    now = datetime.datetime.now()
+    record = dict(time=now.isoformat(timespec="seconds"), **record)
+    latest = {key: value for key, value in record.items() if key != "entries"}
+    with _journal_lock:
+        if latest.get("last_processed") is None:
+            latest["last_processed"] = (load_latest_run() or {}).get("last_processed")
+        try:
+            _rotate_journal(now)
+            with open(RUN_JOURNAL_FILE, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False, default=_journal_value) + "\n")
+            tmp_file = RUN_LATEST_FILE + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(latest, f, indent=2, ensure_ascii=False, default=_journal_value)
+            os.replace(tmp_file, RUN_LATEST_FILE)
+        except OSError as e:
+            print(f"Warning: could not write the run journal: {e}")
+
+def load_latest_run():
+    """The newest run's summary, without touching the journal; None before the first run."""
+    try:
+        with open(RUN_LATEST_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-    total_amount_added = 0
-    total_amount_skipped = 0
-    category_sums = {}
-    max_email_datetime = None
+def _journal_records(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue  # blank, or cut short by a crash
+
+def read_journal(limit=None):
+    """The newest `limit` runs (every run by default), oldest first."""
+    runs = []
+    for path in journal_files():
+        try:
+            runs[:0] = list(_journal_records(path))
+        except OSError:
+            continue
+        if limit and len(runs) >= limit:
+            break
+    return runs[-limit:] if limit else runs
+
+_JOURNAL_SKIPS = {
+    "skip": "SKIPPED: Rs.{amount:.2f} for '{party}' (Skip chosen)",
+    "booked": "SKIPPED: Rs.{amount:.2f} for '{party}' (already booked)",
+    "bad_date": "SKIPPED (Invalid date format '{date}'): Rs.{amount:.2f}",
+    "no_month": "SKIPPED (No '{month}' column in '{sheet}'): Rs.{amount:.2f}",
+    "no_day": "SKIPPED (Day '{day}' not found in '{sheet}'): Rs.{amount:.2f}",
+    "no_category": "SKIPPED (Category '{category}' not found in '{sheet}'): Rs.{amount:.2f}",
+}
 
-    for i, txn in enumerate(transactions):
-        chosen_cat = category_choices[i] if category_choices[i] else "Skip"
+def render_run(record):
+    """One journal record as the text log.txt used to hold."""
+    stamp = datetime.datetime.fromisoformat(record["time"]).strftime("%d-%b-%Y %H:%M:%S")
+    rule = "=" * 50
+    if record.get("status") == "duplicate":
+        return f"[{stamp}] ⚠️ SKIPPED: Expenses already recorded. No duplicate booking.\n\n{rule}\n"
+    if record.get("status") != "ok":
+        return f"[{stamp}] {str(record.get('status')).upper()}: {record.get('message', '')}\n\n{rule}\n"
+
+    lines = [rule]
+    many_sheets = len(record.get("sheets", ())) > 1
+    for entry in record.get("entries", ()):
+        if entry["event"] == "created":
+            text = f"CREATED: {entry['name']} from template"
+        elif entry["event"] == "skipped":
+            text = _JOURNAL_SKIPS[entry["reason"]].format(**entry)
+        else:
+            if entry["category"] == "Food":
+                target = f"'{entry['sheet']}' (Food)"
+            else:
+                target = f"'{entry['category']}'" + (f" in '{entry['sheet']}'" if many_sheets else "")
+            count_note = f" ({entry['count']} transactions)" if entry["count"] > 1 else ""
+            text = (f"{target} -> Prev: Rs.{entry['prev']:.2f}, +Rs.{entry['added']:.2f}{count_note}, "
+                    f"New: Rs.{entry['new']:.2f}")
+        lines.append(f"[{stamp}] {text}")
+    lines += [
+        "",
+        f"Total Expense Added Today: Rs. {record['added']:.2f}",
+        f"Total Amount Skipped: Rs.{record['skipped']:.2f}",
+        "",
+        "📂 **Category-wise Breakdown:**",
+    ]
+    lines += [f"   - {cat}: Rs.{amount:.2f}" for cat, amount in record.get("category_sums", {}).items()]
+    lines += ["", rule]
+    return "\n".join(lines) + "\n"
 
-        if chosen_cat == "Skip":
-            total_amount_skipped += txn["amount"]
-            log_entries.append(
-                f"[{timestamp}] SKIPPED: Rs.{txn['amount']:.2f} for '{txn['party_name']}' (Skip chosen)"
-            )
-            continue
+# =========================
+# ACCOUNTS
+# =========================
 
-        msg_dt = txn["email_datetime"]
-        if msg_dt and (max_email_datetime is None or msg_dt > max_email_datetime):
-            max_email_datetime = msg_dt
+class Account:
+    """
+    One IMAP login, the folders to search in it, and how hard it may be
+    pushed: at most `max_sessions` sessions, each sending at most
+    `max_rate` UID commands per second.
+    """
+    def __init__(self, user, password, folders=None, max_sessions=None, max_rate=None,
+                 host=None, port=None, ssl=None):
+        self.user = user
+        self.password = password
+        self.folders = list(folders or [IMAP_FOLDER])
+        self.max_sessions = max_sessions or IMAP_POOL_SIZE
+        self.max_rate = IMAP_MAX_COMMANDS_PER_SEC if max_rate is None else max_rate
+        self.host = host or IMAP_HOST
+        self.port = port or IMAP_PORT
+        self.ssl = IMAP_SSL if ssl is None else ssl
+
+    @property
+    def key(self):
+        return (self.user, self.host, self.port)
+
+    def mailboxes(self):
+        return [mailbox_key(self.user, folder) for folder in self.folders]
+
+    def __repr__(self):
+        return f"Account({self.user!r}, folders={self.folders!r})"
+
+def default_account():
+    """EMAIL_USER's IMAP_FOLDER, as set when this is called."""
+    return Account(EMAIL_USER, EMAIL_PASS)
+
+def load_accounts():
+    """
+    The accounts in ACCOUNTS_FILE, or just the default account without one.
+    Raises FetchError if the file can't be read or an entry is malformed.
+    """
+    try:
+        with open(ACCOUNTS_FILE, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return [default_account()]
+    except (OSError, ValueError) as e:
+        raise FetchError(f"Could not read {ACCOUNTS_FILE}: {e}")
+
+    if not isinstance(entries, list) or not entries:
+        raise FetchError(f"{ACCOUNTS_FILE} must hold a non-empty list of accounts.")
+    accounts = []
+    limits = ("max_sessions", "max_rate", "host", "port", "ssl")
+    for n, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict) or not entry.get("user") or "password" not in entry:
+            raise FetchError(f"Account {n} in {ACCOUNTS_FILE} needs a \"user\" and a \"password\".")
+        folders = entry.get("folders")
+        if isinstance(folders, str):
+            folders = [folders]
+        try:
+            accounts.append(Account(entry["user"], entry["password"], folders,
+                                    **{field: entry.get(field) for field in limits}))
+        except (TypeError, ValueError) as e:
+            raise FetchError(f"Account {n} in {ACCOUNTS_FILE}: {e}")
+    keys = [key for account in accounts for key in account.mailboxes()]
+    if len(set(keys)) != len(keys):
+        raise FetchError(f"{ACCOUNTS_FILE} lists the same folder more than once.")
+    return accounts
+
+def mailbox_key(account, folder):
+    """The "<account>/<folder>" name a mailbox's sync state and transactions go by."""
+    return f"{account}/{folder}"
+
+def _imap_mailbox(name):
+    """`name` as an IMAP argument; Gmail labels like "[Gmail]/All Mail" need quoting."""
+    if name.startswith('"') or not re.search(r'[\s"\\(){%*\]]', name):
+        return name
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
 
-        if chosen_cat == "Food":
-            date_str = txn["date"]
-            try:
-                day = int(date_str.split("-")[0])
-                date_obj = datetime.strptime(date_str, "%d-%m-%y")
-                month_name = date_obj.strftime("%B")
-            except:
-                total_amount_skipped += txn["amount"]
-                log_entries.append(
-                    f"[{timestamp}] SKIPPED (Invalid date format '{date_str}'): Rs.{txn['amount']:.2f}"
-                )
-                continue
+# =========================
+# GMAIL / EMAIL FUNCTIONS
+# =========================
 
-            # find the column in ws_daily for month_name
-            month_col = None
-            for col in range(2, ws_daily.max_column + 1):
-                if ws_daily.cell(row=2, column=col).value == month_name:
-                    month_col = col
-                    break
-            if not month_col:
-                total_amount_skipped += txn["amount"]
-                log_entries.append(
-                    f"[{timestamp}] SKIPPED (No '{month_name}' column in 'Daily 2025'): Rs.{txn['amount']:.2f}"
-                )
-                continue
+def connect_gmail(account=None, folder=None):
+    """
+    Log in to `account` (the default one if not given) and select `folder`
+    (its first), return the mail object or None if error.
+    """
+    account = account or default_account()
+    folder = folder or account.folders[0]
+    mail = None
+    try:
+        if account.ssl:
+            mail = imaplib.IMAP4_SSL(account.host, account.port, timeout=IMAP_TIMEOUT_SECONDS)
+        else:
+            mail = imaplib.IMAP4(account.host, account.port, timeout=IMAP_TIMEOUT_SECONDS)
+        mail.login(account.user, account.password)
+        result, data = mail.select(_imap_mailbox(folder))
+        if result != "OK":
+            raise imaplib.IMAP4.error(f"cannot open {folder}: {data[0]!r}")
+        return mail
+    except Exception as e:
+        print(f"Error connecting to {mailbox_key(account.user, folder)}: {e}")
+        if mail is not None:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+        return None
 
-            # find the row for the day
-            day_row = None
-            for row_idx in range(3, ws_daily.max_row + 1):
-                val = ws_daily.cell(row=row_idx, column=1).value
-                if isinstance(val, (int, float)) and val == day:
-                    day_row = row_idx
-                    break
-            if not day_row:
-                total_amount_skipped += txn["amount"]
-                log_entries.append(
-                    f"[{timestamp}] SKIPPED (Day '{day}' not found in 'Daily 2025'): Rs.{txn['amount']:.2f}"
-                )
-                continue
+def _is_exists(line):
+    return line.startswith(b"* ") and line.rstrip().upper().endswith(b" EXISTS")
 
-            prev_food_exp = float(ws_daily.cell(row=day_row, column=month_col).value or 0)
-            new_food_exp = prev_food_exp + txn["amount"]
-            ws_daily.cell(row=day_row, column=month_col, value=new_food_exp)
+def _response_waiting(mail, wait):
+    """
+    True once a response line can be read from `mail`, waiting up to `wait`
+    seconds. imaplib reads through the buffered `mail.file`, which (like
+    SSL's own buffer) can already hold lines the socket will never report
+    as readable again, so look there first without blocking.
+    """
+    previous = mail.sock.gettimeout()
+    mail.sock.setblocking(False)
+    try:
+        if mail.file.peek(1):
+            return True
+    except (BlockingIOError, ssl.SSLWantReadError):
+        pass
+    finally:
+        mail.sock.settimeout(previous)
+    return bool(select.select([mail.sock], [], [], wait)[0])
 
-            total_amount_added += txn["amount"]
-            category_sums["Food"] = category_sums.get("Food", 0) + txn["amount"]
-            log_entries.append(
-                f"[{timestamp}] 'Daily 2025' (Food) -> Prev: Rs.{prev_food_exp:.2f}, +Rs.{txn['amount']:.2f}, New: Rs.{new_food_exp:.2f}"
-            )
+def idle_until_new_mail(mail, stop_event, timeout=IMAP_IDLE_RENEW_SECONDS):
+    """
+    Hold `mail` in IMAP IDLE until the server announces new messages
+    (EXISTS), `timeout` seconds pass or `stop_event` is set.
+    Returns True if new mail arrived. imaplib has no IDLE support, so the
+    command is driven by hand on the session's socket.
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b" IDLE\r\n")
+    new_mail = False
+    # Untagged updates may come ahead of the continuation; only a tagged reply is a refusal
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed while entering IDLE")
+        if line.startswith(b"+"):
+            break
+        if not line.startswith(b"* "):
+            mail.tagged_commands.pop(tag, None)
+            raise imaplib.IMAP4.error(f"IDLE refused: {line.strip()!r}")
+        new_mail = new_mail or _is_exists(line)
+
+    deadline = time.monotonic() + timeout
+    while not new_mail and not stop_event.is_set() and time.monotonic() < deadline:
+        # Wake every second to notice stop_event
+        if not _response_waiting(mail, 1.0):
+            continue
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed during IDLE")
+        new_mail = _is_exists(line)
+
+    mail.send(b"DONE\r\n")
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed while leaving IDLE")
+        if line.startswith(tag):
+            break
+    mail.tagged_commands.pop(tag, None)
+    return new_mail
+
+_FETCH_START_RE = re.compile(rb"^(\d+) \(")
+_FETCH_LITERAL_RE = re.compile(rb"(RFC822(?:\.HEADER|\.TEXT)?|BODY\[[^\]]*\](?:<\d+>)?) \{\d+\}$")
+_FETCH_UID_RE = re.compile(rb"\bUID (\d+)")
+_FETCH_INTERNALDATE_RE = re.compile(rb'\bINTERNALDATE "([^"]+)"')
+
+_BODYSTRUCTURE_TOKEN_RE = re.compile(rb'\(|\)|"((?:[^"\\]|\\.)*)"|([^\s()"]+)')
+
+def _balanced_group(data, start):
+    """Return the parenthesised group of `data` opening at `start`, or None if it is cut off."""
+    depth = 0
+    in_quote = False
+    i = start
+    while i < len(data):
+        c = data[i]
+        if in_quote:
+            if c == 0x5C:  # backslash escape
+                i += 1
+            elif c == 0x22:
+                in_quote = False
+        elif c == 0x22:
+            in_quote = True
+        elif c == 0x28:
+            depth += 1
+        elif c == 0x29:
+            depth -= 1
+            if depth == 0:
+                return data[start:i + 1]
+        i += 1
+    return None
+
+def parse_bodystructure(data):
+    """Turn a raw BODYSTRUCTURE value into nested lists of str/None."""
+    stack = [[]]
+    for m in _BODYSTRUCTURE_TOKEN_RE.finditer(data):
+        tok = m.group(0)
+        if tok == b"(":
+            stack.append([])
+        elif tok == b")":
+            inner = stack.pop()
+            stack[-1].append(inner)
+        elif m.group(1) is not None:
+            stack[-1].append(m.group(1).replace(b'\\"', b'"').decode("utf-8", errors="ignore"))
         else:
-            # Non-Food
-            category_row = None
-            for row_idx in range(1, ws_main.max_row + 1):
-                if ws_main.cell(row=row_idx, column=1).value == chosen_cat:
-                    category_row = row_idx
-                    break
+            atom = m.group(2).decode("ascii", errors="ignore")
+            stack[-1].append(None if atom.upper() == "NIL" else atom)
+    return stack[0][0] if stack[0] else None
 
-            if category_row is None:
-                total_amount_skipped += txn["amount"]
-                log_entries.append(
-                    f"[{timestamp}] SKIPPED (Category '{chosen_cat}' not found in main sheet): Rs.{txn['amount']:.2f}"
-                )
-                continue
+def find_text_part(structure, section=""):
+    """
+    Locate the part worth scanning for transaction details: the first
+    text/plain part, otherwise the first text/html part.
+    Returns (section, subtype, transfer encoding, charset) or None.
+    """
+    if not structure:
+        return None
 
-            cell_value = ws_main.cell(row=category_row, column=3).value
-            prev_balance = 0.0
+    if isinstance(structure[0], list):
+        html_part = None
+        for index, child in enumerate(structure, start=1):
+            if not isinstance(child, list):
+                break
+            found = find_text_part(child, f"{section}.{index}" if section else str(index))
+            if found and found[1] == "PLAIN":
+                return found
+            if found and html_part is None:
+                html_part = found
+        return html_part
+
+    if len(structure) < 7 or str(structure[0]).upper() != "TEXT":
+        return None
+    subtype = str(structure[1]).upper()
+    if subtype not in ("PLAIN", "HTML"):
+        return None
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and str(disposition[0]).upper() == "ATTACHMENT":
+        return None
 
-            if isinstance(cell_value, str) and cell_value.startswith("="):
-                updated_formula = f"{cell_value} + {txn['amount']}"
-                ws_main.cell(row=category_row, column=3, value=updated_formula)
-                try:
-                    prev_str = cell_value[1:].strip()
-                    prev_balance = float(eval(prev_str))
-                except:
-                    prev_balance = 0.0
-                new_balance = prev_balance + txn["amount"]
-            else:
-                prev_balance = float(cell_value) if isinstance(cell_value, (int, float)) else 0.0
-                new_balance = prev_balance + txn["amount"]
-                ws_main.cell(row=category_row, column=3, value=new_balance)
-
-            total_amount_added += txn["amount"]
-            category_sums[chosen_cat] = category_sums.get(chosen_cat, 0) + txn["amount"]
-            log_entries.append(
-                f"[{timestamp}] '{chosen_cat}' -> Prev: Rs.{prev_balance:.2f}, +Rs.{txn['amount']:.2f}, New: Rs.{new_balance:.2f}"
+    params = structure[2] if isinstance(structure[2], list) else []
+    charset = None
+    for key, value in zip(params[::2], params[1::2]):
+        if str(key).upper() == "CHARSET":
+            charset = value
+    encoding = str(structure[5] or "7BIT").upper()
+    # A single-part message still addresses its body as part 1
+    return (section or "1", subtype, encoding, charset)
+
+def decode_part(payload, encoding, charset):
+    if encoding == "BASE64":
+        payload = base64.b64decode(payload)
+    elif encoding == "QUOTED-PRINTABLE":
+        payload = quopri.decodestring(payload)
+    try:
+        return str(payload, charset or "utf-8", errors="ignore")
+    except LookupError:
+        return str(payload, "utf-8", errors="ignore")
+
+# One pass over the markup: dropped elements, comments, then any other tag
+_HTML_TOKEN_RE = re.compile(
+    r"<(script|style|head|title)\b.*?</\1\s*>|<!--.*?-->|<(/?)([a-zA-Z][a-zA-Z0-9]*)\b[^>]*>",
+    re.IGNORECASE | re.DOTALL
+)
+_HTML_BLOCK_TAGS = {"br", "p", "div", "tr", "li", "table", "h1", "h2", "h3", "h4", "h5", "h6"}
+_HTML_SPACES_RE = re.compile(r"\s+")
+_HTML_INLINE_SPACES_RE = re.compile(r"[ \t\xa0]+")
+_HTML_LINE_BREAK_RE = re.compile(r" *\n[\s]*")
+
+def _html_token(match):
+    tag = (match.group(3) or "").lower()
+    if tag in _HTML_BLOCK_TAGS:
+        return "\n"
+    return " " if tag == "td" else ""
+
+def html_to_text(markup):
+    """Strip tags, scripts and entities from `markup`, keeping a line per block element."""
+    # Line breaks in the source are just spaces; only block tags end a line
+    text = _HTML_TOKEN_RE.sub(_html_token, _HTML_SPACES_RE.sub(" ", markup))
+    text = _HTML_INLINE_SPACES_RE.sub(" ", html.unescape(text))
+    return _HTML_LINE_BREAK_RE.sub("\n", text).strip()
+
+_RAW_HEADER_END_RE = re.compile(rb"\r?\n\r?\n")
+_RAW_HEADER_RE = re.compile(rb"^(content-type|content-transfer-encoding|content-disposition):[ \t]*(.*)$",
+                            re.IGNORECASE | re.MULTILINE)
+_RAW_PARAM_RE = re.compile(rb';\s*([\w-]+)\s*=\s*(?:"([^"]*)"|([^\s;]+))')
+
+def _raw_text_part(raw, depth=0):
+    """
+    Find the first text/plain part of a raw message (else the first
+    text/html one) by scanning boundaries, without building a Message.
+    Returns (subtype, encoding, charset, payload), or None if the message
+    is laid out in a way only the email package should deal with.
+    """
+    if depth > 5:
+        return None
+    end = _RAW_HEADER_END_RE.search(raw)
+    if not end:
+        return None
+    # Unfold continuation lines before looking at the headers we need
+    headers = re.sub(rb"\r?\n[ \t]+", b" ", raw[:end.start()])
+    fields = {name.lower(): value.strip() for name, value in _RAW_HEADER_RE.findall(headers)}
+    content_type = fields.get(b"content-type", b"text/plain")
+    if b"attachment" in fields.get(b"content-disposition", b"").lower():
+        return None
+    mime_type = content_type.split(b";", 1)[0].strip().lower()
+    params = {m.group(1).lower(): m.group(2) if m.group(2) is not None else m.group(3)
+              for m in _RAW_PARAM_RE.finditer(content_type)}
+    body = raw[end.end():]
+
+    if mime_type.startswith(b"multipart/"):
+        boundary = params.get(b"boundary")
+        if not boundary:
+            return None
+        html_part = None
+        delimiter = b"\n--" + boundary
+        body = b"\n" + body
+        at = body.find(delimiter)
+        while at != -1:
+            after = at + len(delimiter)
+            line_end = body.find(b"\n", after)
+            if body.startswith(b"--", after) or line_end == -1:
+                break
+            at = body.find(delimiter, line_end)
+            part = body[line_end + 1:at if at != -1 else len(body)]
+            found = _raw_text_part(part.rstrip(b"\r"), depth + 1)
+            if found and found[0] == "PLAIN":
+                return found
+            if found and html_part is None:
+                html_part = found
+        return html_part
+
+    if mime_type not in (b"text/plain", b"text/html"):
+        return None
+    subtype = mime_type[5:].decode("ascii").upper()
+    encoding = fields.get(b"content-transfer-encoding", b"7bit").decode("ascii", "ignore").upper()
+    charset = params.get(b"charset")
+    return (subtype, encoding, charset.decode("ascii", "ignore") if charset else None, body)
+
+def extract_body_text(raw):
+    """
+    Text worth scanning in a raw RFC822 message: the first text/plain part,
+    otherwise the first text/html part converted to text. Falls back to the
+    email package for structures the fast path doesn't handle.
+    """
+    found = _raw_text_part(raw)
+    if found is None:
+        return extract_email_text(email.message_from_bytes(raw))
+    subtype, encoding, charset, payload = found
+    text = decode_part(payload, encoding, charset)
+    return html_to_text(text) if subtype == "HTML" else text
+
+def extract_email_text(msg):
+    """Pull the text/plain body (or text/html as a fallback) out of a parsed message."""
+    email_text = ""
+    is_html = False
+    if msg.is_multipart():
+        for part in msg.walk():
+            ct = part.get_content_type()
+            cd = str(part.get("Content-Disposition"))
+            if ct == "text/plain" and "attachment" not in cd:
+                email_text = part.get_payload(decode=True).decode("utf-8", errors="ignore")
+                is_html = False
+                break
+            elif ct == "text/html" and not email_text:
+                email_text = part.get_payload(decode=True).decode("utf-8", errors="ignore")
+                is_html = True
+    else:
+        email_text = msg.get_payload(decode=True).decode("utf-8", errors="ignore")
+        is_html = msg.get_content_type() == "text/html"
+    return html_to_text(email_text) if is_html else email_text
+
+def parse_upi_transactions(email_text, msg_datetime, message_id=None, uid=None, sender=None):
+    """
+    Parse the debits in one alert with the parser registered for `sender`,
+    or with every parser whose keywords are present when the sender is
+    unknown.
+    """
+    parser = BANK_PARSERS.get((sender or "").lower())
+    parsers = [parser] if parser else BANK_PARSERS.values()
+    parsed_transactions = []
+    for parser in parsers:
+        if not parser.might_match(email_text):
+            continue
+        for date, amount, vpa_id, party_name in parser.parse(email_text):
+            parsed_transactions.append(
+                Transaction(date, amount, vpa_id, party_name, msg_datetime, message_id, uid)
             )
+        if parsed_transactions:
+            break
+    return parsed_transactions
 
-    wb.save(excel_file)
-    wb.close()
+def transaction_sort_key(txn):
+    msg_dt = txn.get("email_datetime")
+    return (msg_dt.timestamp() if msg_dt else 0.0, txn.get("uid") or 0)
 
-    summary_msg = (
-        f"Total UPI from Mail: Rs.{total_upi_amount:.2f}\n"
-        f"Total Added: Rs.{total_amount_added:.2f}\n"
-        f"Total Skipped: Rs.{total_amount_skipped:.2f}\n"
-    )
-    messagebox.showinfo("Summary", summary_msg)
-
-    # Write logs with UTF-8 encoding
-    with open(LOG_FILE, "a", encoding="utf-8") as lf:
-        lf.write("\n" + "=" * 50 + "\n")
-        for entry in log_entries:
-            lf.write(entry + "\n")
-        lf.write(f"\nTotal Expense Added Today: Rs. {total_amount_added:.2f}\n")
-        lf.write(f"Total Amount Skipped: Rs.{total_amount_skipped:.2f}\n")
-        lf.write("\n📂 **Category-wise Breakdown:**\n")
-        for cat, amount in category_sums.items():
-            lf.write(f"   - {cat}: Rs.{amount:.2f}\n")
-        lf.write("\n" + "=" * 50 + "\n\n")
-
-    if max_email_datetime:
-        set_last_processed_time(max_email_datetime)
+def iter_fetch_response(data):
+    """
+    Walk the raw data list of a multi-message FETCH and yield
+    (message number, {item name: value}) for every message in it.
+    """
+    msg_num = None
+    items = {}
+    for part in data:
+        if part is None:
+            continue
+        if isinstance(part, tuple):
+            head, literal = part[0], part[1]
+        else:
+            head, literal = part, None
+
+        start = _FETCH_START_RE.match(head)
+        if start:
+            if msg_num is not None:
+                yield msg_num, items
+            msg_num, items = start.group(1), {}
+        if msg_num is None:
+            continue
 
-# ========================
-# MAIN GUI
-# ========================
+        uid = _FETCH_UID_RE.search(head)
+        if uid:
+            items["UID"] = uid.group(1)
+        internaldate = _FETCH_INTERNALDATE_RE.search(head)
+        if internaldate:
+            items["INTERNALDATE"] = internaldate.group(1)
+        structure_at = head.find(b"BODYSTRUCTURE (")
+        if structure_at != -1:
+            # Left out if the server sent part of it as a literal; callers
+            # then fall back to downloading the whole message.
+            structure = _balanced_group(head, structure_at + len(b"BODYSTRUCTURE "))
+            if structure:
+                items["BODYSTRUCTURE"] = structure
+        if literal is not None:
+            name = _FETCH_LITERAL_RE.search(head)
+            if name:
+                items[name.group(1).decode("ascii").upper()] = literal
+
+    if msg_num is not None:
+        yield msg_num, items
+
+def _response_size(data):
+    return sum(sum(map(len, part)) if isinstance(part, tuple) else len(part) for part in data if part)
+
+def fetch_in_batches(mail, email_ids, message_parts, batch_size=FETCH_BATCH_SIZE, metrics=None):
+    """
+    Fetch `message_parts` for all of the UIDs in `email_ids`, `batch_size`
+    per UID FETCH command, and yield (uid, {item name: value}) as each batch
+    arrives. Round-trip time and bytes received go to `metrics` if given.
 
-class ExpenseGUI(tk.Tk):
-    def __init__(self):
-        super().__init__()
-        
-        # ------------------------------
-        # 1) Set the WINDOW title
-        # ------------------------------
-        self.title("💰 UPIx - A Simple UPI Expense Tracker")
-        self.geometry("1000x700")
-
-        # Decide theme by OS
-        system = platform.system()
-        style = ttk.Style(self)
-        if system == "Windows":
-            style.theme_use("default")
-        elif system == "Darwin":
-            style.theme_use("aqua")
-        else:
-            # Fallback for Linux/other systems
-            style.theme_use("clam")
-
-        # Decide text color for dark/light mode
-        is_dark = detect_dark_mode()
-        label_fg = "white" if is_dark else "black"
-
-        style.configure("LastRun.TLabel", foreground=label_fg)
-
-        # ------------------------------
-        # 2) Add a BIG LABEL on top (centered)
-        # ------------------------------
-        title_label = ttk.Label(
-            self, 
-            text="💰 UPIx - A Simple UPI Expense Tracker", 
-            font=("Helvetica", 16, "bold"),
-            foreground=label_fg
-        )
-        title_label.pack(pady=10)
+    If a whole batch fails, its messages are retried one at a time so a
+    single bad message can't take the rest of the batch down with it.
+    """
+    def timed_fetch(ids):
+        started = time.perf_counter()
+        result, data = mail.uid("FETCH", ids, message_parts)
+        if metrics:
+            metrics.add("imap_fetch", time.perf_counter() - started)
+            metrics.count("bytes_downloaded", _response_size(data or ()))
+        return result, data
+
+    for start in range(0, len(email_ids), batch_size):
+        chunk = email_ids[start:start + batch_size]
+        try:
+            result, data = timed_fetch(b",".join(chunk))
+            if result != "OK":
+                raise imaplib.IMAP4.error(f"FETCH returned {result}")
+        except Exception as e:
+            print(f"Batch fetch of {len(chunk)} emails failed ({e}), retrying one by one")
+            for e_id in chunk:
+                try:
+                    result, data = timed_fetch(e_id)
+                    for _, items in iter_fetch_response(data):
+                        yield e_id, items
+                except Exception as e2:
+                    print(f"Error fetching email ID {e_id}: {e2}")
+            continue
 
-        # -- The only change: remove text="Excel File" from LabelFrame below --
-        file_frame = ttk.LabelFrame(self)
-        file_frame.pack(fill="x", padx=10, pady=10)
+        for msg_num, items in iter_fetch_response(data):
+            yield items.get("UID", msg_num), items
 
-        ttk.Label(file_frame, text="Excel Path:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
-        self.excel_path_var = tk.StringVar(value=DEFAULT_EXCEL_FILE)
-        ttk.Entry(file_frame, textvariable=self.excel_path_var, width=55).grid(row=0, column=1, padx=5, pady=5)
-        ttk.Button(file_frame, text="Browse", command=self.browse_excel).grid(row=0, column=2, padx=5, pady=5)
+def fetch_headers(mail, email_ids, metrics=None):
+    """
+    Phase one of a fetch: yield (email id, info) with the message date,
+    Message-ID and location of the text part, without downloading bodies.
+    """
+    for e_id, items in fetch_in_batches(mail, email_ids, HEADER_FETCH_PARTS, metrics=metrics):
+        started = time.perf_counter()
+        header_bytes = b""
+        for name, value in items.items():
+            if name.startswith("BODY[HEADER"):
+                header_bytes = value
+        headers = email.message_from_bytes(header_bytes)
 
-        ttk.Label(file_frame, text="Excel Sheet Name:").grid(row=1, column=0, padx=5, pady=5, sticky="e")
-        self.sheet_var = tk.StringVar(value=SHEET_NAME)
-        ttk.Entry(file_frame, textvariable=self.sheet_var, width=20).grid(row=1, column=1, padx=5, pady=5, sticky="w")
+        try:
+            msg_datetime = parsedate_to_datetime(headers["Date"])
+        except:
+            msg_datetime = None
+        if msg_datetime is None and "INTERNALDATE" in items:
+            try:
+                msg_datetime = datetime.datetime.strptime(
+                    items["INTERNALDATE"].decode("ascii"), "%d-%b-%Y %H:%M:%S %z"
+                )
+            except ValueError:
+                msg_datetime = None
 
-        date_frame = ttk.LabelFrame(self, text="Fetch Transactions Since")
-        date_frame.pack(fill="x", padx=10, pady=5)
+        text_part = None
+        if "BODYSTRUCTURE" in items:
+            try:
+                text_part = find_text_part(parse_bodystructure(items["BODYSTRUCTURE"]))
+            except Exception:
+                text_part = None
+
+        info = {
+            "email_datetime": msg_datetime,
+            "message_id": (headers["Message-ID"] or "").strip() or None,
+            "sender": parseaddr(headers["From"] or "")[1].lower() or None,
+            "text_part": text_part
+        }
+        if metrics:
+            metrics.add("header_parse", time.perf_counter() - started)
+        yield e_id, info
+
+def fetch_email_texts(mail, pending, metrics=None):
+    """
+    Phase two of a fetch: given {email id: info} from fetch_headers, download
+    only the text part of each message and yield (email id, text).
+    Messages whose structure couldn't be read are fetched whole instead.
+    """
+    def decoded(started, text):
+        if metrics:
+            metrics.add("mime_decode", time.perf_counter() - started)
+        return text
+
+    by_section = {}
+    whole = []
+    for e_id, info in pending.items():
+        if info["text_part"]:
+            by_section.setdefault(info["text_part"][0], []).append(e_id)
+        else:
+            whole.append(e_id)
+
+    for section, ids in by_section.items():
+        for e_id, items in fetch_in_batches(mail, ids, f"(BODY.PEEK[{section}])", metrics=metrics):
+            started = time.perf_counter()
+            _, subtype, encoding, charset = pending[e_id]["text_part"]
+            text = decode_part(items.get(f"BODY[{section}]", b""), encoding, charset)
+            yield e_id, decoded(started, html_to_text(text) if subtype == "HTML" else text)
 
-        ttk.Label(date_frame, text="Enter Date:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
+    for e_id, items in fetch_in_batches(mail, whole, "(RFC822)", metrics=metrics):
+        started = time.perf_counter()
+        yield e_id, decoded(started, extract_body_text(items["RFC822"]))
 
-        today = datetime.datetime.today()
-        self.since_date_var = tk.StringVar(value=today.strftime("%d-%m-%Y"))
-        self.since_date_entry = ttk.Entry(date_frame, textvariable=self.since_date_var, width=15)
-        self.since_date_entry.grid(row=0, column=1, padx=5, pady=5, sticky="w")
+def get_uidvalidity(mail, folder=IMAP_FOLDER):
+    """Ask the server for the UIDVALIDITY of `folder`, or None if it won't say."""
+    try:
+        result, data = mail.status(_imap_mailbox(folder), "(UIDVALIDITY)")
+        if result == "OK":
+            match = re.search(rb"UIDVALIDITY (\d+)", data[0])
+            if match:
+                return int(match.group(1))
+    except Exception as e:
+        print(f"Could not read UIDVALIDITY of {folder}: {e}")
+    return None
 
-        self.last_processed_label_var = tk.StringVar()
-        last_processed = get_last_processed_time()
+def load_sync_state():
+    """
+    Read the per-mailbox sync state, a mapping of "<account>/<folder>" to
+    {"uidvalidity", "last_uid", "last_processed"}.
+    """
+    try:
+        with open(SYNC_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def get_sync_state(account, folder=IMAP_FOLDER):
+    return load_sync_state().get(mailbox_key(account, folder))
+
+# Mailboxes are fetched concurrently, but they all share the one state file
+_sync_state_lock = threading.Lock()
+
+def save_sync_state(account, folder, uidvalidity, last_uid, last_processed=None):
+    with _sync_state_lock:
+        state = load_sync_state()
+        key = mailbox_key(account, folder)
+        entry = state.get(key, {})
+        if entry.get("uidvalidity") == uidvalidity:
+            last_uid = max(last_uid, entry.get("last_uid", 0))
+        entry.update({"uidvalidity": uidvalidity, "last_uid": last_uid})
         if last_processed:
-            self.last_processed_label_var.set(
-                f"Last Updated: {last_processed.strftime('%d-%b-%Y %I:%M:%S %p')}"
-            )
-        else:
-            self.last_processed_label_var.set("Last Run: None")
+            entry["last_processed"] = last_processed.isoformat()
+        state[key] = entry
+        try:
+            tmp_file = SYNC_STATE_FILE + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_file, SYNC_STATE_FILE)
+        except Exception as e:
+            print(f"Warning: could not save sync state: {e}")
 
-        self.last_run_label = ttk.Label(
-            date_frame,
-            textvariable=self.last_processed_label_var,
-            style="LastRun.TLabel"
+def commit_sync_markers(sync_markers, last_processed=None):
+    """
+    Record that every message up to each marker's UID has been dealt with.
+    `last_processed` is the newest booked email time, either one for every
+    marker or a dict of them by mailbox key (None: mail of unknown origin).
+    """
+    for marker in sync_markers or []:
+        if marker.get("uidvalidity") is None:
+            continue
+        newest = last_processed
+        if isinstance(last_processed, dict):
+            newest = last_processed.get(mailbox_key(marker["account"], marker["folder"]))
+            newest = max(filter(None, (newest, last_processed.get(None))), default=None)
+        save_sync_state(
+            marker["account"], marker["folder"], marker["uidvalidity"],
+            marker["last_uid"], newest
         )
-        self.last_run_label.grid(row=1, column=0, columnspan=2, padx=5, pady=2, sticky="w")
 
-        btn_frame = ttk.Frame(self)
-        btn_frame.pack(fill="x", padx=10, pady=5)
+def merge_sync_markers(sync_markers, newer):
+    """`sync_markers` with each mailbox's marker replaced by its one in `newer`, if any."""
+    merged = {(m["account"], m["folder"]): m for m in sync_markers or []}
+    merged.update(((m["account"], m["folder"]), m) for m in newer or [])
+    return list(merged.values())
 
-        self.fetch_btn = ttk.Button(btn_frame, text="Fetch UPI Transactions", command=self.on_fetch_clicked)
-        self.fetch_btn.pack(side="left", padx=5)
+def get_last_processed_time(account=None, folder=None):
+    """
+    Newest booked email time recorded in the sync state (for one mailbox if
+    given), falling back to the old last_processed_time.txt, which only
+    ever covered EMAIL_USER's IMAP_FOLDER.
+    """
+    latest = None
+    for key, entry in load_sync_state().items():
+        if account is not None and key != mailbox_key(account, folder or IMAP_FOLDER):
+            continue
+        try:
+            dt = datetime.datetime.fromisoformat(entry["last_processed"])
+        except (KeyError, ValueError):
+            continue
+        if latest is None or dt > latest:
+            latest = dt
+    if latest:
+        return latest
 
-        self.update_btn = ttk.Button(btn_frame, text="Update Excel", command=self.on_update_clicked)
-        self.update_btn.pack(side="left", padx=5)
+    if account is not None and (account, folder or IMAP_FOLDER) != (EMAIL_USER, IMAP_FOLDER):
+        return None
+    if not os.path.exists(LAST_PROCESSED_FILE):
+        return None
+    try:
+        with open(LAST_PROCESSED_FILE, "r", encoding="utf-8") as f:
+            text = f.read().strip()
+            return datetime.datetime.fromisoformat(text)
+    except Exception:
+        return None
 
-        self.quit_btn = ttk.Button(btn_frame, text="Quit", command=self.on_quit_clicked)
-        self.quit_btn.pack(side="right", padx=5)
+# =========================
+# LOCAL CACHE
+# =========================
 
-        self.progress_bar = ttk.Progressbar(btn_frame, orient="horizontal", mode="determinate")
+_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    message_id TEXT PRIMARY KEY,
+    account TEXT,
+    folder TEXT,
+    uid INTEGER,
+    email_datetime TEXT,
+    body TEXT
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    message_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    uid INTEGER,
+    txn_date TEXT,
+    date TEXT,
+    email_datetime TEXT,
+    amount REAL,
+    vpa_id TEXT,
+    party_name TEXT,
+    category TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (message_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_txn_date ON transactions (txn_date);
+CREATE INDEX IF NOT EXISTS idx_transactions_vpa_id ON transactions (vpa_id);
+"""
+
+def open_cache():
+    """Open (creating if needed) the local message/transaction store."""
+    conn = sqlite3.connect(CACHE_DB_FILE, timeout=30)
+    conn.executescript(_CACHE_SCHEMA)
+    return conn
+
+def cache_key(message_id, account, folder, uid):
+    """Messages are keyed by Message-ID; the rare one without falls back to its mailbox UID."""
+    return message_id or f"uid:{account}/{folder}/{uid}"
+
+def _txn_iso_date(date_str, msg_datetime):
+    try:
+        return datetime.datetime.strptime(date_str, "%d-%m-%y").date().isoformat()
+    except (TypeError, ValueError):
+        return msg_datetime.date().isoformat() if msg_datetime else None
+
+def _txn_from_row(row):
+    message_id, uid, date_str, email_dt, amount, vpa_id, party_name, category = row
+    return Transaction(
+        date_str, amount, vpa_id, party_name,
+        datetime.datetime.fromisoformat(email_dt) if email_dt else None,
+        message_id, uid, category
+    )
 
-        self.tree_frame = ttk.Frame(self)
-        self.tree_frame.pack(fill="both", expand=True, padx=10, pady=5)
+_TXN_COLUMNS = "message_id, uid, date, email_datetime, amount, vpa_id, party_name, category"
 
-        columns = ("date", "party_name", "vpa_id", "amount", "category")
-        self.tree = ttk.Treeview(self.tree_frame, columns=columns, show="headings", height=15)
+def cache_lookup(keys):
+    """
+    Return {cache key: [transactions]} for every already-parsed message among
+    `keys` (messages that held no transactions map to an empty list).
+    """
+    found = {}
+    keys = list(keys)
+    if not keys:
+        return found
+    with closing(open_cache()) as conn:
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            for (key,) in conn.execute(f"SELECT message_id FROM messages WHERE message_id IN ({marks})", chunk):
+                found[key] = []
+            rows = conn.execute(
+                f"SELECT {_TXN_COLUMNS} FROM transactions WHERE message_id IN ({marks}) ORDER BY message_id, seq",
+                chunk
+            )
+            for row in rows:
+                found.setdefault(row[0], []).append(_txn_from_row(row))
+    return found
 
-        self.tree.heading("date", text="Date", anchor="center")
-        self.tree.heading("party_name", text="Party Name", anchor="center")
-        self.tree.heading("vpa_id", text="UPI ID", anchor="center")
-        self.tree.heading("amount", text="Amount (Rs)", anchor="center")
-        self.tree.heading("category", text="Category", anchor="center")
+def cache_store(messages, account, folder):
+    """
+    Remember freshly parsed messages. `messages` is a list of
+    (uid, info from fetch_headers, email text, transactions).
+    """
+    if not messages:
+        return
+    with closing(open_cache()) as conn, conn:
+        for uid, info, email_text, txns in messages:
+            key = info["message_id"]
+            msg_dt = info["email_datetime"]
+            conn.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                (key, account, folder, uid, msg_dt.isoformat() if msg_dt else None,
+                 email_text if CACHE_STORE_BODIES else None)
+            )
+            conn.execute("DELETE FROM transactions WHERE message_id = ?", (key,))
+            conn.executemany(
+                "INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, '')",
+                [(key, seq, uid, _txn_iso_date(txn["date"], msg_dt), txn["date"],
+                  msg_dt.isoformat() if msg_dt else None, txn["amount"], txn["vpa_id"], txn["party_name"])
+                 for seq, txn in enumerate(txns)]
+            )
 
-        self.tree.column("date", width=120, anchor="center")
-        self.tree.column("party_name", width=150, anchor="center")
-        self.tree.column("vpa_id", width=150, anchor="center")
-        self.tree.column("amount", width=120, anchor="center")
-        self.tree.column("category", width=120, anchor="center")
+def cache_set_categories(transactions, category_choices):
+    """
+    Record the category each booked or skipped transaction ended up with.
+    Rows with no category were held back, and stay uncategorized in the
+    cache so the next run holds them again.
+    """
+    updates = [
+        (cat, txn["message_id"], txn["vpa_id"], txn["amount"], txn["date"])
+        for txn, cat in zip(transactions, category_choices)
+        if cat and txn.get("message_id")
+    ]
+    if not updates:
+        return
+    try:
+        with closing(open_cache()) as conn, conn:
+            # The unary + keeps SQLite on the message_id key instead of the VPA index,
+            # which a statement's few VPAs with thousands of rows each make slow
+            conn.executemany(
+                "UPDATE transactions SET category = ? "
+                "WHERE message_id = ? AND +vpa_id = ? AND amount = ? AND date = ?",
+                updates
+            )
+    except sqlite3.Error as e:
+        print(f"Warning: could not update cached categories: {e}")
 
-        self.tree.pack(side="left", fill="both", expand=True)
-        scrollbar = ttk.Scrollbar(self.tree_frame, orient="vertical", command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
-        scrollbar.pack(side="right", fill="y")
+# Statement rows are cached under a made-up Message-ID with this prefix
+STATEMENT_ID_PREFIX = "statement:"
 
-        cat_frame = ttk.LabelFrame(self, text="")
-        cat_frame.pack(fill="x", padx=10, pady=5)
+def is_statement_row(txn):
+    return (txn.get("message_id") or "").startswith(STATEMENT_ID_PREFIX)
 
-        ttk.Label(cat_frame, text="Choose Category:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
-        self.single_combobox_var = tk.StringVar()
-        self.single_combobox = ttk.Combobox(
-            cat_frame,
-            textvariable=self.single_combobox_var,
-            values=list(EXPENSE_CATEGORIES.values()),
-            state="readonly",
-            width=25
+def drop_cached_duplicates(transactions, against):
+    """
+    Split `transactions` into (new, already known) by matching each to a
+    cached row from the other source, "mail" or "statement", with the same
+    date, amount and VPA. A cached row matches at most one transaction;
+    rows without a VPA, or from the same source, are always new.
+    """
+    from_statement = against == "statement"
+    candidates = [txn for txn in transactions if txn["vpa_id"] and is_statement_row(txn) != from_statement]
+    days = [day for day in (_txn_iso_date(txn["date"], txn["email_datetime"]) for txn in candidates) if day]
+    if not days:
+        return list(transactions), []
+
+    def match_key(day, amount, vpa_id):
+        return day, round(amount * 100), (vpa_id or "").lower()
+
+    known = {}
+    with closing(open_cache()) as conn:
+        rows = conn.execute(
+            "SELECT txn_date, amount, vpa_id FROM transactions WHERE txn_date BETWEEN ? AND ? "
+            f"AND message_id {'' if from_statement else 'NOT '}LIKE ?",
+            (min(days), max(days), STATEMENT_ID_PREFIX + "%")
         )
-        self.single_combobox.grid(row=0, column=1, padx=5, pady=5, sticky="w")
+        for row in rows:
+            key = match_key(*row)
+            known[key] = known.get(key, 0) + 1
+
+    fresh, duplicates = [], []
+    for txn in transactions:
+        key = None
+        if txn["vpa_id"] and is_statement_row(txn) != from_statement:
+            key = match_key(_txn_iso_date(txn["date"], txn["email_datetime"]), txn["amount"], txn["vpa_id"])
+        if known.get(key):
+            known[key] -= 1
+            duplicates.append(txn)
+        else:
+            fresh.append(txn)
+    return fresh, duplicates
+
+def load_cached_transactions(since_date, until_date=None):
+    """All cached transactions dated `since_date` (inclusive) to `until_date` (exclusive), oldest first."""
+    query = f"SELECT {_TXN_COLUMNS} FROM transactions WHERE txn_date >= ?"
+    params = [since_date.strftime("%Y-%m-%d")]
+    if until_date:
+        query += " AND txn_date < ?"
+        params.append(until_date.strftime("%Y-%m-%d"))
+    with closing(open_cache()) as conn:
+        rows = conn.execute(query + " ORDER BY message_id, seq", params).fetchall()
+    return sorted((_txn_from_row(row) for row in rows), key=transaction_sort_key)
 
-        self.apply_selected_btn = ttk.Button(cat_frame, text="Apply to Selected", command=self.on_apply_selected_clicked)
-        self.apply_selected_btn.grid(row=0, column=2, padx=5, pady=5)
+# =========================
+# BOOKING LEDGER
+# =========================
 
-        self.apply_all_btn = ttk.Button(cat_frame, text="Apply to All", command=self.on_apply_all_clicked)
-        self.apply_all_btn.grid(row=0, column=3, padx=5, pady=5)
+def open_ledger():
+    conn = sqlite3.connect(LEDGER_DB_FILE, timeout=30)
+    conn.execute("CREATE TABLE IF NOT EXISTS booked (key TEXT PRIMARY KEY, booked_at TEXT)")
+    return conn
 
-        # Internals
-        self.transactions = []
-        self.category_choices = []
-        self.fetch_thread = None
-        self.total_emails = 0
-        self.processed_emails = 0
-        self.since_date_str = ""
+def ledger_keys(transactions):
+    """
+    One stable key per transaction, hashed from (Message-ID, amount, VPA,
+    date). Repeats of the same tuple within one message get numbered so they
+    stay distinct; a copy of the message from another mailbox gets the same
+    keys as the first.
+    """
+    keys = []
+    seen = {}
+    for txn in transactions:
+        ident = f"{txn.get('message_id') or ''}|{txn['amount']:.2f}|{txn['vpa_id']}|{txn['date']}"
+        occurrence = seen.get((ident, txn.get("mailbox")), 0)
+        seen[(ident, txn.get("mailbox"))] = occurrence + 1
+        if occurrence:
+            ident += f"#{occurrence}"
+        keys.append(hashlib.sha1(ident.encode("utf-8")).hexdigest())
+    return keys
+
+def ledger_booked(keys):
+    """The subset of `keys` that has already been booked into a workbook."""
+    booked = set()
+    keys = list(keys)
+    with closing(open_ledger()) as conn:
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            booked.update(k for (k,) in conn.execute(f"SELECT key FROM booked WHERE key IN ({marks})", chunk))
+    return booked
+
+def ledger_record(keys):
+    booked_at = datetime.datetime.now().isoformat(timespec="seconds")
+    with closing(open_ledger()) as conn, conn:
+        conn.executemany("INSERT OR IGNORE INTO booked VALUES (?, ?)", [(k, booked_at) for k in keys])
 
-    def on_quit_clicked(self):
-        self.destroy()
+# =========================
+# CATEGORY INDEX
+# =========================
 
-    def on_fetch_clicked(self):
-        if self.fetch_thread and self.fetch_thread.is_alive():
-            messagebox.showwarning("Warning", "Fetching is already in progress.")
-            return
+def open_category_index():
+    conn = sqlite3.connect(CATEGORY_INDEX_FILE, timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS merchant_categories ("
+        "kind TEXT NOT NULL, key TEXT NOT NULL, category TEXT NOT NULL, updated_at TEXT, "
+        "PRIMARY KEY (kind, key))"
+    )
+    return conn
+
+# Handle prefixes payment aggregators give every merchant they sign up
+# ("q700001@ybl" is a PhonePe QR, "paytmqr28100@paytm" a Paytm one); the
+# merchants behind one of them have nothing in common
+VPA_FAMILY_AGGREGATORS = {
+    "q", "qr", "paytmqr", "paytm", "bharatpe", "phonepe", "gpay", "googlepay", "mab", "ombk",
+    "razorpay", "rzp", "cashfree", "payu", "billdesk", "pinelabs", "upi", "pay", "merchant",
+}
+
+def vpa_family(vpa_id):
+    """
+    The handle family of a VPA: the local part up to its first digit, at
+    the same provider, so "bookmyshow1@icici" and "bookmyshow2@icici" share
+    "bookmyshow@icici". Phone-number VPAs, stems under three letters and
+    aggregator prefixes (VPA_FAMILY_AGGREGATORS) have no family.
+    """
+    local, _, domain = (vpa_id or "").lower().partition("@")
+    stem = re.split(r"\d", local, 1)[0].rstrip("._-")
+    if not domain or len(re.sub(r"[^a-z]", "", stem)) < 3:
+        return None
+    if re.split(r"[._-]", stem, 1)[0] in VPA_FAMILY_AGGREGATORS:
+        return None
+    return f"{stem}@{domain}"
 
-        self.set_button_processing(self.fetch_btn)
-        self.progress_bar.pack(side="left", padx=5)
-        self.progress_bar["value"] = 0
-        self.progress_bar.config(mode="determinate", maximum=1)
+def normalize_party(party_name):
+    return " ".join(re.sub(r"[^\w&]+", " ", (party_name or "").lower()).split())
+
+def _category_index_keys(txn):
+    """(kind, key) pairs for one transaction, most specific first."""
+    keys = [("vpa", (txn["vpa_id"] or "").lower()), ("party", normalize_party(txn["party_name"]))]
+    family = vpa_family(txn["vpa_id"])
+    if family:
+        keys.append(("family", family))
+    return [(kind, key) for kind, key in keys if key]
+
+def suggest_categories(transactions):
+    """
+    Pre-fill the category of every uncategorized transaction the index
+    knows, in one lookup for the whole batch. Returns how many were filled.
+    """
+    wanted = [txn for txn in transactions if not txn.get("category")]
+    lookups = {}
+    for txn in wanted:
+        for kind, key in _category_index_keys(txn):
+            lookups.setdefault(kind, set()).add(key)
+    if not lookups:
+        return 0
+    known = {}
+    try:
+        with closing(open_category_index()) as conn:
+            # kind leads the primary key, so one query per kind is an index search, not a scan
+            for kind, keys in lookups.items():
+                keys = list(keys)
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start:start + 500]
+                    marks = ",".join("?" * len(chunk))
+                    for key, category in conn.execute(
+                        f"SELECT key, category FROM merchant_categories WHERE kind = ? AND key IN ({marks})",
+                        [kind] + chunk
+                    ):
+                        known[(kind, key)] = category
+    except sqlite3.Error as e:
+        print(f"Warning: category index unavailable: {e}")
+        return 0
+
+    filled = 0
+    for txn in wanted:
+        for index_key in _category_index_keys(txn):
+            if index_key in known:
+                txn["category"] = known[index_key]
+                filled += 1
+                break
+    return filled
+
+def learn_categories(transactions, category_choices):
+    """Remember the category each booked transaction went into, for every key it has."""
+    updated_at = datetime.datetime.now().isoformat(timespec="seconds")
+    rows = {}
+    for txn, cat in zip(transactions, category_choices):
+        for kind, key in _category_index_keys(txn):
+            rows[(kind, key)] = (kind, key, cat, updated_at)
+    if not rows:
+        return
+    try:
+        with closing(open_category_index()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO merchant_categories VALUES (?, ?, ?, ?)", rows.values())
+    except sqlite3.Error as e:
+        print(f"Warning: could not update the category index: {e}")
 
-        # Clear old data
-        for row in self.tree.get_children():
-            self.tree.delete(row)
-        self.transactions.clear()
-        self.category_choices.clear()
+# =========================
+# INGESTION ENGINE
+# =========================
 
-        self.fetch_thread = threading.Thread(target=self.fetch_transactions_in_thread)
-        self.fetch_thread.start()
+class FetchError(Exception):
+    """A fetch that couldn't get going at all (login or SEARCH failed)."""
 
-    def on_update_clicked(self):
-        self.set_button_processing(self.update_btn)
+class ThrottledIMAP:
+    """
+    Wraps a logged-in IMAP session so UID commands on it are spaced out to
+    at most `max_rate` per second, keeping Gmail's throttling at bay.
+    """
+    def __init__(self, mail, max_rate):
+        self.mail = mail
+        self.min_interval = 1.0 / max_rate if max_rate else 0.0
+        self.next_call = 0.0
+        self.metrics = None
+        self.folder = None
+
+    def uid(self, *args):
+        wait = self.next_call - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+            if self.metrics:
+                self.metrics.add("imap_throttle", wait)
+        self.next_call = time.monotonic() + self.min_interval
+        return self.mail.uid(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.mail, name)
+
+class IMAPConnectionPool:
+    """
+    A bounded set of logged-in IMAP sessions for one account. Sessions are
+    handed back after each fetch and reused by the next one, so repeat
+    fetches skip the TLS handshake and LOGIN. `size` and `max_rate` default
+    to the account's limits; `connect(folder)` returns a session with
+    `folder` selected, or None.
+    """
+    def __init__(self, size=None, max_rate=None, connect=None, account=None):
+        self.account = account or default_account()
+        self.size = size or self.account.max_sessions
+        self.max_rate = self.account.max_rate if max_rate is None else max_rate
+        self.connect = connect or (lambda folder: connect_gmail(self.account, folder))
+        self.idle = []
+        self.open_count = 0
+        self.lock = threading.Condition()
+
+    def acquire(self, metrics=None, folder=None, blocking=True):
+        """
+        Borrow a live session with `folder` (the account's first) selected,
+        waiting if all `size` are in use (or, with blocking=False, returning
+        None). None if login or SELECT fails. Its commands are timed into
+        `metrics` if given.
+        """
+        folder = folder or self.account.folders[0]
+        while True:
+            with self.lock:
+                while not self.idle and self.open_count >= self.size:
+                    if not blocking:
+                        return None
+                    self.lock.wait()
+                if self.idle:
+                    conn = self.idle.pop()
+                else:
+                    conn = None
+                    self.open_count += 1
+
+            if conn is None:
+                started = time.perf_counter()
+                mail = self.connect(folder)
+                if metrics:
+                    metrics.add("imap_login", time.perf_counter() - started)
+                if not mail:
+                    with self.lock:
+                        self.open_count -= 1
+                        self.lock.notify()
+                    return None
+                conn = ThrottledIMAP(mail, self.max_rate)
+                conn.metrics = metrics
+                conn.folder = folder
+                return conn
+
+            # Idle sessions can time out server-side; make sure this one is alive
+            try:
+                started = time.perf_counter()
+                conn.mail.noop()
+                if metrics:
+                    metrics.add("imap_noop", time.perf_counter() - started)
+            except Exception:
+                self.release(conn, broken=True)
+                continue
+            conn.metrics = metrics
+            if conn.folder == folder:
+                return conn
+            # Last used on another folder of the same account
+            try:
+                result, data = conn.mail.select(_imap_mailbox(folder))
+            except Exception as e:
+                print(f"Error opening {mailbox_key(self.account.user, folder)}: {e}")
+                self.release(conn, broken=True)
+                continue
+            if result != "OK":
+                print(f"Error opening {mailbox_key(self.account.user, folder)}: {data[0]!r}")
+                conn.folder = None
+                self.release(conn)
+                return None
+            conn.folder = folder
+            return conn
+
+    def release(self, conn, broken=False):
+        if broken:
+            try:
+                conn.mail.logout()
+            except Exception:
+                pass
+        with self.lock:
+            if broken:
+                self.open_count -= 1
+            else:
+                self.idle.append(conn)
+            self.lock.notify()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+            self.open_count -= len(idle)
+        for conn in idle:
+            try:
+                conn.mail.logout()
+            except Exception:
+                pass
+
+# One pool per account, so each account's session and rate limits hold on their own
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(account=None):
+    """The process-wide pool for `account` (the default one), created on first use."""
+    account = account or default_account()
+    with _connection_pools_lock:
+        pool = _connection_pools.get(account.key)
+        if pool is None:
+            pool = _connection_pools[account.key] = IMAPConnectionPool(account=account)
+        return pool
+
+def close_connection_pools():
+    """Log out every idle session of every account's pool."""
+    with _connection_pools_lock:
+        pools = list(_connection_pools.values())
+    for pool in pools:
+        pool.close()
+
+def _ingest_shard(mail, uids, last_processed, on_progress, metrics, account, folder, cancel_event=None):
+    """
+    Run the header and body phases over one shard of UIDs on one session
+    of `account`'s `folder`. Returns (transactions, set of UIDs fully processed, freshly parsed
+    messages for the cache). Once `cancel_event` is set it stops after the
+    FETCH batch in hand, leaving the session clean.
+    """
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    transactions = []
+    done = set()
+    fresh = []
+    mailbox = mailbox_key(account, folder)
+
+    # Phase one: headers only, so already-processed mails never download a body
+    if cancelled():
+        return transactions, done, fresh
+    pending = {}
+    for e_id, info in fetch_headers(mail, uids, metrics):
+        if cancelled():
+            return transactions, done, fresh
         try:
-            self.update_excel_gui()
-        finally:
-            self.set_button_normal(self.update_btn, "Update Excel")
+            # skip if <= last_processed
+            msg_datetime = info["email_datetime"]
+            if last_processed and msg_datetime and msg_datetime <= last_processed:
+                done.add(int(e_id))
+                metrics.count("skipped_processed")
+                on_progress()
+                continue
+            info["message_id"] = cache_key(info["message_id"], account, folder, int(e_id))
+            pending[e_id] = info
+        except Exception as e2:
+            print(f"Error processing email ID {e_id}: {e2}")
 
-    def on_apply_selected_clicked(self):
-        self.set_button_processing(self.apply_selected_btn)
+    # Mails parsed on an earlier run are served from the local cache
+    try:
+        with metrics.stage("cache_lookup"):
+            cached = cache_lookup(info["message_id"] for info in pending.values())
+    except sqlite3.Error as e:
+        print(f"Warning: local cache unavailable: {e}")
+        cached = {}
+    for e_id in list(pending):
+        key = pending[e_id]["message_id"]
+        if key in cached:
+            for txn in cached[key]:
+                txn["uid"] = int(e_id)
+                txn["mailbox"] = mailbox
+                transactions.append(txn)
+            del pending[e_id]
+            done.add(int(e_id))
+            metrics.count("cache_hits")
+            on_progress()
+
+    # Phase two: just the text part of the survivors
+    for e_id, email_text in fetch_email_texts(mail, pending, metrics):
+        if cancelled():
+            break
         try:
-            selected_item_id = self.tree.focus()
-            if not selected_item_id:
-                messagebox.showwarning("No Selection", "Please select a row.")
-                return
+            info = pending[e_id]
+            started = time.perf_counter()
+            parsed = parse_upi_transactions(
+                email_text, info["email_datetime"], info["message_id"], int(e_id),
+                info.get("sender")
+            )
+            metrics.add("regex", time.perf_counter() - started)
+            metrics.count("regex_tried")
+            if parsed:
+                metrics.count("regex_hits")
+            for txn in parsed:
+                txn["mailbox"] = mailbox
+            transactions.extend(parsed)
+            fresh.append((int(e_id), info, email_text, parsed))
+            done.add(int(e_id))
+            on_progress()
+        except Exception as e2:
+            metrics.count("parse_errors")
+            print(f"Error processing email ID {e_id}: {e2}")
+
+    return transactions, done, fresh
+
+def ingest_transactions(since_date, pool=None, on_total=None, on_progress=None, after_uid=None,
+                        metrics=None, account=None, folder=None, cancel_event=None):
+    """
+    Find and parse every UPI alert since `since_date` in one mailbox,
+    `account`'s `folder` (by default the pool's account and its first
+    folder), that hasn't been processed yet, fetching shards of the result
+    set in parallel over the account's connection pool. `after_uid` skips UIDs the caller has already been
+    handed but not booked yet (watch mode); the caller then owns
+    committing the sync markers.
+
+    Returns a dict with the transactions (oldest first), the sync markers
+    to commit once they're booked, and the number of emails searched.
+    Timings go to `metrics`, which the caller then finishes; without one
+    the run reports itself and the dict also carries "metrics".
+    Raises FetchError if the mailbox couldn't be searched, or if
+    `cancel_event` got set because the caller gave up waiting; such a run
+    never commits sync markers.
+    """
+    account = account or (pool.account if pool else default_account())
+    pool = pool or get_connection_pool(account)
+    folder = folder or account.folders[0]
+    mailbox = mailbox_key(account.user, folder)
+    on_total = on_total or (lambda total: None)
+    on_progress = on_progress or (lambda: None)
+    own_metrics = metrics is None
+    metrics = metrics or RunMetrics("fetch")
+
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    def finished(result):
+        metrics.count("transactions", len(result["transactions"]))
+        if own_metrics:
+            result["metrics"] = metrics.finish()
+        return result
+
+    with metrics.stage("imap_connect"):
+        mail = pool.acquire(metrics, folder)
+    if not mail:
+        if own_metrics:
+            metrics.finish(error="connect failed")
+        raise FetchError(f"Failed to open {mailbox}. Check credentials and folder name.")
 
-            row_index = int(selected_item_id)
-            chosen_cat = self.single_combobox_var.get()
-            if not chosen_cat:
-                messagebox.showwarning("No Category", "Pick a category first.")
-                return
+    try:
+        since_str = since_date.strftime("%d-%b-%Y")
+        senders = sender_search_criteria()
+
+        # Incremental sync: only UIDs above the last processed one, unless the
+        # mailbox's UIDVALIDITY changed and every stored UID is meaningless.
+        uidvalidity = get_uidvalidity(mail, folder)
+        state = get_sync_state(account.user, folder)
+        last_uid = None
+        if state and uidvalidity is not None and state.get("uidvalidity") == uidvalidity:
+            last_uid = state.get("last_uid", 0)
+        if after_uid is not None and uidvalidity is not None:
+            last_uid = max(last_uid or 0, after_uid)
+        if last_uid is not None:
+            search_query = f'(UID {last_uid + 1}:* {senders} SINCE "{since_str}")'
+            last_processed = None
+        else:
+            last_uid = 0
+            search_query = f'({senders} SINCE "{since_str}")'
+            last_processed = get_last_processed_time(account.user, folder)
 
-            self.category_choices[row_index] = chosen_cat
-            values = list(self.tree.item(row_index, "values"))
-            values[-1] = chosen_cat
-            self.tree.item(row_index, values=values)
-        finally:
-            self.set_button_normal(self.apply_selected_btn, "Apply to Selected")
+        try:
+            with metrics.stage("imap_search"):
+                result, data = mail.uid("SEARCH", None, search_query)
+        except Exception as e:
+            pool.release(mail, broken=True)
+            mail = None
+            raise FetchError(f"Error searching {mailbox}:\n{e}")
+        if result != "OK":
+            raise FetchError(f"Failed to search {mailbox}.")
+
+        # "n:*" always matches the newest message, even if it's below n
+        email_ids = [uid for uid in data[0].split() if int(uid) > last_uid]
+        metrics.count("emails_found", len(email_ids))
+        on_total(len(email_ids))
+        if not email_ids:
+            return finished({"transactions": [], "sync_markers": [], "total": 0})
+
+        # Contiguous shards, one per worker, never smaller than a FETCH batch
+        shard_count = max(1, min(pool.size, len(email_ids) // FETCH_BATCH_SIZE))
+        shard_size = -(-len(email_ids) // shard_count)
+        shards = [email_ids[i:i + shard_size] for i in range(0, len(email_ids), shard_size)]
+
+        progress_lock = threading.Lock()
+        def report_progress():
+            with progress_lock:
+                on_progress()
+
+        def run_shard(index, conn):
+            try:
+                return _ingest_shard(conn, shards[index], last_processed, report_progress, metrics,
+                                     account.user, folder, cancel_event)
+            except Exception as e:
+                print(f"Shard {index + 1}/{len(shards)} failed: {e}")
+                if conn is not mail:
+                    pool.release(conn, broken=True)
+                    conn = None
+                return [], set(), []
+            finally:
+                if conn is not None and conn is not mail:
+                    pool.release(conn)
+
+        def run_extra_shard(index):
+            # Only a session that is free right now: other folders of the account
+            # (watch mode) may be fetching on this pool, and waiting for one they
+            # hold while holding `mail` could wait forever
+            with metrics.profiled():
+                conn = pool.acquire(metrics, folder, blocking=False)
+                if conn is None:
+                    return None
+                return run_shard(index, conn)
+        transactions = []
+        processed = set()
+        fresh = []
+        metrics.count("shards", len(shards))
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            extra = executor.map(run_extra_shard, range(1, len(shards)))
+            results = [run_shard(0, mail)]
+            # Shards that found no free session run on this one afterwards
+            for index, result in enumerate(extra, 1):
+                results.append(result or run_shard(index, mail))
+        for shard_txns, shard_done, shard_fresh in results:
+            transactions.extend(shard_txns)
+            processed |= shard_done
+            fresh.extend(shard_fresh)
+        transactions.sort(key=transaction_sort_key)
 
-    def on_apply_all_clicked(self):
-        self.set_button_processing(self.apply_all_btn)
         try:
-            chosen_cat = self.single_combobox_var.get()
-            if not chosen_cat:
-                messagebox.showwarning("No Category", "Pick a category first.")
+            with metrics.stage("cache_store"):
+                cache_store(fresh, account.user, folder)
+        except sqlite3.Error as e:
+            print(f"Warning: could not update local cache: {e}")
+        if cancelled():
+            raise FetchError(f"Gave up on {mailbox}; it's left for the next fetch.")
+
+        # Never move the marker past a message that failed to process
+        all_uids = {int(uid) for uid in email_ids}
+        failed = all_uids - processed
+        sync_markers = [{
+            "account": account.user,
+            "folder": folder,
+            "uidvalidity": uidvalidity,
+            "last_uid": (min(failed) - 1) if failed else max(all_uids)
+        }]
+
+        # Alerts for debits a statement import has already brought in
+        try:
+            with metrics.stage("statement_dedupe"):
+                transactions, imported = drop_cached_duplicates(transactions, "statement")
+            metrics.count("statement_duplicates", len(imported))
+        except sqlite3.Error as e:
+            print(f"Warning: could not check imported statements: {e}")
+
+        # Nothing to categorize means no "Update Excel" will record this run,
+        # so mark the mails as processed now.
+        if not transactions and after_uid is None and not cancelled():
+            commit_sync_markers(sync_markers)
+        with metrics.stage("categorize"):
+            metrics.count("categories_suggested", suggest_categories(transactions))
+
+        return finished({"transactions": transactions, "sync_markers": sync_markers, "total": len(email_ids)})
+    finally:
+        if mail is not None:
+            pool.release(mail)
+        if own_metrics:
+            metrics.finish()
+
+def drop_copied_messages(transactions, delivered=None):
+    """
+    `transactions` without copies of a message another mailbox already
+    delivered, as when a mail filter files one alert into two folders.
+    `delivered` maps Message-ID to the mailbox it came from first; it's
+    updated in place.
+    """
+    delivered = {} if delivered is None else delivered
+    kept = []
+    for txn in transactions:
+        message_id, mailbox = txn.get("message_id"), txn.get("mailbox")
+        if message_id and delivered.setdefault(message_id, mailbox) != mailbox:
+            continue
+        kept.append(txn)
+    return kept
+
+def ingest_mailboxes(since_date, accounts=None, on_total=None, on_progress=None, after_uids=None,
+                     metrics=None, timeout=MAILBOX_STALL_SECONDS):
+    """
+    ingest_transactions over every folder of every account (load_accounts()
+    by default), the accounts side by side, each through its own pool and
+    limits. An account's folders take turns, so together they stay within
+    its session limit. `after_uids` maps mailbox keys to after_uid.
+    `on_total` gets the running total of emails found so far.
+
+    A mailbox that fails, or whose account has made no progress for
+    `timeout` seconds while another account is still going, is left for
+    the next fetch and listed in the result's "errors" (mailbox key ->
+    message); it never holds back the others. A stalled account is told to
+    stop, and commits nothing. Otherwise returns what ingest_transactions
+    does, for all mailboxes at once, the transactions merged oldest first,
+    each message's only once even if it was filed into several folders.
+    Raises FetchError only if every mailbox failed.
+    """
+    accounts = accounts or load_accounts()
+    after_uids = after_uids or {}
+    on_total = on_total or (lambda total: None)
+    on_progress = on_progress or (lambda: None)
+    own_metrics = metrics is None
+    metrics = metrics or RunMetrics("fetch")
+    results = queue.Queue()
+    totals = {}
+    report_lock = threading.Lock()
+    # Per account: when it last showed signs of life, and the flag that stops it
+    heard_from = {n: time.monotonic() for n in range(len(accounts))}
+    cancel_events = {n: threading.Event() for n in range(len(accounts))}
+
+    def report_total(n, mailbox, total):
+        with report_lock:
+            heard_from[n] = time.monotonic()
+            totals[mailbox] = total
+            on_total(sum(totals.values()))
+
+    def report_progress(n):
+        with report_lock:
+            heard_from[n] = time.monotonic()
+            on_progress()
+
+    def run_account(n, account):
+        for folder in account.folders:
+            if cancel_events[n].is_set():
                 return
+            heard_from[n] = time.monotonic()
+            mailbox = mailbox_key(account.user, folder)
+            try:
+                # Profiled per folder, so the profile is handed over before the result
+                with metrics.profiled():
+                    result = ingest_transactions(
+                        since_date, pool=get_connection_pool(account),
+                        on_total=lambda total, mailbox=mailbox: report_total(n, mailbox, total),
+                        on_progress=lambda: report_progress(n), after_uid=after_uids.get(mailbox),
+                        metrics=metrics, account=account, folder=folder, cancel_event=cancel_events[n]
+                    )
+            except Exception as e:
+                result = e
+            results.put((mailbox, result))
+
+    owner = {mailbox: n for n, account in enumerate(accounts) for mailbox in account.mailboxes()}
+    mailboxes = list(owner)
+    metrics.count("mailboxes", len(mailboxes))
+    for n, account in enumerate(accounts):
+        # Daemon threads: a hung server can't keep the process alive once the rest are done
+        threading.Thread(target=run_account, args=(n, account), daemon=True).start()
+
+    merged = {"transactions": [], "sync_markers": [], "total": 0, "errors": {}}
+    pending = set(mailboxes)
+    with metrics.stage("mailboxes"):
+        while pending:
+            running = {owner[mailbox] for mailbox in pending}
+            # The last account still going is waited for however long it takes
+            wait = None
+            if timeout and len(running) > 1:
+                wait = max(0.0, min(heard_from[n] for n in running) + timeout - time.monotonic())
+            try:
+                mailbox, result = results.get(timeout=wait)
+            except queue.Empty:
+                now = time.monotonic()
+                stalled = sorted((n for n in running if now - heard_from[n] >= timeout), key=heard_from.get)
+                if len(stalled) == len(running):
+                    stalled.pop()
+                for n in stalled:
+                    cancel_events[n].set()
+                    for mailbox in sorted(pending):
+                        if owner[mailbox] == n:
+                            print(f"Fetching {mailbox} made no progress for {timeout}s, leaving it for the next fetch")
+                            merged["errors"][mailbox] = f"No progress for {timeout}s."
+                            pending.discard(mailbox)
+                continue
+            if mailbox not in pending:
+                # From an account given up on; its stragglers don't count
+                continue
+            pending.discard(mailbox)
+            if isinstance(result, Exception):
+                print(f"Fetching {mailbox} failed: {result}")
+                merged["errors"][mailbox] = str(result)
+                continue
+            merged["transactions"].extend(result["transactions"])
+            merged["sync_markers"].extend(result["sync_markers"])
+            merged["total"] += result["total"]
+    metrics.count("mailbox_errors", len(merged["errors"]))
+    merged["transactions"].sort(key=transaction_sort_key)
+    merged["transactions"] = drop_copied_messages(merged["transactions"])
+
+    if len(merged["errors"]) == len(mailboxes):
+        if own_metrics:
+            metrics.finish(error="every mailbox failed")
+        if len(mailboxes) == 1:
+            raise FetchError(next(iter(merged["errors"].values())))
+        raise FetchError("Every mailbox failed:\n" + "\n".join(
+            f"{mailbox}: {message}" for mailbox, message in merged["errors"].items()
+        ))
+    if own_metrics:
+        merged["metrics"] = metrics.finish()
+    return merged
+
+def watch_mailbox(since_date, on_batch, stop_event, pool=None, after_uid=None, account=None, folder=None):
+    """
+    Long-running watch of one mailbox, `account`'s `folder` (by default the
+    pool's account and its first folder): catch up on everything since
+    `since_date`, then keep one session in IDLE and fetch only the new UIDs
+    each time the server reports mail. `on_batch` gets every
+    ingest_transactions result (including empty ones, whose markers the
+    caller should commit once nothing before them is pending). `after_uid`
+    skips UIDs the caller already holds. Reconnects after connection errors
+    and returns when `stop_event` is set.
+    """
+    account = account or (pool.account if pool else default_account())
+    folder = folder or account.folders[0]
+    seen_uid = after_uid
+    mail = None
+    new_mail = True
+    while not stop_event.is_set():
+        try:
+            if mail is None:
+                mail = connect_gmail(account, folder)
+                if mail is None:
+                    raise FetchError(f"Failed to open {mailbox_key(account.user, folder)}.")
+                # Anything that arrived while disconnected
+                new_mail = True
+            if new_mail:
+                result = ingest_transactions(since_date, pool=pool, after_uid=seen_uid,
+                                             account=account, folder=folder)
+                for marker in result["sync_markers"]:
+                    seen_uid = marker["last_uid"]
+                on_batch(result)
+            new_mail = idle_until_new_mail(mail, stop_event)
+        except (FetchError, imaplib.IMAP4.error, OSError) as e:
+            print(f"Watch: {e}; reconnecting in {WATCH_RECONNECT_SECONDS}s")
+            if mail is not None:
+                try:
+                    mail.logout()
+                except Exception:
+                    pass
+                mail = None
+            stop_event.wait(WATCH_RECONNECT_SECONDS)
 
-            for i in range(len(self.transactions)):
-                self.category_choices[i] = chosen_cat
-                values = list(self.tree.item(i, "values"))
-                values[-1] = chosen_cat
-                self.tree.item(i, values=values)
-        finally:
-            self.set_button_normal(self.apply_all_btn, "Apply to All")
+    if mail is not None:
+        try:
+            mail.logout()
+        except Exception:
+            pass
 
-    def set_button_processing(self, btn, label="Processing..."):
-        btn.config(text=label, state="disabled")
+def watch_mailboxes(since_date, on_batch, stop_event, accounts=None, after_uids=None):
+    """
+    watch_mailbox on every folder of every account (load_accounts() by
+    default) at once, each with its own IDLE session, so a mailbox that is
+    down or slow only delays its own batches. `on_batch` is called from
+    several threads; `after_uids` maps mailbox keys to after_uid. Returns
+    when `stop_event` is set and every watcher has stopped.
+    """
+    accounts = accounts or load_accounts()
+    after_uids = after_uids or {}
+    watchers = []
+    for account in accounts:
+        for folder in account.folders:
+            watcher = threading.Thread(
+                target=watch_mailbox,
+                args=(since_date, on_batch, stop_event, get_connection_pool(account),
+                      after_uids.get(mailbox_key(account.user, folder)), account, folder),
+                daemon=True
+            )
+            watcher.start()
+            watchers.append(watcher)
+    # join() with a timeout, so KeyboardInterrupt still reaches the main thread
+    while any(watcher.is_alive() for watcher in watchers):
+        for watcher in watchers:
+            watcher.join(0.5)
 
-    def set_button_normal(self, btn, original_text):
-        btn.config(text=original_text, state="normal")
+# ========================
+# EXCEL UPDATE FUNCTION
+# ========================
 
-    # ---------- Fetch (Threaded) ----------
-    def fetch_transactions_in_thread(self):
-        mail = connect_gmail()
-        if not mail:
-            self.after(0, lambda: messagebox.showerror("Error", "Failed to connect to Gmail. Check credentials."))
-            self.after(0, self.fetch_done)
-            return
+_SAFE_BINOPS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: lambda a, b: a / b,
+}
+_SAFE_UNARYOPS = {
+    ast.UAdd: lambda a: a,
+    ast.USub: lambda a: -a,
+}
 
-        # parse user date
-        selected_date_str = self.since_date_var.get().strip()
+def safe_eval_arithmetic(expr):
+    """
+    Evaluate a plain arithmetic formula body like "1200 + 45.5 - 20".
+    Numbers, + - * / and brackets only; anything else (cell references,
+    functions, names) raises ValueError.
+    """
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return node.value
+        if isinstance(node, ast.BinOp) and type(node.op) in _SAFE_BINOPS:
+            return _SAFE_BINOPS[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _SAFE_UNARYOPS:
+            return _SAFE_UNARYOPS[type(node.op)](evaluate(node.operand))
+        raise ValueError(f"Unsupported element in formula: {ast.dump(node)}")
+
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Not an arithmetic formula: {expr!r}") from e
+    try:
+        return float(evaluate(tree))
+    except ArithmeticError as e:
+        raise ValueError(f"Cannot evaluate formula {expr!r}: {e}") from e
+
+def compact_formula(formula, max_terms=FORMULA_MAX_TERMS, keep_terms=FORMULA_KEEP_TERMS):
+    """
+    Keep an "=a + b + c ..." cell from growing forever: once it has more than
+    `max_terms` top-level terms, fold all plain numbers except the latest
+    `keep_terms` into one exact base value. Formulas that aren't simple
+    sums come back untouched, and so does any result that wouldn't
+    evaluate to the same value.
+    """
+    body = formula[1:].strip()
+    try:
+        node = ast.parse(body, mode="eval").body
+        value = safe_eval_arithmetic(body)
+    except (ValueError, SyntaxError):
+        return formula
+
+    terms = []
+    while isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+        terms.append(("+" if isinstance(node.op, ast.Add) else "-", node.right))
+        node = node.left
+    terms.append(("+", node))
+    terms.reverse()
+    if len(terms) <= max_terms:
+        return formula
+
+    def source(term):
+        # The segment leaves out any brackets around the term; "- (20 + 5)" needs them back
+        text = ast.get_source_segment(body, term)
+        return text if isinstance(term, ast.Constant) else f"({text})"
+
+    old_terms, recent_terms = terms[:-keep_terms], terms[-keep_terms:]
+    base = Decimal(0)
+    kept = []
+    for sign, term in old_terms:
+        if isinstance(term, ast.Constant):
+            text = ast.get_source_segment(body, term)
+            base += Decimal(text) if sign == "+" else -Decimal(text)
+        else:
+            kept.append((sign, source(term)))
+
+    parts = [format(base.normalize(), "f")]
+    for sign, text in kept + [(sign, source(term)) for sign, term in recent_terms]:
+        parts.append(f" {sign} {text}")
+    compacted = "=" + "".join(parts)
+    # Only float rounding may differ between the two, never the amount
+    if abs(safe_eval_arithmetic(compacted[1:]) - value) > 1e-6 * max(1.0, abs(value)):
+        print(f"Warning: not compacting {formula!r}, it would change the value")
+        return formula
+    return compacted
+
+_sheet_index_cache = {}
+
+def build_sheet_index(ws_main, ws_daily):
+    """
+    Map out where update_excel writes: month name -> column and day -> row
+    in the daily sheet, category -> row in the main sheet. First match wins,
+    like the cell-by-cell scans this replaces.
+    """
+    return dict(_daily_sheet_index(ws_daily), category_rows=_month_sheet_index(ws_main))
+
+def _daily_sheet_index(ws_daily):
+    month_cols = {}
+    for col, value in enumerate(next(ws_daily.iter_rows(min_row=2, max_row=2, values_only=True), ())[1:], start=2):
+        if value is not None:
+            month_cols.setdefault(value, col)
+
+    day_rows = {}
+    for row_idx, (value,) in enumerate(ws_daily.iter_rows(min_row=3, max_col=1, values_only=True), start=3):
+        if isinstance(value, (int, float)):
+            day_rows.setdefault(value, row_idx)
+    return {"month_cols": month_cols, "day_rows": day_rows}
+
+def _month_sheet_index(ws_main):
+    category_rows = {}
+    for row_idx, (value,) in enumerate(ws_main.iter_rows(min_row=1, max_col=1, values_only=True), start=1):
+        if value is not None:
+            category_rows.setdefault(value, row_idx)
+    return category_rows
+
+def get_sheet_index(excel_file, ws_main, ws_daily):
+    """build_sheet_index, reused for as long as the workbook file is unchanged on disk."""
+    key = (os.path.abspath(excel_file), ws_main.title, ws_daily.title)
+    try:
+        mtime = os.path.getmtime(excel_file)
+    except OSError:
+        mtime = None
+    cached = _sheet_index_cache.get(key)
+    if cached and mtime is not None and cached[0] == mtime:
+        return cached[1]
+    index = build_sheet_index(ws_main, ws_daily)
+    _sheet_index_cache[key] = (mtime, index)
+    return index
+
+def refresh_sheet_index_mtime(excel_file, ws_main, ws_daily):
+    """After our own save the layout is unchanged, so keep the index valid for the new mtime."""
+    key = (os.path.abspath(excel_file), ws_main.title, ws_daily.title)
+    if key in _sheet_index_cache:
         try:
-            selected_date = datetime.datetime.strptime(selected_date_str, "%d-%m-%Y").date()
-        except ValueError:
-            selected_date = datetime.date.today()
+            _sheet_index_cache[key] = (os.path.getmtime(excel_file), _sheet_index_cache[key][1])
+        except OSError:
+            _sheet_index_cache.pop(key, None)
+
+def save_workbook_atomically(wb, excel_file, cancel_event=None):
+    """
+    Save to a temporary file next to `excel_file` and swap it into place, so
+    a crash or cancel never leaves a half-written workbook behind.
+    Returns False (and leaves the original untouched) if cancelled.
+    """
+    folder, name = os.path.split(os.path.abspath(excel_file))
+    tmp_file = os.path.join(folder, f"~upix-{os.getpid()}-{name}")
+    try:
+        wb.save(tmp_file)
+        if cancel_event is not None and cancel_event.is_set():
+            os.remove(tmp_file)
+            return False
+        os.replace(tmp_file, excel_file)
+        return True
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+class PartitionError(Exception):
+    pass
+
+def partition_for(when, excel_file, sheet_name):
+    """
+    (workbook file, month sheet, daily sheet) a transaction dated `when`
+    books into. A fixed `sheet_name` keeps every month in that one sheet.
+    """
+    daily_sheet = when.strftime(DAILY_SHEET_FORMAT)
+    if sheet_name != AUTO_SHEET:
+        return excel_file, sheet_name, daily_sheet
+    month_sheet = when.strftime(MONTH_SHEET_FORMAT)
+    if os.path.isdir(excel_file):
+        return os.path.join(excel_file, f"{month_sheet}.xlsx"), month_sheet, daily_sheet
+    return excel_file, month_sheet, daily_sheet
+
+def _parse_title(title, title_format):
+    try:
+        return datetime.datetime.strptime(title, title_format)
+    except ValueError:
+        return None
+
+def partition_files(folder):
+    """The month workbooks in `folder`, as {first of the month: path}."""
+    months = {}
+    for name in os.listdir(folder):
+        stem, ext = os.path.splitext(name)
+        month = _parse_title(stem, MONTH_SHEET_FORMAT)
+        if month and ext.lower() == ".xlsx" and not name.startswith("~"):
+            months[month] = os.path.join(folder, name)
+    return months
+
+def _nearest(candidates, when):
+    """From {datetime: value}, the latest one before `when`, else the earliest after it."""
+    earlier = [key for key in candidates if key < when]
+    if earlier:
+        return candidates[max(earlier)]
+    return candidates[min(candidates)] if candidates else None
+
+_SHEET_REF_RE = re.compile(
+    r"(?:'((?:[^']|'')+)'|([A-Za-z_][\w.]*))!(\$?)([A-Z]{1,3})(\$?\d+)(?::(\$?)([A-Z]{1,3})(\$?\d+))?"
+)
+
+def _retarget_daily_refs(ws, old_daily, new_daily, columns):
+    """Point formulas that read `old_daily` at `new_daily`, moving its columns through `columns`."""
+    quoted = "'" + new_daily.replace("'", "''") + "'"
+    def retarget(match):
+        name = match.group(1).replace("''", "'") if match.group(1) else match.group(2)
+        if name != old_daily:
+            return match.group(0)
+        ref = f"{quoted}!{match.group(3)}{columns.get(match.group(4), match.group(4))}{match.group(5)}"
+        if match.group(7):
+            ref += f":{match.group(6)}{columns.get(match.group(7), match.group(7))}{match.group(8)}"
+        return ref
+
+    for row in ws.iter_rows():
+        for cell in row:
+            if isinstance(cell.value, str) and cell.value.startswith("=") and "!" in cell.value:
+                cell.value = _SHEET_REF_RE.sub(retarget, cell.value)
+
+def _is_booked_value(value):
+    """Numbers and same-sheet arithmetic, i.e. what update_excel leaves in a cell."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return True
+    return isinstance(value, str) and value.startswith("=") and "!" not in value
+
+def _clear_month_sheet(ws_main):
+    """Empty the category cells update_excel books into (Food reads the daily sheet, so it stays)."""
+    categories = set(EXPENSE_CATEGORIES.values()) - {"Food", "Skip"}
+    for category, row_idx in _month_sheet_index(ws_main).items():
+        cell = ws_main.cell(row=row_idx, column=3)
+        if category in categories and _is_booked_value(cell.value):
+            cell.value = None
+
+def _clear_daily_sheet(ws_daily):
+    """Empty every day of every month in the daily sheet."""
+    index = _daily_sheet_index(ws_daily)
+    for row_idx in index["day_rows"].values():
+        for col_idx in index["month_cols"].values():
+            cell = ws_daily.cell(row=row_idx, column=col_idx)
+            if _is_booked_value(cell.value):
+                cell.value = None
+
+def _adopt_template(ws_main, ws_daily, old_daily, template_month, month_sheet, clear_main):
+    """
+    Turn a copy of a month sheet into `month_sheet`: its formulas follow the
+    daily sheet to `ws_daily`, and from the template month's column there to
+    this month's. With `clear_main` last month's bookings are emptied too.
+    """
+    from openpyxl.utils import get_column_letter
+
+    columns = {}
+    month = _parse_title(month_sheet, MONTH_SHEET_FORMAT)
+    if template_month and month:
+        month_cols = _daily_sheet_index(ws_daily)["month_cols"]
+        old_col = month_cols.get(template_month.strftime("%B"))
+        new_col = month_cols.get(month.strftime("%B"))
+        if old_col and new_col:
+            columns[get_column_letter(old_col)] = get_column_letter(new_col)
+    ws_main.title = month_sheet
+    _retarget_daily_refs(ws_main, old_daily, ws_daily.title, columns)
+    if clear_main:
+        _clear_month_sheet(ws_main)
+
+def new_partition_workbook(excel_file, month_sheet, daily_sheet):
+    """
+    A workbook for a month that has none yet, made from EXCEL_TEMPLATE_FILE
+    or else a copy of the nearest month's workbook with its bookings
+    emptied. Only the month and daily sheets are kept. Not saved here.
+    """
+    template_file = EXCEL_TEMPLATE_FILE if os.path.exists(EXCEL_TEMPLATE_FILE) else None
+    from_month = template_file is None
+    if from_month:
+        template_file = _nearest(partition_files(os.path.dirname(excel_file)),
+                                 _parse_title(month_sheet, MONTH_SHEET_FORMAT))
+        if template_file is None:
+            raise PartitionError(f"No workbook for '{month_sheet}' and no template to make one from:\n"
+                                 f"{EXCEL_TEMPLATE_FILE}")
+
+    wb = load_workbook(template_file)
+    ws_daily = next((ws for ws in wb if _parse_title(ws.title, DAILY_SHEET_FORMAT)), None)
+    ws_main = next((ws for ws in wb if _parse_title(ws.title, MONTH_SHEET_FORMAT)), None)
+    if ws_main is None:
+        ws_main = next((ws for ws in wb if ws is not ws_daily), None)
+    if ws_main is None or ws_daily is None:
+        wb.close()
+        raise PartitionError(f"Template needs a month sheet and a daily sheet:\n{template_file}")
+    for ws in list(wb):
+        if ws is not ws_main and ws is not ws_daily:
+            wb.remove(ws)
+
+    old_daily = ws_daily.title
+    ws_daily.title = daily_sheet
+    if from_month:
+        _clear_daily_sheet(ws_daily)
+    _adopt_template(ws_main, ws_daily, old_daily, _parse_title(ws_main.title, MONTH_SHEET_FORMAT),
+                    month_sheet, clear_main=from_month)
+    return wb
+
+def ensure_partition_sheets(wb, month_sheet, daily_sheet):
+    """
+    Add `daily_sheet` and `month_sheet` to `wb` if missing, each copied from
+    the nearest sheet of its kind with the copied bookings emptied.
+    Returns the titles of the sheets added.
+    """
+    added = []
+    if daily_sheet not in wb.sheetnames:
+        dailies = {}
+        for ws in wb:
+            year = _parse_title(ws.title, DAILY_SHEET_FORMAT)
+            if year:
+                dailies[year] = ws
+        template = _nearest(dailies, datetime.datetime.strptime(daily_sheet, DAILY_SHEET_FORMAT))
+        if template is None:
+            raise PartitionError(f"Sheet '{daily_sheet}' not found, and no daily sheet to copy it from.")
+        ws_daily = wb.copy_worksheet(template)
+        ws_daily.title = daily_sheet
+        _clear_daily_sheet(ws_daily)
+        added.append(daily_sheet)
+
+    if month_sheet not in wb.sheetnames:
+        months = {}
+        for ws in wb:
+            month = _parse_title(ws.title, MONTH_SHEET_FORMAT)
+            if month:
+                months[month] = ws
+        template = _nearest(months, _parse_title(month_sheet, MONTH_SHEET_FORMAT))
+        if template is None:
+            raise PartitionError(f"Sheet '{month_sheet}' not found, and no month sheet to copy it from.")
+        template_month = _parse_title(template.title, MONTH_SHEET_FORMAT)
+        ws_main = wb.copy_worksheet(template)
+        _adopt_template(ws_main, wb[daily_sheet], template_month.strftime(DAILY_SHEET_FORMAT),
+                        template_month, month_sheet, clear_main=True)
+        added.append(month_sheet)
+    return added
+
+def update_excel(transactions, category_choices, excel_file, sheet_name, sync_markers=None,
+                 on_progress=None, cancel_event=None, metrics=None):
+    """
+    Book the categorized transactions into the workbook. `transactions` is
+    a TransactionBatch (whose categories are set to `category_choices`) or
+    any list of transactions. With `sheet_name` AUTO_SHEET each one goes to
+    the partition for its date (see partition_for); only the workbooks
+    touched are loaded and saved.
+
+    Safe to run off the Tk thread: nothing here touches the UI. Progress is
+    reported as a percentage through `on_progress`, and setting
+    `cancel_event` abandons the update without writing anything. Returns a
+    dict with "status" ("ok", "duplicate", "error" or "cancelled") plus a
+    "title" and "message" for the user. Every run, booked or not, goes to
+    the run journal. Timings go to `metrics`, which the caller then
+    finishes; without one the run reports itself under "metrics".
+    """
+    own_metrics = metrics is None
+    metrics = metrics or RunMetrics("update")
+    record = {"kind": "update", "excel": excel_file, "sheet": sheet_name}
+    try:
+        result = _update_excel(transactions, category_choices, excel_file, sheet_name, sync_markers,
+                               on_progress, cancel_event, metrics)
+    except Exception as e:
+        journal_run(dict(record, status="error", message=f"{type(e).__name__}: {e}"))
+        if own_metrics:
+            metrics.finish(status="error", error=f"{type(e).__name__}: {e}")
+        raise
+
+    record["status"] = result["status"]
+    for field in ("total_upi", "added", "skipped", "category_sums", "workbooks", "created", "sheets",
+                  "last_processed", "entries"):
+        if field in result:
+            record[field] = result[field]
+    if result["status"] in ("error", "cancelled"):
+        record["message"] = result["message"]
+    with metrics.stage("journal_write"):
+        journal_run(record)
+    result.pop("entries", None)
+    if own_metrics:
+        result["metrics"] = metrics.finish(status=result["status"])
+    return result
+
+def _update_excel(transactions, category_choices, excel_file, sheet_name, sync_markers,
+                  on_progress, cancel_event, metrics):
+    from datetime import datetime
+
+    on_progress = on_progress or (lambda percent: None)
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+    cancelled_result = {
+        "status": "cancelled",
+        "title": "Cancelled",
+        "message": "Excel update cancelled. The workbook was not changed."
+    }
+
+    batch = transactions if isinstance(transactions, TransactionBatch) else TransactionBatch(transactions)
+    amounts, dates, party_names = batch.amounts, batch.dates, batch.party_names
+    total_upi_amount = round(batch.total(), 2)
+    journal_entries = []
+
+    # Drop transactions the ledger says are already in a workbook
+    metrics.count("transactions", len(batch))
+    txn_keys = ledger_keys(batch)
+    try:
+        with metrics.stage("ledger_read"):
+            already_booked = ledger_booked(txn_keys)
+    except sqlite3.Error as e:
+        return {"status": "error", "title": "Error", "message": f"Could not read the booking ledger:\n{e}"}
+
+    to_book = [
+        i for i in range(len(batch))
+        if category_choices[i] and category_choices[i] != "Skip"
+    ]
+    if to_book and all(txn_keys[i] in already_booked for i in to_book):
+        msg = (f"Expenses for this set of transactions appear to be already logged. "
+               f"(Mail total: Rs.{total_upi_amount:.2f})")
+        commit_sync_markers(sync_markers)
+        return {"status": "duplicate", "title": "Skipped", "message": msg, "total_upi": total_upi_amount}
+
+    on_progress(5)
+
+    # Route each transaction to its partition by date. Workbooks and sheets
+    # are only loaded (or made from a template) once a transaction needs them.
+    auto = sheet_name == AUTO_SHEET
+    workbooks = {}
+    partitions = {}
+    created = []
+
+    def close_workbooks():
+        for wb in workbooks.values():
+            wb.close()
+
+    opening_seconds = 0.0
+
+    def open_partition(when):
+        nonlocal opening_seconds
+        key = partition_for(when, excel_file, sheet_name)
+        if key not in partitions:
+            started = time.perf_counter()
+            part_file, month_sheet, daily_sheet = key
+            wb = workbooks.get(part_file)
+            if wb is None:
+                if os.path.exists(part_file) or not (auto and os.path.isdir(excel_file)):
+                    with metrics.stage("workbook_load"):
+                        wb = load_workbook(part_file)
+                    metrics.count("workbooks_loaded")
+                else:
+                    with metrics.stage("workbook_create"):
+                        wb = new_partition_workbook(part_file, month_sheet, daily_sheet)
+                    metrics.count("workbooks_created")
+                    created.append(os.path.basename(part_file))
+                workbooks[part_file] = wb
+            if not auto and month_sheet not in wb.sheetnames:
+                raise KeyError(month_sheet)
+            with metrics.stage("sheet_create"):
+                added = ensure_partition_sheets(wb, month_sheet, daily_sheet)
+            created.extend(f"'{title}' in {os.path.basename(part_file)}" for title in added)
+            ws_main, ws_daily = wb[month_sheet], wb[daily_sheet]
+            ws_main["O1"].value = datetime.now().strftime("%d-%b-%Y %I:%M%p")
+            with metrics.stage("sheet_index"):
+                partitions[key] = (ws_main, ws_daily, get_sheet_index(part_file, ws_main, ws_daily))
+            opening_seconds += time.perf_counter() - started
+        return key
+
+    total_amount_skipped = 0
+    booked_rows = []
+    settled_rows = []   # chosen as Skip, or already in a workbook: their category is final too
+    booked_files = {}
+
+    # First reduce the batch to the amounts going into each target cell...
+    cell_amounts = {}
+    route_started = time.perf_counter()
+    for i in range(len(batch)):
+        if i % 200 == 0:
+            on_progress(5 + 65 * i // len(batch))
+            if cancelled():
+                close_workbooks()
+                return cancelled_result
 
-        self.since_date_str = selected_date.strftime("%d-%b-%Y")
+        chosen_cat = category_choices[i] if category_choices[i] else "Skip"
+        amount = amounts[i]
+
+        if chosen_cat == "Skip":
+            total_amount_skipped += amount
+            if category_choices[i]:
+                settled_rows.append(i)
+            journal_entries.append({"event": "skipped", "reason": "skip", "amount": amount, "party": party_names[i]})
+            continue
 
-        search_query = f'(FROM "alerts@hdfcbank.net" SINCE "{self.since_date_str}")'
+        if txn_keys[i] in already_booked:
+            total_amount_skipped += amount
+            settled_rows.append(i)
+            journal_entries.append({"event": "skipped", "reason": "booked", "amount": amount, "party": party_names[i]})
+            continue
+
+        date_str = dates[i]
         try:
-            result, data = mail.search(None, search_query)
-        except Exception as e:
-            self.after(0, lambda: messagebox.showerror("Error", f"Error searching mailbox:\n{e}"))
-            self.after(0, lambda: self.fetch_done(mail))
-            return
+            day = int(date_str.split("-")[0])
+            date_obj = datetime.strptime(date_str, "%d-%m-%y")
+            month_name = date_obj.strftime("%B")
+        except:
+            if chosen_cat == "Food":
+                total_amount_skipped += amount
+                journal_entries.append({"event": "skipped", "reason": "bad_date", "amount": amount, "date": date_str})
+                continue
+            date_obj = batch.email_datetime(i) or datetime.now()
 
-        if result != "OK":
-            self.after(0, lambda: messagebox.showerror("Error", "Failed to search emails."))
-            self.after(0, lambda: self.fetch_done(mail))
-            return
+        try:
+            key = open_partition(date_obj)
+        except FileNotFoundError as e:
+            close_workbooks()
+            return {"status": "error", "title": "Error", "message": f"Excel file not found:\n{e.filename}"}
+        except KeyError as e:
+            close_workbooks()
+            return {"status": "error", "title": "Error", "message": f"Sheet {e} not found in workbook."}
+        except PartitionError as e:
+            close_workbooks()
+            return {"status": "error", "title": "Error", "message": str(e)}
+        ws_main, ws_daily, sheet_index = partitions[key]
 
-        email_ids = data[0].split()
-        self.total_emails = len(email_ids)
-        self.after(0, lambda: self.progress_bar.config(maximum=self.total_emails, value=0))
+        if chosen_cat == "Food":
+            month_col = sheet_index["month_cols"].get(month_name)
+            if not month_col:
+                total_amount_skipped += amount
+                journal_entries.append({
+                    "event": "skipped", "reason": "no_month", "amount": amount, "month": month_name,
+                    "sheet": ws_daily.title
+                })
+                continue
 
-        if not email_ids:
-            self.after(0, lambda: self.fetch_done(mail, no_emails=True))
-            return
+            day_row = sheet_index["day_rows"].get(day)
+            if not day_row:
+                total_amount_skipped += amount
+                journal_entries.append({
+                    "event": "skipped", "reason": "no_day", "amount": amount, "day": day, "sheet": ws_daily.title
+                })
+                continue
 
-        last_processed = get_last_processed_time()
-        upi_pattern = r"Rs\.\s?(\d+\.\d{2})\s?has been debited .*? to VPA (\S+)\s(.+?) on (\d{2}-\d{2}-\d{2})"
+            target = (ws_daily, day_row, month_col)
+        else:
+            # Non-Food
+            category_row = sheet_index["category_rows"].get(chosen_cat)
+            if category_row is None:
+                total_amount_skipped += amount
+                journal_entries.append({
+                    "event": "skipped", "reason": "no_category", "amount": amount, "category": chosen_cat,
+                    "sheet": ws_main.title
+                })
+                continue
 
-        self.processed_emails = 0
+            target = (ws_main, category_row, 3)
+
+        cell_amounts.setdefault(target, (chosen_cat, []))[1].append(amount)
+        booked_rows.append(i)
+        booked_files.setdefault(key[0], []).append(i)
+        # A copy of this row later in the batch is then skipped as booked
+        already_booked.add(txn_keys[i])
+    metrics.add("route", time.perf_counter() - route_started - opening_seconds)
+    metrics.count("booked", len(booked_rows))
+
+    batch.set_categories(category_choices)
+    category_sums = batch.sums_by_category(booked_rows)
+    total_amount_added = sum(category_sums.values())
+    dated = [i for i in booked_rows if batch.stamps[i] == batch.stamps[i]]
+    max_email_datetime = batch.email_datetime(max(dated, key=batch.stamps.__getitem__)) if dated else None
+    # Each mailbox's sync state only moves up to its own newest booked mail
+    newest_by_mailbox = {}
+    for i in dated:
+        newest = newest_by_mailbox.get(batch.mailboxes[i])
+        if newest is None or batch.stamps[i] > batch.stamps[newest]:
+            newest_by_mailbox[batch.mailboxes[i]] = i
+    month_sheets = {ws_main.title for ws_main, _, _ in partitions.values()}
+
+    # ...then touch each of those cells exactly once
+    write_started = time.perf_counter()
+    for (ws, row_idx, col_idx), (chosen_cat, amounts) in cell_amounts.items():
+        cell = ws.cell(row=row_idx, column=col_idx)
+        batch_total = sum(amounts)
 
-        for e_id in email_ids:
+        if chosen_cat == "Food":
+            prev_food_exp = float(cell.value or 0)
+            new_food_exp = prev_food_exp
+            for amount in amounts:
+                new_food_exp += amount
+            cell.value = new_food_exp
+            journal_entries.append({
+                "event": "booked", "sheet": ws.title, "category": chosen_cat, "count": len(amounts),
+                "prev": round(prev_food_exp, 2), "added": round(batch_total, 2), "new": round(new_food_exp, 2)
+            })
+            continue
+
+        cell_value = cell.value
+        prev_balance = 0.0
+
+        if isinstance(cell_value, str) and cell_value.startswith("="):
+            updated_formula = cell_value + "".join(f" + {amount}" for amount in amounts)
+            if FORMULA_COMPACTION:
+                updated_formula = compact_formula(updated_formula)
+            cell.value = updated_formula
+            try:
+                prev_str = cell_value[1:].strip()
+                prev_balance = safe_eval_arithmetic(prev_str)
+            except ValueError:
+                prev_balance = 0.0
+            new_balance = prev_balance
+            for amount in amounts:
+                new_balance += amount
+        else:
+            prev_balance = float(cell_value) if isinstance(cell_value, (int, float)) else 0.0
+            new_balance = prev_balance
+            for amount in amounts:
+                new_balance += amount
+            cell.value = new_balance
+
+        journal_entries.append({
+            "event": "booked", "sheet": ws.title, "category": chosen_cat, "count": len(amounts),
+            "prev": round(prev_balance, 2), "added": round(batch_total, 2), "new": round(new_balance, 2)
+        })
+
+    journal_entries[:0] = [{"event": "created", "name": name} for name in created]
+    metrics.add("write_cells", time.perf_counter() - write_started)
+    metrics.count("cells_written", len(cell_amounts))
+
+    on_progress(75)
+    if cancelled():
+        close_workbooks()
+        return cancelled_result
+
+    # Save each touched workbook. Once the first is on disk there's no going
+    # back, so later ones ignore cancel, and a failed save still records
+    # what the earlier ones booked.
+    saved_files = []
+    try:
+        for part_file, wb in workbooks.items():
+            with metrics.stage("workbook_save"):
+                saved = save_workbook_atomically(wb, part_file, None if saved_files else cancel_event)
+            if not saved:
+                return cancelled_result
+            saved_files.append(part_file)
+            metrics.count("workbooks_saved")
+    except Exception as e:
+        message = f"Could not save the workbook:\n{e}"
+        if saved_files:
             try:
-                _, msg_data = mail.fetch(e_id, "(RFC822)")
-                raw_email = msg_data[0][1]
-                msg = email.message_from_bytes(raw_email)
+                ledger_record([txn_keys[i] for part_file in saved_files for i in booked_files.get(part_file, ())])
+            except sqlite3.Error as ledger_error:
+                print(f"Warning: could not record booked transactions in the ledger: {ledger_error}")
+            message += "\n\nAlready saved:\n" + "\n".join(saved_files)
+        return {"status": "error", "title": "Error", "message": message}
+    finally:
+        close_workbooks()
+    for (part_file, _, _), (ws_main, ws_daily, _) in partitions.items():
+        refresh_sheet_index_mtime(part_file, ws_main, ws_daily)
+    booked_keys = [txn_keys[i] for i in booked_rows]
+    on_progress(95)
+
+    try:
+        with metrics.stage("ledger_write"):
+            ledger_record(booked_keys)
+    except sqlite3.Error as e:
+        print(f"Warning: could not record booked transactions in the ledger: {e}")
+    with metrics.stage("learn_categories"):
+        # Rows skipped for a missing sheet, column or date keep no category,
+        # so the cache (and the report built on it) never counts them as booked
+        written = booked_rows + settled_rows
+        cache_set_categories([batch[i] for i in written], [category_choices[i] for i in written])
+        learn_categories([batch[i] for i in booked_rows], [category_choices[i] for i in booked_rows])
+
+    summary_msg = (
+        f"Total UPI from Mail: Rs.{total_upi_amount:.2f}\n"
+        f"Total Added: Rs.{total_amount_added:.2f}\n"
+        f"Total Skipped: Rs.{total_amount_skipped:.2f}\n"
+    )
+
+    commit_sync_markers(sync_markers, {
+        mailbox: batch.email_datetime(i) for mailbox, i in newest_by_mailbox.items()
+    })
+    on_progress(100)
+
+    return {
+        "status": "ok",
+        "title": "Summary",
+        "message": summary_msg,
+        "total_upi": total_upi_amount,
+        "added": total_amount_added,
+        "skipped": total_amount_skipped,
+        "category_sums": category_sums,
+        "workbooks": saved_files,
+        "created": created,
+        "sheets": sorted(month_sheets),
+        "last_processed": max_email_datetime,
+        "entries": journal_entries
+    }
+
+# =========================
+# STATEMENT IMPORT
+# =========================
+
+class StatementError(Exception):
+    pass
+
+# Column headers as Indian banks spell them, lower-cased with everything but
+# letters (and a trailing "inr") dropped, e.g. "Withdrawal Amt." -> "withdrawalamt"
+STATEMENT_COLUMNS = {
+    "date": ("date", "txndate", "transactiondate", "trandate", "postingdate"),
+    "narration": ("narration", "description", "particulars", "transactionremarks", "remarks", "details"),
+    "reference": ("chqrefno", "chqrefnumber", "refnochequeno", "refno", "chequeno", "reference", "utr"),
+    "debit": ("withdrawalamt", "withdrawalamount", "withdrawal", "withdrawals", "debitamount", "debit", "dr"),
+    "amount": ("amount", "transactionamount"),
+    "type": ("drcr", "crdr", "type"),
+}
+
+STATEMENT_DATE_FORMATS = ("%d/%m/%y", "%d/%m/%Y", "%d-%m-%y", "%d-%m-%Y", "%d-%b-%y", "%d-%b-%Y",
+                          "%d %b %y", "%d %b %Y", "%d.%m.%y", "%d.%m.%Y", "%Y-%m-%d")
 
-                msg_date_hdr = msg["Date"]
+def _csv_rows(path):
+    with open(path, newline="", encoding="utf-8-sig", errors="replace") as f:
+        sample = f.read(8192)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.reader(f, dialect)
+
+def _xlsx_rows(path):
+    try:
+        wb = load_workbook(path, read_only=True, data_only=True)
+    except Exception as e:
+        raise StatementError(f"Could not open {os.path.basename(path)}: {e}")
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+def _xls_rows(path):
+    """Old-style .xls through xlrd, which holds the sheet in memory while it's read."""
+    try:
+        import xlrd
+    except ImportError as e:
+        raise StatementError("Reading .xls statements needs xlrd (pip install xlrd); "
+                             "or save the statement as .xlsx or .csv.") from e
+    try:
+        book = xlrd.open_workbook(path, on_demand=True)
+    except Exception as e:
+        raise StatementError(f"Could not open {os.path.basename(path)}: {e}")
+    try:
+        sheet = book.sheet_by_index(0)
+        for r in range(sheet.nrows):
+            yield [
+                xlrd.xldate_as_datetime(cell.value, book.datemode) if cell.ctype == xlrd.XL_CELL_DATE else cell.value
+                for cell in sheet.row(r)
+            ]
+    finally:
+        book.release_resources()
+
+_STATEMENT_READERS = {".csv": _csv_rows, ".txt": _csv_rows, ".xlsx": _xlsx_rows, ".xlsm": _xlsx_rows, ".xls": _xls_rows}
+
+def iter_statement_rows(path):
+    """Every row of the first sheet of a CSV, XLSX or XLS statement, lazily."""
+    reader = _STATEMENT_READERS.get(os.path.splitext(path)[1].lower())
+    if reader is None:
+        raise StatementError(f"Unsupported statement format: {os.path.basename(path)} (use .csv, .xlsx or .xls)")
+    if not os.path.isfile(path):
+        raise StatementError(f"Statement not found: {path}")
+    return reader(path)
+
+def _column_key(value):
+    key = re.sub(r"[^a-z]", "", str(value or "").lower())
+    return key[:-3] if key.endswith("inr") and len(key) > 3 else key
+
+def statement_columns(row):
+    """{field: column index} if `row` is a statement's column header, else None."""
+    keys = [_column_key(cell) for cell in row]
+    columns = {}
+    for field, names in STATEMENT_COLUMNS.items():
+        for name in names:
+            if name in keys:
+                columns[field] = keys.index(name)
+                break
+    if "date" in columns and "narration" in columns and ("debit" in columns or "amount" in columns):
+        return columns
+    return None
+
+_statement_dates = {}
+
+def _statement_date(value):
+    """A date cell as a date, or None for blank lines, banners and footers."""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if not isinstance(value, str):
+        return None
+    text = value.strip()
+    if text not in _statement_dates:
+        parsed = None
+        for candidate in dict.fromkeys((text, text.split(" ")[0])):
+            for fmt in STATEMENT_DATE_FORMATS:
                 try:
-                    msg_datetime = parsedate_to_datetime(msg_date_hdr)
-                except:
-                    msg_datetime = None
-
-                # skip if <= last_processed
-                if last_processed and msg_datetime and msg_datetime <= last_processed:
-                    self.processed_emails += 1
-                    self.after(0, self.increment_progress)
+                    parsed = datetime.datetime.strptime(candidate, fmt).date()
+                    break
+                except ValueError:
                     continue
+            if parsed:
+                break
+        _statement_dates[text] = parsed
+    return _statement_dates[text]
+
+def _statement_amount(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value or "").replace(",", "").strip() or 0)
+    except ValueError:
+        return 0.0
 
-                email_text = ""
-                if msg.is_multipart():
-                    for part in msg.walk():
-                        ct = part.get_content_type()
-                        cd = str(part.get("Content-Disposition"))
-                        if ct == "text/plain" and "attachment" not in cd:
-                            email_text = part.get_payload(decode=True).decode("utf-8", errors="ignore")
-                            break
-                        elif ct == "text/html" and not email_text:
-                            email_text = part.get_payload(decode=True).decode("utf-8", errors="ignore")
-                else:
-                    email_text = msg.get_payload(decode=True).decode("utf-8", errors="ignore")
-
-                matches = re.findall(upi_pattern, email_text)
-                parsed_transactions = []
-                if matches:
-                    for match in matches:
-                        amount = float(match[0])
-                        vpa_id = match[1]
-                        party_name = match[2].strip().lower()
-                        date_str = match[3]
-
-                        txn = {
-                            "date": date_str,
-                            "amount": amount,
-                            "vpa_id": vpa_id,
-                            "party_name": party_name,
-                            "email_datetime": msg_datetime
-                        }
-                        parsed_transactions.append(txn)
-
-                if parsed_transactions:
-                    self.after(0, lambda txns=parsed_transactions: self.add_transactions_to_ui(txns))
-
-                self.processed_emails += 1
-                self.after(0, self.increment_progress)
-
-            except Exception as e2:
-                print(f"Error processing email ID {e_id}: {e2}")
-
-        self.after(0, lambda: self.fetch_done(mail))
-
-    def add_transactions_to_ui(self, txns):
-        for txn in txns:
-            self.transactions.append(txn)
-            self.category_choices.append("")
-            row_index = len(self.transactions) - 1
-            self.tree.insert(
-                "",
-                "end",
-                iid=row_index,
-                values=(
-                    txn["date"],
-                    txn["party_name"],
-                    txn["vpa_id"],
-                    txn["amount"],
-                    ""
-                )
-            )
+_HDFC_NARRATION_RE = re.compile(r"^UPI-(?P<party>[^-]*)-(?P<vpa>[\w.\-]+?@\w+)(?:-|$)")
+_VPA_FIELD_RE = re.compile(r"^[\w.\-]+@[A-Za-z]\w*$")
+_NARRATION_FILLER = {"UPI", "DR", "CR", "P2A", "P2M", "PAYMENT"}
 
-    def increment_progress(self):
-        self.progress_bar["value"] = self.processed_emails
+def parse_narration(narration):
+    """
+    (VPA, payee) from a statement narration. HDFC's
+    "UPI-<payee>-<VPA>-<IFSC>-<ref>-<note>" is read by position, the
+    slash-separated "UPI/..." forms by what each field looks like. Other
+    debits have no VPA and keep the narration as the payee.
+    """
+    match = _HDFC_NARRATION_RE.match(narration)
+    if match:
+        return match.group("vpa"), match.group("party").strip()
+    if narration.upper().startswith("UPI/"):
+        fields = [field.strip() for field in narration.split("/")[1:]]
+        vpa_id = next((field for field in fields if _VPA_FIELD_RE.match(field)), "")
+        party_name = next((
+            field for field in fields
+            if field != vpa_id and re.search(r"[A-Za-z]{2}", field) and field.upper() not in _NARRATION_FILLER
+        ), "")
+        return vpa_id, party_name
+    return "", narration
+
+def read_statement(path, stats=None):
+    """
+    Yield one Transaction per debit in the statement at `path`, streaming
+    its rows. Preamble, credits and footers are passed over; `stats` (a
+    dict) counts the dated rows, debits and credits seen.
 
-    def fetch_done(self, mail=None, no_emails=False):
-        if mail:
-            mail.logout()
+    The Message-ID is made up from the row itself, so importing the same
+    statement (or an overlapping one) again gives the same ledger keys.
+    """
+    stats = stats if stats is not None else {}
+    for name in ("rows", "debits", "credits"):
+        stats.setdefault(name, 0)
+    rows = iter_statement_rows(path)
+    columns = None
+    for row in islice(rows, STATEMENT_HEADER_SCAN_ROWS):
+        columns = statement_columns(row)
+        if columns:
+            break
+    if columns is None:
+        raise StatementError(
+            f"No column header with a date, narration and withdrawal column in the first "
+            f"{STATEMENT_HEADER_SCAN_ROWS} rows of {os.path.basename(path)}"
+        )
 
-        self.progress_bar.stop()
-        self.progress_bar.pack_forget()
-        self.set_button_normal(self.fetch_btn, "Fetch UPI Transactions")
+    width = max(columns.values()) + 1
+    day_idents = {}
+    for row in rows:
+        if len(row) < width:
+            row = list(row) + [None] * (width - len(row))
+        day = _statement_date(row[columns["date"]])
+        if day is None:
+            continue
+        stats["rows"] += 1
 
-        if no_emails:
-            messagebox.showinfo("Info", f"No UPI transactions found since {self.since_date_str}.")
-            return
+        if "debit" in columns:
+            amount = _statement_amount(row[columns["debit"]])
+        else:
+            # One amount column: signed, or with a Dr/Cr column beside it
+            amount = _statement_amount(row[columns["amount"]])
+            kind = str(row[columns["type"]] or "").strip().upper() if "type" in columns else ""
+            amount = (abs(amount) if kind.startswith("D") else -abs(amount)) if kind else -amount
+        if amount <= 0:
+            stats["credits"] += 1
+            continue
+        stats["debits"] += 1
+
+        narration = " ".join(str(row[columns["narration"]] or "").split())
+        reference = str(row[columns["reference"]] or "").strip() if "reference" in columns else ""
+        vpa_id, party_name = parse_narration(narration)
+        date_str = day.strftime("%d-%m-%y")
+        # Number identical rows within their day; statements are in date order,
+        # so only the current day's rows need remembering
+        ident = f"{date_str}|{amount:.2f}|{reference}|{narration}"
+        if day_idents and next(iter(day_idents)).split("|", 1)[0] != date_str:
+            day_idents.clear()
+        repeat = day_idents.get(ident, 0)
+        day_idents[ident] = repeat + 1
+        if repeat:
+            ident += f"#{repeat}"
+        yield Transaction(
+            date_str, round(amount, 2), vpa_id, party_name or narration,
+            datetime.datetime.combine(day, datetime.time()),
+            STATEMENT_ID_PREFIX + hashlib.sha1(ident.encode("utf-8")).hexdigest()
+        )
 
-        if self.total_emails > 0 and not self.transactions:
-            last_processed = get_last_processed_time()
-            if last_processed:
-                messagebox.showinfo("Info", "No new transactions found since last run.")
-            else:
-                messagebox.showinfo("Info", "No valid UPI transactions found in the fetched emails.")
+def cache_statement_rows(transactions, source):
+    """
+    Add statement rows to the local cache, where reports and offline syncs
+    find them. Rows an earlier import already cached come back as cached,
+    with the category they were booked under.
+    """
+    cached = cache_lookup(txn["message_id"] for txn in transactions)
+    rows, new = [], []
+    for txn in transactions:
+        earlier = cached.get(txn["message_id"])
+        if earlier:
+            rows.append(earlier[0])
         else:
-            messagebox.showinfo("Success", "Fetching completed successfully! Transactions are now listed below.")
+            rows.append(txn)
+            new.append(txn)
+    if not new:
+        return rows
+    # One row per "message"; these are all new, so no cache_store() replace dance
+    with closing(open_cache()) as conn, conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO messages VALUES (?, 'statement', ?, NULL, ?, NULL)",
+            [(txn["message_id"], source, txn["email_datetime"].isoformat()) for txn in new]
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO transactions VALUES (?, 0, NULL, ?, ?, ?, ?, ?, ?, '')",
+            [(txn["message_id"], _txn_iso_date(txn["date"], None), txn["date"], txn["email_datetime"].isoformat(),
+              txn["amount"], txn["vpa_id"], txn["party_name"]) for txn in new]
+        )
+    return rows
 
-    # ---------- Update Excel ----------
-    def update_excel_gui(self):
-        if not self.transactions:
-            messagebox.showwarning("Warning", "No transactions to update.")
-            return
+# =========================
+# COMMAND LINE
+# =========================
 
-        for i in range(len(self.transactions)):
-            row_vals = list(self.tree.item(i, "values"))
-            cat = row_vals[-1].strip() if row_vals[-1] else ""
-            self.category_choices[i] = cat
+# Exit codes of `python -m UPIx sync`, for cron jobs and scripts
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+EXIT_FETCH_FAILED = 3  # or, for import, the statement couldn't be read
+EXIT_COMMIT_FAILED = 4
+EXIT_PARTIAL_FETCH = 5  # booked, but some mailboxes failed and were left for next time
 
-        excel_file = self.excel_path_var.get().strip()
-        sheet_name = self.sheet_var.get().strip()
+def hold_back_markers(sync_markers, held):
+    """
+    Keep each mailbox's marker below its oldest held-back transaction, so
+    the next sync sees those emails again instead of losing them. UIDs
+    only mean something within their own mailbox.
+    """
+    oldest = {}
+    for txn in held:
+        if txn.get("uid") is not None:
+            mailbox = txn.get("mailbox")
+            oldest[mailbox] = min(oldest.get(mailbox, int(txn["uid"])), int(txn["uid"]))
+    if not oldest:
+        return sync_markers
+    capped = []
+    for marker in sync_markers or []:
+        # Held rows of unknown origin keep every marker down, as before
+        uids = [oldest[key] for key in (mailbox_key(marker["account"], marker["folder"]), None)
+                if key in oldest]
+        if uids:
+            marker = dict(marker, last_uid=min(marker["last_uid"], min(uids) - 1))
+        capped.append(marker)
+    return capped
+
+def book_batch(transactions, sync_markers, excel_file, sheet_name, default_category=None, dry_run=False,
+               held_before=()):
+    """
+    Categorize one batch of fetched transactions and book it into the
+    workbook. `held_before` are transactions held back earlier in the same
+    session, which the sync state must also stay below.
+    Returns (exit code, summary dict).
+    """
+    category_choices = [txn.get("category") or default_category for txn in transactions]
+    held = [txn for txn, cat in zip(transactions, category_choices) if not cat]
+    sync_markers = hold_back_markers(sync_markers, list(held_before) + held)
+    summary = {
+        "transactions": len(transactions),
+        "held": len(held),
+        "total_upi": round(sum(txn["amount"] for txn in transactions), 2)
+    }
+
+    if not transactions:
+        if not dry_run:
+            commit_sync_markers(sync_markers)
+        summary.update(status="ok", message="No new transactions.")
+        return EXIT_OK, summary
+    if dry_run or len(held) == len(transactions):
+        if dry_run:
+            message = "Dry run, nothing booked."
+        else:
+            message = "No known merchants and no default category, nothing booked."
+        summary.update(
+            status="ok",
+            message=message,
+            rows=[
+                {"date": txn["date"], "amount": txn["amount"], "vpa_id": txn["vpa_id"],
+                 "party_name": txn["party_name"], "category": cat}
+                for txn, cat in zip(transactions, category_choices)
+            ]
+        )
+        return EXIT_OK, summary
+
+    result = update_excel(transactions, category_choices, excel_file, sheet_name, sync_markers=sync_markers)
+    summary["status"] = result["status"]
+    summary["message"] = result["message"]
+    for field in ("added", "skipped", "category_sums", "workbooks", "created"):
+        if field in result:
+            summary[field] = result[field]
+    if "metrics" in result:
+        summary["metrics"] = {"update": result["metrics"]}
+    if result["status"] in ("ok", "duplicate"):
+        return EXIT_OK, summary
+    return EXIT_COMMIT_FAILED, summary
+
+def fetch_for_cli(since_date, offline=False):
+    """
+    Fetch for the sync command. Returns (transactions, sync markers,
+    emails searched, fetch run report or None, failed mailboxes), or raises
+    FetchError.
+    """
+    if offline:
+        try:
+            transactions, _ = drop_cached_duplicates(load_cached_transactions(since_date), "statement")
+        except sqlite3.Error as e:
+            raise FetchError(f"Could not read local cache: {e}")
+        suggest_categories(transactions)
+        return transactions, [], len(transactions), None, {}
+    try:
+        result = ingest_mailboxes(since_date)
+    finally:
+        close_connection_pools()
+    return (result["transactions"], result["sync_markers"], result["total"], result.get("metrics"),
+            result["errors"])
 
-        update_excel(self.transactions, self.category_choices, excel_file, sheet_name)
+def run_sync(since_date, excel_file, sheet_name, default_category=None, offline=False, dry_run=False):
+    """
+    Fetch, parse, categorize and book transactions with no GUI.
 
-        for row in self.tree.get_children():
-            self.tree.delete(row)
-        self.transactions.clear()
-        self.category_choices.clear()
+    Transactions the category index doesn't know get --default-category;
+    without one they are held back: nothing is booked for them and the sync
+    state stays below them.
+    Returns (exit code, summary dict).
+    """
+    summary = {"since": since_date.strftime("%d-%m-%Y"), "excel": excel_file, "sheet": sheet_name}
+    try:
+        transactions, sync_markers, summary["emails"], fetch_report, errors = fetch_for_cli(since_date, offline)
+    except FetchError as e:
+        summary.update(status="error", message=str(e))
+        return EXIT_FETCH_FAILED, summary
 
-        last_processed = get_last_processed_time()
-        if last_processed:
-            self.last_processed_label_var.set(
-                f"Last Run: {last_processed.strftime('%d-%b-%Y %I:%M:%S %p')}"
-            )
+    code, batch_summary = book_batch(
+        transactions, sync_markers, excel_file, sheet_name, default_category, dry_run
+    )
+    summary.update(batch_summary)
+    if fetch_report:
+        summary.setdefault("metrics", {})["fetch"] = fetch_report
+    if errors:
+        summary["mailbox_errors"] = errors
+        if code == EXIT_OK:
+            code = EXIT_PARTIAL_FETCH
+    return code, summary
+
+def run_watch(since_date, excel_file, sheet_name, emit, default_category=None, dry_run=False):
+    """
+    Stay in IMAP IDLE and book every new batch as it arrives, passing one
+    summary per batch to `emit`. Runs until interrupted.
+    """
+    stop_event = threading.Event()
+    held = []
+    # Every mailbox has its own watcher; they book into the workbook one at a time
+    booking = threading.Lock()
+
+    def on_batch(result):
+        with booking:
+            book_result(result)
+
+    def book_result(result):
+        transactions = result["transactions"]
+        if not result["total"]:
+            return
+        code, summary = book_batch(
+            transactions, result["sync_markers"], excel_file, sheet_name,
+            default_category, dry_run, held_before=held
+        )
+        held.extend(txn for txn in transactions if not (txn.get("category") or default_category))
+        summary["time"] = datetime.datetime.now().isoformat(timespec="seconds")
+        summary["emails"] = result["total"]
+        if result.get("metrics"):
+            summary.setdefault("metrics", {})["fetch"] = result["metrics"]
+        emit(code, summary)
+
+    try:
+        watch_mailboxes(since_date, on_batch, stop_event)
+    except FetchError as e:
+        emit(EXIT_FETCH_FAILED, {"status": "error", "message": str(e)})
+        return EXIT_FETCH_FAILED
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        close_connection_pools()
+    return EXIT_OK
+
+def run_import(path, excel_file, sheet_name, default_category=None, dry_run=False, chunk_rows=None):
+    """
+    Book a bank statement export STATEMENT_CHUNK_ROWS rows at a time, so
+    memory stays flat however many years it covers. Debits the mail alerts
+    already brought in are dropped; the rest are cached, categorized and
+    booked like a sync, each chunk committed before the next is read.
+    Returns (exit code, summary dict).
+    """
+    chunk_rows = chunk_rows or STATEMENT_CHUNK_ROWS
+    metrics = RunMetrics("import")
+    stats = {}
+    summary = {
+        "statement": path, "excel": excel_file, "sheet": sheet_name, "chunks": 0,
+        "mail_duplicates": 0, "transactions": 0, "held": 0, "total_debited": 0.0,
+        "added": 0.0, "skipped": 0.0, "category_sums": {}, "workbooks": [], "created": []
+    }
+    code = EXIT_OK
+    status, message = "ok", None
+    duplicate_chunks = 0
+    rows = read_statement(path, stats)
+    try:
+        while True:
+            with metrics.stage("statement_read"):
+                chunk = list(islice(rows, chunk_rows))
+            if not chunk:
+                break
+            summary["chunks"] += 1
+            with metrics.stage("dedupe"):
+                chunk, from_mail = drop_cached_duplicates(chunk, "mail")
+            summary["mail_duplicates"] += len(from_mail)
+            if not dry_run:
+                with metrics.stage("cache_store"):
+                    chunk = cache_statement_rows(chunk, os.path.basename(path))
+            with metrics.stage("categorize"):
+                metrics.count("categories_suggested", suggest_categories(chunk))
+
+            with metrics.stage("book"):
+                code, booked = book_batch(chunk, None, excel_file, sheet_name, default_category, dry_run)
+            summary["transactions"] += booked["transactions"]
+            summary["held"] += booked["held"]
+            summary["total_debited"] = round(summary["total_debited"] + booked["total_upi"], 2)
+            for field in ("added", "skipped"):
+                summary[field] = round(summary[field] + booked.get(field, 0), 2)
+            for cat, amount in booked.get("category_sums", {}).items():
+                summary["category_sums"][cat] = round(summary["category_sums"].get(cat, 0) + amount, 2)
+            summary["workbooks"] += [name for name in booked.get("workbooks", ()) if name not in summary["workbooks"]]
+            summary["created"] += booked.get("created", [])
+            duplicate_chunks += booked["status"] == "duplicate"
+            if code != EXIT_OK:
+                status = booked["status"]
+                message = f"Stopped at chunk {summary['chunks']}; earlier chunks are booked. {booked['message']}"
+                break
+    except (StatementError, OSError, csv.Error) as e:
+        code, status, message = EXIT_FETCH_FAILED, "error", str(e)
+
+    summary.update(rows=stats.get("rows", 0), debits=stats.get("debits", 0), credits=stats.get("credits", 0))
+    if message is None:
+        if dry_run:
+            message = "Dry run, nothing booked."
+        elif not summary["transactions"]:
+            message = "No new debits in the statement."
+        elif duplicate_chunks == summary["chunks"]:
+            message = "Everything in the statement is already booked."
+        else:
+            message = (f"Booked Rs.{summary['added']:.2f} in {summary['chunks']} chunk(s), "
+                       f"skipped Rs.{summary['skipped']:.2f}.")
+            if summary["held"]:
+                message += f" {summary['held']} from unknown merchants held back."
+    summary.update(status=status, message=message)
+    for name in ("rows", "debits", "credits", "mail_duplicates", "transactions", "held"):
+        metrics.count(name, summary[name])
+    summary["metrics"] = {"import": metrics.finish(status=status)}
+    return code, summary
+
+def run_log(args):
+    """The log subcommand: the newest runs from the run journal, as text or JSON lines."""
+    if args.latest:
+        print(json.dumps(load_latest_run(), indent=2, ensure_ascii=False))
+        return EXIT_OK
+    for record in read_journal(args.runs if args.runs > 0 else None):
+        print(json.dumps(record, ensure_ascii=False) if args.json else render_run(record))
+    return EXIT_OK
+
+def run_report(args, parser):
+    """The report subcommand: print the analytics as JSON, optionally export them."""
+    dates = {}
+    for name in ("since", "until"):
+        value = getattr(args, name)
+        try:
+            dates[name] = datetime.datetime.strptime(value, "%d-%m-%Y") if value else None
+        except ValueError:
+            parser.print_usage(sys.stderr)
+            print(f"UPIx report: error: --{name} must be DD-MM-YYYY, got '{value}'", file=sys.stderr)
+            return EXIT_USAGE
 
-    def browse_excel(self):
-        path = filedialog.askopenfilename(
-            title="Select Excel File",
-            filetypes=[("Excel Files", "*.xlsx *.xlsm *.xlsb *.xls")],
+    # pandas only gets imported here
+    import UPIx_analytics
+    try:
+        result = UPIx_analytics.build_report(
+            dates["since"], dates["until"], args.excel if os.path.exists(args.excel) else None,
+            args.daily_sheet, args.top
         )
-        if path:
-            self.excel_path_var.set(path)
+        summary = UPIx_analytics.report_summary(result)
+        if args.export:
+            exported = UPIx_analytics.export_report(result, args.excel)
+            summary["exported_to"] = f"{exported} [{UPIx_analytics.REPORT_SHEET_NAME}]"
+    except (UPIx_analytics.AnalyticsError, sqlite3.Error, OSError) as e:
+        print(json.dumps({"status": "error", "message": str(e)}, indent=2))
+        return EXIT_ERROR
+    summary["status"] = "ok"
+    print(json.dumps(summary, indent=2, default=str))
+    return EXIT_OK
+
+def main(argv=None):
+    """Run a subcommand, or open the window when none is given."""
+    import argparse
+    import contextlib
+
+    parser = argparse.ArgumentParser(prog="UPIx", description="Book HDFC UPI alerts into the expense workbook.")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("gui", help="open the window (default)")
+
+    # Options every booking command takes, defined once so they can't drift apart
+    booking = argparse.ArgumentParser(add_help=False)
+    booking.add_argument("--excel", default=DEFAULT_EXCEL_FILE, help="workbook, or folder of monthly workbooks, to update")
+    booking.add_argument("--sheet", default=SHEET_NAME, help=f"month sheet to update ('{AUTO_SHEET}': by transaction date)")
+    booking.add_argument("--default-category", choices=list(EXPENSE_CATEGORIES.values()),
+                         help="category for merchants not seen before; without it they are held back")
+    booking.add_argument("--dry-run", action="store_true", help="report what would be booked, but don't touch the workbook")
+    booking.add_argument("--metrics", action="store_true", help="include stage timings and counters in the JSON output")
+    booking.add_argument("--profile", action="store_true", help=f"also save a cProfile dump of each run to {PROFILE_DIR}")
+
+    sync = commands.add_parser("sync", parents=[booking], help="fetch and book transactions without the GUI")
+    sync.add_argument("--since", required=True, help="first day to fetch, DD-MM-YYYY")
+    sync.add_argument("--offline", action="store_true", help="read the local cache only, no IMAP")
+    watch = commands.add_parser("watch", parents=[booking], help="stay connected and book alerts as they arrive")
+    watch.add_argument("--since", help="first day to catch up on, DD-MM-YYYY (default: today)")
+    importer = commands.add_parser("import", parents=[booking], help="book a bank statement export (CSV, XLSX or XLS)")
+    importer.add_argument("statement", help="statement file, as downloaded from net banking")
+    importer.add_argument("--chunk-rows", type=int, default=STATEMENT_CHUNK_ROWS, help="debits read and booked at a time")
+
+    report = commands.add_parser("report", help="spending analytics over the booked history (needs pandas)")
+    report.add_argument("--since", help="first day to include, DD-MM-YYYY")
+    report.add_argument("--until", help="first day to leave out, DD-MM-YYYY")
+    report.add_argument("--excel", default=DEFAULT_EXCEL_FILE, help="workbook, or folder of monthly workbooks, with the daily sheet")
+    report.add_argument("--daily-sheet", default=datetime.date.today().strftime(DAILY_SHEET_FORMAT),
+                        help="sheet to compare the daily run-rate against")
+    report.add_argument("--top", type=int, default=10, help="how many merchants to list")
+    report.add_argument("--export", action="store_true", help="also write the report into the workbook as a new sheet")
+
+    log = commands.add_parser("log", help="show the newest booking runs from the run journal")
+    log.add_argument("--runs", type=int, default=5, help="how many of the newest runs to show (0: all)")
+    log.add_argument("--json", action="store_true", help="print the journal lines as they are")
+    log.add_argument("--latest", action="store_true", help="print only the latest run's summary, as JSON")
 
-def main():
-    app = ExpenseGUI()
-    app.mainloop()
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as e:
+        return e.code
+
+    if args.command in (None, "gui"):
+        # Tk is only imported when the window is actually wanted
+        import UPIx_gui
+        UPIx_gui.main()
+        return EXIT_OK
+
+    if args.command == "report":
+        return run_report(args, report)
+    if args.command == "log":
+        return run_log(args)
+
+    if args.profile:
+        global PROFILE_RUNS
+        PROFILE_RUNS = True
+
+    if args.command == "import":
+        if args.chunk_rows < 1:
+            importer.print_usage(sys.stderr)
+            print(f"UPIx import: error: --chunk-rows must be at least 1, got {args.chunk_rows}", file=sys.stderr)
+            return EXIT_USAGE
+    else:
+        since = args.since or datetime.date.today().strftime("%d-%m-%Y")
+        try:
+            since_date = datetime.datetime.strptime(since, "%d-%m-%Y")
+        except ValueError:
+            (sync if args.command == "sync" else watch).print_usage(sys.stderr)
+            print(f"UPIx {args.command}: error: --since must be DD-MM-YYYY, got '{since}'", file=sys.stderr)
+            return EXIT_USAGE
+
+    # stdout carries only the JSON summaries; progress chatter goes to stderr
+    out = sys.stdout
+    if args.command == "watch":
+        def emit(code, summary):
+            if not args.metrics:
+                summary.pop("metrics", None)
+            print(json.dumps(summary, default=str), file=out, flush=True)
+        with contextlib.redirect_stdout(sys.stderr):
+            return run_watch(
+                since_date, args.excel, args.sheet, emit, args.default_category, dry_run=args.dry_run
+            )
+
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            if args.command == "import":
+                code, summary = run_import(
+                    args.statement, args.excel, args.sheet, args.default_category,
+                    dry_run=args.dry_run, chunk_rows=args.chunk_rows
+                )
+            else:
+                code, summary = run_sync(
+                    since_date, args.excel, args.sheet, args.default_category,
+                    offline=args.offline, dry_run=args.dry_run
+                )
+    except Exception as e:
+        code, summary = EXIT_ERROR, {"status": "error", "message": f"{type(e).__name__}: {e}"}
+    if not args.metrics:
+        summary.pop("metrics", None)
+    print(json.dumps(summary, indent=2, default=str))
+    return code
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,342 @@
+import datetime
+import os
+import re
+import time
+from contextlib import closing
+
+from openpyxl import Workbook, load_workbook
+
+from UPIx import (
+    DAILY_SHEET_FORMAT,
+    normalize_party,
+    open_cache,
+    partition_files,
+    safe_eval_arithmetic,
+    save_workbook_atomically,
+)
+
+# =========================
+# SETTINGS
+# =========================
+
+DAILY_SHEET_NAME = datetime.date.today().strftime(DAILY_SHEET_FORMAT)
+REPORT_SHEET_NAME = "UPIx Report"
+TOP_MERCHANTS = 10
+
+# A transaction is flagged when its robust z-score within its category passes
+# this, and a category's month when it beats the previous months' average by this factor
+ANOMALY_Z_SCORE = 3.5
+ANOMALY_MIN_TRANSACTIONS = 5
+ANOMALY_MONTH_FACTOR = 2.0
+ANOMALY_MONTH_HISTORY = 3
+
+class AnalyticsError(Exception):
+    pass
+
+def _pandas():
+    """pandas and numpy, only imported once a report is actually asked for."""
+    try:
+        import numpy
+        import pandas
+    except ImportError as e:
+        raise AnalyticsError("Reports need pandas and numpy (pip install pandas).") from e
+    return pandas, numpy
+
+# =========================
+# HISTORY
+# =========================
+
+def load_booked_history(since=None, until=None):
+    """
+    Every booked transaction in the local cache, dated `since` (inclusive)
+    to `until` (exclusive), as a DataFrame with a `month` column added.
+    Skipped and never-categorized rows are left out.
+    """
+    pd, _ = _pandas()
+    query = (
+        "SELECT txn_date, amount, vpa_id, party_name, category FROM transactions "
+        "WHERE category NOT IN ('', 'Skip') AND txn_date IS NOT NULL"
+    )
+    params = []
+    if since:
+        query += " AND txn_date >= ?"
+        params.append(since.strftime("%Y-%m-%d"))
+    if until:
+        query += " AND txn_date < ?"
+        params.append(until.strftime("%Y-%m-%d"))
+    with closing(open_cache()) as conn:
+        history = pd.read_sql_query(query, conn, params=params)
+    history["txn_date"] = pd.to_datetime(history["txn_date"])
+    history["month"] = history["txn_date"].dt.strftime("%Y-%m")
+    return history
+
+# =========================
+# REPORTS
+# =========================
+
+def category_month_totals(history):
+    """Category x month spending, with a Total column and row."""
+    pd, _ = _pandas()
+    if history.empty:
+        return pd.DataFrame()
+    table = history.pivot_table(index="category", columns="month", values="amount", aggfunc="sum", fill_value=0.0)
+    table["Total"] = table.sum(axis=1)
+    table = table.sort_values("Total", ascending=False)
+    table.loc["Total"] = table.sum(axis=0)
+    return table.round(2)
+
+def top_merchants(history, count=TOP_MERCHANTS):
+    """
+    The payees with the most spend: total, number of payments, average,
+    name and last payment date. UPI payments are grouped by VPA; debits
+    without one (ATM, NEFT, card) are grouped by their normalized payee
+    name instead, and left out when they have no name either.
+    """
+    pd, _ = _pandas()
+    vpa = history["vpa_id"].fillna("")
+    payee = vpa.where(vpa != "", history["party_name"].map(normalize_party))
+    history = history.assign(payee=payee)[payee != ""]
+    if history.empty:
+        return pd.DataFrame()
+    merchants = history.sort_values("txn_date").groupby("payee").agg(
+        party_name=("party_name", "last"),
+        total=("amount", "sum"),
+        payments=("amount", "size"),
+        average=("amount", "mean"),
+        last_paid=("txn_date", "max"),
+    )
+    merchants = merchants.sort_values("total", ascending=False).head(count)
+    merchants["last_paid"] = merchants["last_paid"].dt.strftime("%Y-%m-%d")
+    return merchants.round(2)
+
+def _sheet_year(daily_sheet):
+    year = re.search(r"\d{4}", daily_sheet)
+    if not year:
+        raise AnalyticsError(f"Can't tell the year of sheet '{daily_sheet}'.")
+    return int(year.group())
+
+def read_daily_sheet(excel_file, daily_sheet=DAILY_SHEET_NAME):
+    """
+    The per-day amounts the daily sheet holds, as a Series indexed by date.
+    Formula cells are evaluated the same way update_excel reads them. For a
+    folder of monthly workbooks, their daily sheets are added together.
+    """
+    pd, _ = _pandas()
+    if os.path.isdir(excel_file):
+        sheets = []
+        for path in partition_files(excel_file).values():
+            try:
+                sheets.append(read_daily_sheet(path, daily_sheet))
+            except AnalyticsError:
+                continue
+        if not sheets:
+            raise AnalyticsError(f"No workbook in {excel_file} has a '{daily_sheet}' sheet.")
+        return pd.concat(sheets).groupby(level=0).sum().sort_index()
+    year = _sheet_year(daily_sheet)
+
+    wb = load_workbook(excel_file, read_only=True)
+    try:
+        try:
+            ws = wb[daily_sheet]
+        except KeyError:
+            raise AnalyticsError(f"Sheet '{daily_sheet}' not found in workbook.")
+        rows = ws.iter_rows(min_row=2, values_only=True)
+        header = next(rows, ())
+        month_cols = {}
+        for col, name in enumerate(header[1:], start=1):
+            try:
+                month_cols.setdefault(col, datetime.datetime.strptime(str(name).strip(), "%B").month)
+            except ValueError:
+                continue
+
+        amounts = {}
+        for row in rows:
+            if not row or not isinstance(row[0], (int, float)):
+                continue
+            for col, month in month_cols.items():
+                value = row[col] if col < len(row) else None
+                if isinstance(value, str) and value.startswith("="):
+                    try:
+                        value = safe_eval_arithmetic(value[1:])
+                    except ValueError:
+                        value = None
+                if not isinstance(value, (int, float)) or not value:
+                    continue
+                try:
+                    day = datetime.date(year, month, int(row[0]))
+                except ValueError:
+                    continue
+                amounts[day] = amounts.get(day, 0.0) + float(value)
+    finally:
+        wb.close()
+    return pd.Series(amounts, dtype="float64").sort_index()
+
+def daily_run_rate(history, excel_file, daily_sheet=DAILY_SHEET_NAME, category="Food"):
+    """
+    Month by month: what the daily sheet holds against what the booked
+    `category` transactions add up to, both as totals and per day elapsed.
+    """
+    pd, _ = _pandas()
+    sheet = read_daily_sheet(excel_file, daily_sheet)
+    booked = history[(history["category"] == category) & (history["txn_date"].dt.year == _sheet_year(daily_sheet))]
+    booked = booked.groupby(booked["txn_date"].dt.strftime("%Y-%m"))["amount"].sum()
+    if sheet.empty and booked.empty:
+        return pd.DataFrame()
+
+    if not sheet.empty:
+        sheet = sheet.groupby(pd.to_datetime(sheet.index).strftime("%Y-%m")).sum()
+    months = sorted(set(sheet.index) | set(booked.index))
+    table = pd.DataFrame(index=months)
+    table["sheet_total"] = sheet.reindex(months, fill_value=0.0)
+    table["booked_total"] = booked.reindex(months, fill_value=0.0)
+
+    # Days of each month that have happened so far
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    days = []
+    for month in months:
+        start = datetime.datetime.strptime(month, "%Y-%m").date()
+        end = min((start + datetime.timedelta(days=32)).replace(day=1), tomorrow)
+        days.append(max((end - start).days, 0))
+    table["days"] = days
+    elapsed = table["days"].where(table["days"] > 0)
+    table["sheet_per_day"] = table["sheet_total"] / elapsed
+    table["booked_per_day"] = table["booked_total"] / elapsed
+    table["difference"] = table["sheet_total"] - table["booked_total"]
+    return table.round(2)
+
+def find_anomalies(history):
+    """
+    Flag single payments far outside their category's usual range
+    (robust z-score on the median absolute deviation), and category
+    months well above the average of the months before them.
+    """
+    pd, np = _pandas()
+    columns = ["kind", "category", "when", "vpa_id", "amount", "expected"]
+    if history.empty:
+        return pd.DataFrame(columns=columns)
+
+    flags = []
+    by_category = history.groupby("category")["amount"]
+    median = by_category.transform("median")
+    mad = (history["amount"] - median).abs().groupby(history["category"]).transform("median")
+    size = by_category.transform("size")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = 0.6745 * (history["amount"] - median) / mad
+    outliers = history[(size >= ANOMALY_MIN_TRANSACTIONS) & (mad > 0) & (score > ANOMALY_Z_SCORE)]
+    flags.append(pd.DataFrame({
+        "kind": "payment",
+        "category": outliers["category"],
+        "when": outliers["txn_date"].dt.strftime("%Y-%m-%d"),
+        "vpa_id": outliers["vpa_id"],
+        "amount": outliers["amount"],
+        "expected": median[outliers.index],
+    }))
+
+    monthly = history.pivot_table(index="category", columns="month", values="amount", aggfunc="sum", fill_value=0.0)
+    previous = monthly.T.rolling(ANOMALY_MONTH_HISTORY, min_periods=2).mean().shift(1).T
+    spikes = (monthly > previous * ANOMALY_MONTH_FACTOR).stack()
+    for category, month in spikes[spikes].index:
+        flags.append(pd.DataFrame([{
+            "kind": "month",
+            "category": category,
+            "when": month,
+            "vpa_id": "",
+            "amount": monthly.at[category, month],
+            "expected": previous.at[category, month],
+        }]))
+
+    flags = [frame for frame in flags if not frame.empty]
+    if not flags:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(flags, ignore_index=True).sort_values("when").reset_index(drop=True).round(2)
+
+def build_report(since=None, until=None, excel_file=None, daily_sheet=DAILY_SHEET_NAME, top=TOP_MERCHANTS):
+    """
+    Run every report over the booked history. The run-rate comparison
+    needs `excel_file`; it's left out without one. Returns a dict of
+    DataFrames plus the row count and how long it took.
+    """
+    started = time.perf_counter()
+    history = load_booked_history(since, until)
+    report = {
+        "transactions": len(history),
+        "category_month": category_month_totals(history),
+        "top_merchants": top_merchants(history, top),
+        "anomalies": find_anomalies(history),
+    }
+    if excel_file:
+        report["run_rate"] = daily_run_rate(history, excel_file, daily_sheet)
+    report["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return report
+
+def report_summary(report):
+    """The report as plain JSON-friendly values."""
+    summary = {"transactions": report["transactions"], "elapsed_ms": report["elapsed_ms"]}
+    summary["category_month"] = {
+        category: {month: value for month, value in row.items()}
+        for category, row in report["category_month"].to_dict(orient="index").items()
+    }
+    summary["top_merchants"] = report["top_merchants"].reset_index().to_dict(orient="records")
+    summary["anomalies"] = report["anomalies"].to_dict(orient="records")
+    if "run_rate" in report:
+        summary["run_rate"] = report["run_rate"].reset_index(names="month").to_dict(orient="records")
+    return summary
+
+# =========================
+# EXPORT
+# =========================
+
+def _write_table(ws, row, title, table, index_label):
+    """Write one titled table starting at `row`; returns the first free row after it."""
+    ws.cell(row=row, column=1, value=title)
+    row += 1
+    if table.empty:
+        ws.cell(row=row, column=1, value="(nothing to show)")
+        return row + 2
+    ws.cell(row=row, column=1, value=index_label)
+    for col, name in enumerate(table.columns, start=2):
+        ws.cell(row=row, column=col, value=str(name))
+    for label, values in zip(table.index, table.itertuples(index=False)):
+        row += 1
+        ws.cell(row=row, column=1, value=str(label))
+        for col, value in enumerate(values, start=2):
+            if hasattr(value, "item"):
+                value = value.item()
+            if isinstance(value, float) and value != value:
+                value = None
+            ws.cell(row=row, column=col, value=value)
+    return row + 2
+
+def export_report(report, excel_file, sheet_name=REPORT_SHEET_NAME):
+    """
+    Replace `sheet_name` in the workbook with a fresh copy of the report,
+    saved atomically. Given a folder of monthly workbooks, the report gets
+    a workbook of its own there. Returns the file written.
+    """
+    if os.path.isdir(excel_file):
+        excel_file = os.path.join(excel_file, f"{sheet_name}.xlsx")
+        if os.path.exists(excel_file):
+            wb = load_workbook(excel_file)
+        else:
+            wb = Workbook()
+            wb.remove(wb.active)
+    else:
+        wb = load_workbook(excel_file)
+    try:
+        if sheet_name in wb.sheetnames:
+            del wb[sheet_name]
+        ws = wb.create_sheet(sheet_name)
+        ws.cell(row=1, column=1, value="UPIx spending report")
+        ws.cell(row=2, column=1, value=f"Generated {datetime.datetime.now():%d-%b-%Y %I:%M%p} "
+                                       f"from {report['transactions']} booked transactions")
+        row = 4
+        row = _write_table(ws, row, "Spending by category and month", report["category_month"], "Category")
+        row = _write_table(ws, row, "Top merchants", report["top_merchants"], "UPI ID / payee")
+        if "run_rate" in report:
+            row = _write_table(ws, row, "Daily sheet vs booked Food", report["run_rate"], "Month")
+        anomalies = report["anomalies"]
+        _write_table(ws, row, "Anomalies", anomalies.set_index("kind") if not anomalies.empty else anomalies, "Kind")
+        save_workbook_atomically(wb, excel_file)
+    finally:
+        wb.close()
+    return excel_file
@@ -0,0 +1,761 @@
+import datetime
+import re
+import sqlite3
+import threading
+import time
+import queue
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog
+import platform
+import subprocess
+
+from UPIx import (
+    AUTO_SHEET,
+    DEFAULT_EXCEL_FILE,
+    EXPENSE_CATEGORIES,
+    SHEET_NAME,
+    UI_TICK_MS,
+    FetchError,
+    RunMetrics,
+    TransactionBatch,
+    close_connection_pools,
+    commit_sync_markers,
+    drop_cached_duplicates,
+    drop_copied_messages,
+    get_last_processed_time,
+    ingest_mailboxes,
+    load_cached_transactions,
+    load_latest_run,
+    mailbox_key,
+    merge_sync_markers,
+    suggest_categories,
+    update_excel,
+    watch_mailboxes,
+)
+
+# =========================
+# DARK MODE DETECTION
+# =========================
+
+def detect_dark_mode():
+    """
+    Return True if the system is in Dark Mode (Windows or macOS).
+    Otherwise, return False (assume light mode).
+    """
+    system = platform.system()
+    if system == "Darwin":
+        # macOS detection
+        try:
+            result = subprocess.run(
+                ["defaults", "read", "-g", "AppleInterfaceStyle"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            return (result.returncode == 0 and "Dark" in result.stdout)
+        except:
+            pass
+        return False
+    elif system == "Windows":
+        # Windows detection
+        try:
+            import winreg
+            with winreg.OpenKey(
+                winreg.HKEY_CURRENT_USER,
+                r"Software\Microsoft\Windows\CurrentVersion\Themes\Personalize"
+            ) as key:
+                apps_use_light_theme, _ = winreg.QueryValueEx(key, "AppsUseLightTheme")
+                return (apps_use_light_theme == 0)
+        except:
+            return False
+    return False
+
+# ========================
+# MAIN GUI
+# ========================
+
+def _email_time_sort_value(batch, i):
+    stamp = batch.stamps[i]
+    return (stamp if stamp == stamp else 0.0, max(batch.uids[i], 0))
+
+# Sort keys read the batch's columns directly, row `i` at a time
+TABLE_SORT_KEYS = {
+    "date": lambda batch, i: (batch.days[i], _email_time_sort_value(batch, i)),
+    "party_name": lambda batch, i: batch.party_names[i] or "",
+    "vpa_id": lambda batch, i: (batch.vpa_ids[i] or "").lower(),
+    "amount": lambda batch, i: batch.amounts[i],
+    "category": lambda batch, i: batch.category(i),
+}
+
+def make_transaction_filter(text):
+    """
+    Turn the table's filter box into a predicate over (batch, row index).
+    ">500", "<=99.5" or "=120" compare the amount; any other text matches
+    date, party name, UPI ID or category case-insensitively.
+    """
+    text = text.strip().lower()
+    if not text:
+        return None
+
+    match = re.fullmatch(r"(<=|>=|<|>|=)\s*(\d+(?:\.\d+)?)", text)
+    if match:
+        op, limit = match.group(1), float(match.group(2))
+        compare = {
+            "<": lambda a: a < limit, "<=": lambda a: a <= limit,
+            ">": lambda a: a > limit, ">=": lambda a: a >= limit,
+            "=": lambda a: abs(a - limit) < 0.005,
+        }[op]
+        return lambda batch, i: compare(batch.amounts[i])
+
+    return lambda batch, i: (
+        text in batch.dates[i] or text in batch.party_names[i]
+        or text in batch.vpa_ids[i].lower() or text in batch.category(i).lower()
+    )
+
+def last_run_text():
+    """The "Last Run" line: newest processed email, plus what the latest update booked."""
+    last_processed = get_last_processed_time()
+    if not last_processed:
+        return "Last Run: None"
+    text = f"Last Run: {last_processed.strftime('%d-%b-%Y %I:%M:%S %p')}"
+    latest = load_latest_run()
+    if latest and latest.get("status") == "ok":
+        text += f"  (Rs.{latest['added']:.2f} booked)"
+    return text
+
+class VirtualTable(ttk.Frame):
+    """
+    A Treeview that only ever holds the rows currently on screen.
+
+    The rows themselves live elsewhere: the table is given a list of model
+    indices to show (already filtered and sorted) and a `row_values(index)`
+    callback, and materializes just the visible slice of that list. Item IDs
+    are the model indices, so selections map straight back to the model.
+    """
+    def __init__(self, master, columns, row_values, on_heading_click=None, height=15):
+        super().__init__(master)
+        self.row_values = row_values
+        self.view = []
+        self.top = 0
+        self.visible_rows = height
+        self.selected = set()
+
+        self.tree = ttk.Treeview(self, columns=[c for c, _, _ in columns], show="headings", height=height)
+        for name, heading, width in columns:
+            command = (lambda c=name: on_heading_click(c)) if on_heading_click else ""
+            self.tree.heading(name, text=heading, anchor="center", command=command)
+            self.tree.column(name, width=width, anchor="center")
+        self.tree.pack(side="left", fill="both", expand=True)
+
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+        self.tree.bind("<Configure>", self.on_resize)
+        self.tree.bind("<MouseWheel>", self.on_mousewheel)
+        self.tree.bind("<Button-4>", lambda e: self.scroll_by(-3))
+        self.tree.bind("<Button-5>", lambda e: self.scroll_by(3))
+        self.tree.bind("<Prior>", lambda e: self.scroll_by(-self.visible_rows))
+        self.tree.bind("<Next>", lambda e: self.scroll_by(self.visible_rows))
+
+    def set_view(self, view, keep_position=True):
+        self.view = view
+        if not keep_position:
+            self.top = 0
+        self.selected &= set(view)
+        self.render()
+
+    def clear(self):
+        self.selected.clear()
+        self.set_view([], keep_position=False)
+
+    def render(self):
+        self.top = max(0, min(self.top, len(self.view) - self.visible_rows))
+        visible = self.view[self.top:self.top + self.visible_rows]
+
+        self.tree.delete(*self.tree.get_children())
+        for index in visible:
+            self.tree.insert("", "end", iid=str(index), values=self.row_values(index))
+        self.tree.selection_set([str(i) for i in visible if i in self.selected])
+
+        if self.view:
+            first = self.top / len(self.view)
+            self.scrollbar.set(first, min(1.0, (self.top + len(visible)) / len(self.view)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def refresh_rows(self, indices=None):
+        """Re-read values of visible rows (all of them, or just `indices`) from the model."""
+        for iid in self.tree.get_children():
+            if indices is None or int(iid) in indices:
+                self.tree.item(iid, values=self.row_values(int(iid)))
+
+    def scroll_by(self, rows):
+        self.top += rows
+        self.render()
+        return "break"
+
+    def on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.top = int(float(amount) * len(self.view))
+            self.render()
+        elif action == "scroll":
+            step = self.visible_rows if unit == "pages" else 1
+            self.scroll_by(int(amount) * step)
+
+    def on_mousewheel(self, event):
+        # Windows reports multiples of 120, macOS small deltas
+        delta = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        return self.scroll_by(-3 * delta)
+
+    def on_resize(self, event):
+        rowheight = int(ttk.Style(self).lookup("Treeview", "rowheight") or 20)
+        visible_rows = max(1, (event.height - 25) // rowheight)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.render()
+
+    def on_select(self, event=None):
+        visible = {int(iid) for iid in self.tree.get_children()}
+        chosen = {int(iid) for iid in self.tree.selection()}
+        self.selected = (self.selected - visible) | chosen
+
+class ExpenseGUI(tk.Tk):
+    def __init__(self):
+        super().__init__()
+        
+        # ------------------------------
+        # 1) Set the WINDOW title
+        # ------------------------------
+        self.title("💰 UPIx - A Simple UPI Expense Tracker")
+        self.geometry("1000x700")
+
+        # Decide theme by OS
+        system = platform.system()
+        style = ttk.Style(self)
+        if system == "Windows":
+            style.theme_use("default")
+        elif system == "Darwin":
+            style.theme_use("aqua")
+        else:
+            # Fallback for Linux/other systems
+            style.theme_use("clam")
+
+        # Decide text color for dark/light mode
+        is_dark = detect_dark_mode()
+        label_fg = "white" if is_dark else "black"
+
+        style.configure("LastRun.TLabel", foreground=label_fg)
+
+        # ------------------------------
+        # 2) Add a BIG LABEL on top (centered)
+        # ------------------------------
+        title_label = ttk.Label(
+            self, 
+            text="💰 UPIx - A Simple UPI Expense Tracker", 
+            font=("Helvetica", 16, "bold"),
+            foreground=label_fg
+        )
+        title_label.pack(pady=10)
+
+        # -- The only change: remove text="Excel File" from LabelFrame below --
+        file_frame = ttk.LabelFrame(self)
+        file_frame.pack(fill="x", padx=10, pady=10)
+
+        ttk.Label(file_frame, text="Excel Path:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
+        self.excel_path_var = tk.StringVar(value=DEFAULT_EXCEL_FILE)
+        ttk.Entry(file_frame, textvariable=self.excel_path_var, width=55).grid(row=0, column=1, padx=5, pady=5)
+        ttk.Button(file_frame, text="Browse", command=self.browse_excel).grid(row=0, column=2, padx=5, pady=5)
+
+        ttk.Label(file_frame, text="Excel Sheet Name:").grid(row=1, column=0, padx=5, pady=5, sticky="e")
+        self.sheet_var = tk.StringVar(value=SHEET_NAME)
+        ttk.Entry(file_frame, textvariable=self.sheet_var, width=20).grid(row=1, column=1, padx=5, pady=5, sticky="w")
+        ttk.Label(file_frame, text=f"'{AUTO_SHEET}' picks the month sheet from each date").grid(
+            row=1, column=1, columnspan=2, padx=5, pady=5, sticky="e"
+        )
+
+        date_frame = ttk.LabelFrame(self, text="Fetch Transactions Since")
+        date_frame.pack(fill="x", padx=10, pady=5)
+
+        ttk.Label(date_frame, text="Enter Date:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
+
+        today = datetime.datetime.today()
+        self.since_date_var = tk.StringVar(value=today.strftime("%d-%m-%Y"))
+        self.since_date_entry = ttk.Entry(date_frame, textvariable=self.since_date_var, width=15)
+        self.since_date_entry.grid(row=0, column=1, padx=5, pady=5, sticky="w")
+
+        self.offline_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            date_frame, text="Offline (local cache only)", variable=self.offline_var
+        ).grid(row=0, column=2, padx=15, pady=5, sticky="w")
+
+        self.watch_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            date_frame, text="Watch inbox (list alerts as they arrive)", variable=self.watch_var,
+            command=self.on_watch_toggled
+        ).grid(row=0, column=3, padx=5, pady=5, sticky="w")
+
+        self.last_processed_label_var = tk.StringVar(value=last_run_text())
+
+        self.last_run_label = ttk.Label(
+            date_frame,
+            textvariable=self.last_processed_label_var,
+            style="LastRun.TLabel"
+        )
+        self.last_run_label.grid(row=1, column=0, columnspan=2, padx=5, pady=2, sticky="w")
+
+        btn_frame = ttk.Frame(self)
+        btn_frame.pack(fill="x", padx=10, pady=5)
+
+        self.fetch_btn = ttk.Button(btn_frame, text="Fetch UPI Transactions", command=self.on_fetch_clicked)
+        self.fetch_btn.pack(side="left", padx=5)
+
+        self.update_btn = ttk.Button(btn_frame, text="Update Excel", command=self.on_update_clicked)
+        self.update_btn.pack(side="left", padx=5)
+
+        self.quit_btn = ttk.Button(btn_frame, text="Quit", command=self.on_quit_clicked)
+        self.quit_btn.pack(side="right", padx=5)
+
+        self.progress_bar = ttk.Progressbar(btn_frame, orient="horizontal", mode="determinate")
+
+        filter_frame = ttk.Frame(self)
+        filter_frame.pack(fill="x", padx=10)
+        ttk.Label(filter_frame, text="Filter (text, or >500 / <100 for amount):").pack(side="left", padx=5)
+        self.filter_var = tk.StringVar()
+        self.filter_var.trace_add("write", lambda *args: self.refresh_view())
+        ttk.Entry(filter_frame, textvariable=self.filter_var, width=30).pack(side="left", padx=5)
+
+        columns = (
+            ("date", "Date", 120),
+            ("party_name", "Party Name", 150),
+            ("vpa_id", "UPI ID", 150),
+            ("amount", "Amount (Rs)", 120),
+            ("category", "Category", 120),
+        )
+        self.table = VirtualTable(self, columns, self.row_values, on_heading_click=self.on_sort_clicked)
+        self.table.pack(fill="both", expand=True, padx=10, pady=5)
+
+        cat_frame = ttk.LabelFrame(self, text="")
+        cat_frame.pack(fill="x", padx=10, pady=5)
+
+        ttk.Label(cat_frame, text="Choose Category:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
+        self.single_combobox_var = tk.StringVar()
+        self.single_combobox = ttk.Combobox(
+            cat_frame,
+            textvariable=self.single_combobox_var,
+            values=list(EXPENSE_CATEGORIES.values()),
+            state="readonly",
+            width=25
+        )
+        self.single_combobox.grid(row=0, column=1, padx=5, pady=5, sticky="w")
+
+        self.apply_selected_btn = ttk.Button(cat_frame, text="Apply to Selected", command=self.on_apply_selected_clicked)
+        self.apply_selected_btn.grid(row=0, column=2, padx=5, pady=5)
+
+        self.apply_all_btn = ttk.Button(cat_frame, text="Apply to All", command=self.on_apply_all_clicked)
+        self.apply_all_btn.grid(row=0, column=3, padx=5, pady=5)
+
+        # Internals: self.batch holds every row and its category, column by column;
+        # the table only ever renders from it.
+        self.batch = TransactionBatch()
+        self.sort_column = None
+        self.sort_reverse = False
+        self.sync_markers = []
+        self.fetch_thread = None
+        self.fetch_metrics = None
+        self.commit_thread = None
+        self.commit_cancel = None
+        self.watch_thread = None
+        self.watch_stop = None
+        self.watch_backlog = []
+        self.ui_queue = queue.Queue()
+        self.total_emails = 0
+        self.processed_emails = 0
+        self.since_date_str = ""
+
+        self.after(UI_TICK_MS, self.drain_ui_queue)
+
+    def on_quit_clicked(self):
+        # A commit in flight only ever writes a temp file, so abandoning it is safe
+        if self.commit_thread and self.commit_thread.is_alive():
+            self.commit_cancel.set()
+        if self.watch_stop:
+            self.watch_stop.set()
+        close_connection_pools()
+        self.destroy()
+
+    def on_fetch_clicked(self):
+        if self.fetch_thread and self.fetch_thread.is_alive():
+            messagebox.showwarning("Warning", "Fetching is already in progress.")
+            return
+        if self.watch_var.get():
+            messagebox.showwarning("Warning", "New alerts are already being listed; turn off Watch to fetch a date range.")
+            return
+        if self.commit_thread and self.commit_thread.is_alive():
+            messagebox.showwarning("Warning", "Wait for the Excel update to finish first.")
+            return
+
+        self.set_button_processing(self.fetch_btn)
+        self.progress_bar.pack(side="left", padx=5)
+        self.progress_bar["value"] = 0
+        self.progress_bar.config(mode="determinate", maximum=1)
+
+        # Clear old data
+        self.table.clear()
+        self.batch.clear()
+        self.sync_markers = []
+
+        # Finished in fetch_done, so the report also covers filling the table
+        self.fetch_metrics = RunMetrics("fetch")
+        metrics = self.fetch_metrics
+        def fetch():
+            with metrics.profiled():
+                self.fetch_transactions_in_thread()
+        self.fetch_thread = threading.Thread(target=fetch)
+        self.fetch_thread.start()
+
+    def on_watch_toggled(self):
+        if not self.watch_var.get():
+            if self.watch_stop:
+                self.watch_stop.set()
+            return
+        if self.fetch_thread and self.fetch_thread.is_alive():
+            messagebox.showwarning("Warning", "Wait for fetching to finish first.")
+            self.watch_var.set(False)
+            return
+        if self.watch_thread and self.watch_thread.is_alive():
+            messagebox.showwarning("Warning", "Watch is still stopping, try again in a moment.")
+            self.watch_var.set(False)
+            return
+
+        try:
+            since_date = datetime.datetime.strptime(self.since_date_var.get().strip(), "%d-%m-%Y").date()
+        except ValueError:
+            since_date = datetime.date.today()
+        # Rows already in the table aren't listed twice
+        held_uids = {mailbox_key(marker["account"], marker["folder"]): marker["last_uid"]
+                     for marker in self.sync_markers}
+
+        self.watch_stop = threading.Event()
+        self.watch_thread = threading.Thread(
+            target=self.watch_in_thread, args=(since_date, held_uids, self.watch_stop), daemon=True
+        )
+        self.watch_thread.start()
+
+    def watch_in_thread(self, since_date, held_uids, stop_event):
+        try:
+            watch_mailboxes(
+                since_date, lambda result: self.post_ui("call", lambda: self.watch_batch_arrived(result)),
+                stop_event, after_uids=held_uids
+            )
+        except FetchError as e:
+            self.post_ui("call", lambda err=e: messagebox.showerror("Error", str(err)))
+            self.post_ui("call", lambda: self.watch_var.set(False))
+
+    def watch_batch_arrived(self, result):
+        """A batch from watch mode, on the Tk thread: list its rows for categorizing."""
+        # The table is locked while a commit runs; pick these up once it's done
+        if self.commit_thread and self.commit_thread.is_alive():
+            self.watch_backlog.append(result)
+            return
+        if not result["total"]:
+            return
+        if not result["transactions"] and not self.batch:
+            # Only non-alert mail, and nothing before it waiting to be booked
+            commit_sync_markers(result["sync_markers"])
+            return
+        # Each mailbox's watcher reports its own marker; keep the others'
+        self.sync_markers = merge_sync_markers(self.sync_markers, result["sync_markers"])
+        if result["transactions"]:
+            self.add_transactions_to_ui(result["transactions"])
+            self.bell()
+
+    def on_update_clicked(self):
+        # While a commit runs, the same button cancels it
+        if self.commit_thread and self.commit_thread.is_alive():
+            self.commit_cancel.set()
+            self.set_button_processing(self.update_btn, "Cancelling...")
+            return
+        if self.fetch_thread and self.fetch_thread.is_alive():
+            messagebox.showwarning("Warning", "Wait for fetching to finish first.")
+            return
+        self.update_excel_gui()
+
+    def on_apply_selected_clicked(self):
+        self.set_button_processing(self.apply_selected_btn)
+        try:
+            selected = self.table.selected
+            if not selected:
+                messagebox.showwarning("No Selection", "Please select a row.")
+                return
+
+            chosen_cat = self.single_combobox_var.get()
+            if not chosen_cat:
+                messagebox.showwarning("No Category", "Pick a category first.")
+                return
+
+            for row_index in selected:
+                self.batch.set_category(row_index, chosen_cat)
+            self.table.refresh_rows(selected)
+        finally:
+            self.set_button_normal(self.apply_selected_btn, "Apply to Selected")
+
+    def on_apply_all_clicked(self):
+        self.set_button_processing(self.apply_all_btn)
+        try:
+            chosen_cat = self.single_combobox_var.get()
+            if not chosen_cat:
+                messagebox.showwarning("No Category", "Pick a category first.")
+                return
+
+            # All rows the filter currently shows (every row when there's no filter)
+            for i in self.table.view:
+                self.batch.set_category(i, chosen_cat)
+            self.table.refresh_rows()
+        finally:
+            self.set_button_normal(self.apply_all_btn, "Apply to All")
+
+    def set_button_processing(self, btn, label="Processing..."):
+        btn.config(text=label, state="disabled")
+
+    def set_button_normal(self, btn, original_text):
+        btn.config(text=original_text, state="normal")
+
+    # ---------- Fetch (Threaded) ----------
+    def fetch_transactions_in_thread(self):
+        # parse user date
+        selected_date_str = self.since_date_var.get().strip()
+        try:
+            selected_date = datetime.datetime.strptime(selected_date_str, "%d-%m-%Y").date()
+        except ValueError:
+            selected_date = datetime.date.today()
+
+        self.since_date_str = selected_date.strftime("%d-%b-%Y")
+        self.processed_emails = 0
+
+        # Offline: re-open the range straight from the local cache, no IMAP at all
+        if self.offline_var.get():
+            try:
+                cached, _ = drop_cached_duplicates(load_cached_transactions(selected_date), "statement")
+            except sqlite3.Error as e:
+                self.post_ui("call", lambda err=e: messagebox.showerror("Error", f"Could not read local cache:\n{err}"))
+                self.post_ui("call", self.fetch_done)
+                return
+            suggest_categories(cached)
+            self.total_emails = len(cached)
+            if not cached:
+                self.post_ui("call", lambda: self.fetch_done(no_emails=True))
+                return
+            self.post_ui("rows", cached)
+            self.post_ui("call", self.fetch_done)
+            return
+
+        def on_total(total):
+            self.total_emails = total
+            self.post_ui("call", lambda: self.progress_bar.config(maximum=total))
+
+        def on_progress():
+            self.processed_emails += 1
+            self.post_ui("progress", self.processed_emails)
+
+        try:
+            result = ingest_mailboxes(
+                selected_date, on_total=on_total, on_progress=on_progress, metrics=self.fetch_metrics
+            )
+        except FetchError as e:
+            self.post_ui("call", lambda err=e: messagebox.showerror("Error", str(err)))
+            self.post_ui("call", self.fetch_done)
+            return
+        if result["errors"]:
+            failed = "\n".join(f"{mailbox}: {message}" for mailbox, message in result["errors"].items())
+            self.post_ui("call", lambda: messagebox.showwarning(
+                "Warning", f"Some mailboxes were skipped; they'll be fetched next time:\n{failed}"))
+
+        if not result["total"]:
+            self.post_ui("call", lambda: self.fetch_done(no_emails=True))
+            return
+
+        self.sync_markers = result["sync_markers"]
+        if result["transactions"]:
+            self.post_ui("rows", result["transactions"])
+        self.post_ui("call", self.fetch_done)
+
+    def add_transactions_to_ui(self, txns):
+        # Watchers of two folders both report an alert filed into both; list it once
+        delivered = dict(zip(self.batch.message_ids, self.batch.mailboxes))
+        self.batch.extend(drop_copied_messages(txns, delivered))
+        self.refresh_view()
+
+    def row_values(self, index):
+        batch = self.batch
+        return (batch.dates[index], batch.party_names[index], batch.vpa_ids[index],
+                batch.amounts[index], batch.category(index))
+
+    def refresh_view(self):
+        """Recompute which rows the table shows, and in what order, from the model."""
+        batch = self.batch
+        indices = range(len(batch))
+        keep = make_transaction_filter(self.filter_var.get())
+        if keep:
+            indices = [i for i in indices if keep(batch, i)]
+        if self.sort_column:
+            sort_key = TABLE_SORT_KEYS[self.sort_column]
+            indices = sorted(indices, key=lambda i: sort_key(batch, i), reverse=self.sort_reverse)
+        self.table.set_view(list(indices))
+
+    def on_sort_clicked(self, column):
+        if self.sort_column == column:
+            self.sort_reverse = not self.sort_reverse
+        else:
+            self.sort_column, self.sort_reverse = column, False
+        self.refresh_view()
+
+    def post_ui(self, kind, payload):
+        """
+        Hand work to the Tk thread from a worker. `kind` is "rows" (a list of
+        transactions for the table), "progress" (a progress bar value) or
+        "call" (a function to run).
+        """
+        self.ui_queue.put((kind, payload))
+
+    def drain_ui_queue(self):
+        """
+        Runs every UI_TICK_MS on the Tk thread: everything queued since the
+        last tick becomes one bulk table insert and one progress bar update.
+        Calls run in order, after the rows and progress queued before them.
+        """
+        rows = []
+        progress = None
+
+        def flush():
+            nonlocal rows, progress
+            if rows:
+                started = time.perf_counter()
+                self.add_transactions_to_ui(rows)
+                if self.fetch_metrics:
+                    self.fetch_metrics.add("ui_table", time.perf_counter() - started)
+                rows = []
+            if progress is not None:
+                self.progress_bar["value"] = progress
+                progress = None
+
+        try:
+            while True:
+                try:
+                    kind, payload = self.ui_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if kind == "rows":
+                    rows.extend(payload)
+                elif kind == "progress":
+                    progress = payload
+                else:
+                    flush()
+                    payload()
+            flush()
+        finally:
+            self.after(UI_TICK_MS, self.drain_ui_queue)
+
+    def fetch_done(self, no_emails=False):
+        if self.fetch_metrics:
+            # The fetch thread hands its profile over as it ends, just after posting this
+            if self.fetch_thread and self.fetch_thread is not threading.current_thread():
+                self.fetch_thread.join(1.0)
+            self.fetch_metrics.finish()
+            self.fetch_metrics = None
+        self.progress_bar.stop()
+        self.progress_bar.pack_forget()
+        self.set_button_normal(self.fetch_btn, "Fetch UPI Transactions")
+
+        if no_emails:
+            messagebox.showinfo("Info", f"No UPI transactions found since {self.since_date_str}.")
+            return
+
+        if self.total_emails > 0 and not self.batch:
+            last_processed = get_last_processed_time()
+            if last_processed:
+                messagebox.showinfo("Info", "No new transactions found since last run.")
+            else:
+                messagebox.showinfo("Info", "No valid UPI transactions found in the fetched emails.")
+        else:
+            known = sum(1 for code in self.batch.category_codes if code)
+            note = f"\n{known} of {len(self.batch)} were categorized from earlier choices." if known else ""
+            messagebox.showinfo("Success", "Fetching completed successfully! Transactions are now listed below." + note)
+
+    # ---------- Update Excel ----------
+    def update_excel_gui(self):
+        if not self.batch:
+            messagebox.showwarning("Warning", "No transactions to update.")
+            return
+
+        excel_file = self.excel_path_var.get().strip()
+        sheet_name = self.sheet_var.get().strip()
+
+        # The worker gets its own copies; the table stays locked until it's done
+        transactions = self.batch.copy()
+        category_choices = transactions.categories
+        sync_markers = list(self.sync_markers)
+        self.commit_cancel = threading.Event()
+
+        self.update_btn.config(text="Cancel Update")
+        for btn in (self.fetch_btn, self.apply_selected_btn, self.apply_all_btn):
+            btn.config(state="disabled")
+        self.progress_bar.pack(side="left", padx=5)
+        self.progress_bar.config(mode="determinate", maximum=100, value=0)
+
+        def report_progress(percent):
+            self.post_ui("progress", percent)
+
+        def worker():
+            try:
+                result = update_excel(
+                    transactions, category_choices, excel_file, sheet_name, sync_markers,
+                    on_progress=report_progress, cancel_event=self.commit_cancel
+                )
+            except Exception as e:
+                result = {"status": "error", "title": "Error", "message": f"Excel update failed:\n{e}"}
+            self.post_ui("call", lambda: self.commit_done(result))
+
+        self.commit_thread = threading.Thread(target=worker, daemon=True)
+        self.commit_thread.start()
+
+    def commit_done(self, result):
+        self.progress_bar.pack_forget()
+        self.set_button_normal(self.update_btn, "Update Excel")
+        for btn in (self.fetch_btn, self.apply_selected_btn, self.apply_all_btn):
+            btn.config(state="normal")
+
+        if result["status"] == "error":
+            messagebox.showerror(result["title"], result["message"])
+        elif result["status"] == "duplicate":
+            messagebox.showwarning(result["title"], result["message"])
+        else:
+            messagebox.showinfo(result["title"], result["message"])
+
+        # Keep the rows around if nothing was booked, so the user can retry
+        if result["status"] in ("ok", "duplicate"):
+            self.table.clear()
+            self.batch.clear()
+            self.sync_markers = []
+
+            self.last_processed_label_var.set(last_run_text())
+
+        # Alerts that arrived in watch mode while the commit ran
+        backlog, self.watch_backlog = self.watch_backlog, []
+        for batch in backlog:
+            self.watch_batch_arrived(batch)
+
+    def browse_excel(self):
+        path = filedialog.askopenfilename(
+            title="Select Excel File",
+            filetypes=[("Excel Files", "*.xlsx *.xlsm *.xlsb *.xls")],
+        )
+        if path:
+            self.excel_path_var.set(path)
+
+def main():
+    app = ExpenseGUI()
+    app.mainloop()
+
+if __name__ == "__main__":
+    main()
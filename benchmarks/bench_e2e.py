@@ -0,0 +1,281 @@
+"""
+End-to-end benchmark: synthetic mailbox -> local IMAP server -> UPIx.
+
+    python benchmarks/bench_e2e.py [--sizes 1000,10000,100000] [--out results.json]
+                                   [--baseline results.json] [--tolerance 0.25]
+
+A year of HDFC-style alerts (text, HTML and multipart) is served by
+imap_stub over plain TCP on localhost, and UPIx is pointed at it through
+IMAP_HOST / IMAP_PORT / IMAP_SSL. Every state file goes to a temporary
+folder, so the real cache, ledger and workbooks are never touched.
+
+For each mailbox size it times
+  search         - the UID SEARCH ingest_transactions sends
+  fetch_headers  - phase one: headers and BODYSTRUCTURE of every hit
+  fetch_texts    - phase two: just the text part of each
+  parse          - running the bank parsers over those texts
+  categorize     - suggest_categories against a learned category index
+  ingest         - ingest_transactions end to end, nothing cached yet
+  ingest_cached  - the same again after a sync state reset, served from the cache
+  update_excel   - booking the batch into one workbook holding `history` earlier
+                   months of sheets, and into a folder of monthly workbooks
+
+The results are one JSON document on stdout (and in --out). With
+--baseline, every scenario whose throughput fell by more than --tolerance
+is listed on stderr and the exit code is 1.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from openpyxl import load_workbook
+
+import UPIx
+import imap_stub
+import mailgen
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_WORKBOOK = os.path.join(REPO_DIR, "Feb 25.xlsx")
+PASSWORD = "bench"
+SINCE = datetime.datetime(2025, 1, 1)
+STATE_FILES = ("SYNC_STATE_FILE", "LAST_PROCESSED_FILE", "CACHE_DB_FILE", "LEDGER_DB_FILE",
+               "CATEGORY_INDEX_FILE", "RUN_JOURNAL_FILE", "RUN_LATEST_FILE", "RUN_REPORT_FILE",
+               "ACCOUNTS_FILE")
+
+def timed(func):
+    start = time.perf_counter()
+    value = func()
+    return time.perf_counter() - start, value
+
+def result(scenario, messages, seconds, variant="", **extra):
+    return dict({
+        "scenario": scenario,
+        "variant": variant,
+        "messages": messages,
+        "seconds": round(seconds, 4),
+        "per_second": round(messages / seconds, 1) if seconds else None,
+    }, **extra)
+
+def point_upix_at(server, workdir):
+    """Aim UPIx at the stub and keep all of its files inside `workdir`."""
+    UPIx.IMAP_HOST = "127.0.0.1"
+    UPIx.IMAP_PORT = server.port
+    UPIx.IMAP_SSL = False
+    UPIx.EMAIL_USER = "bench@example.com"
+    UPIx.EMAIL_PASS = PASSWORD
+    for name in STATE_FILES:
+        setattr(UPIx, name, os.path.join(workdir, os.path.basename(getattr(UPIx, name))))
+    UPIx.EXCEL_TEMPLATE_FILE = os.path.join(workdir, "no-template.xlsx")
+
+def reset_state(*names):
+    for name in names or STATE_FILES:
+        path = getattr(UPIx, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+def fill_mailbox(server, size, merchants):
+    """A year of alerts, spread evenly from SINCE. Returns (seconds, bytes)."""
+    step = datetime.timedelta(days=365) / size
+    start = SINCE.replace(tzinfo=mailgen.IST) + datetime.timedelta(hours=9)
+    started = time.perf_counter()
+    total = 0
+    for when, raw in mailgen.generate(size, start=start, step=step, merchants=merchants):
+        server.add_message(raw, when.timestamp())
+        total += len(raw)
+    server.warm()
+    return time.perf_counter() - started, total
+
+def bench_stages(size):
+    """Search, both fetch phases, parse and categorize, one session, no pool or throttle."""
+    results = []
+    mail = UPIx.connect_gmail()
+    try:
+        query = f'({UPIx.sender_search_criteria()} SINCE "{SINCE:%d-%b-%Y}")'
+        seconds, (status, data) = timed(lambda: mail.uid("SEARCH", None, query))
+        uids = data[0].split()
+        assert status == "OK" and len(uids) == size, (status, len(uids))
+        results.append(result("search", size, seconds))
+
+        seconds, headers = timed(lambda: dict(UPIx.fetch_headers(mail, uids)))
+        results.append(result("fetch_headers", size, seconds))
+
+        seconds, texts = timed(lambda: list(UPIx.fetch_email_texts(mail, headers)))
+        results.append(result("fetch_texts", size, seconds))
+    finally:
+        mail.logout()
+
+    def parse():
+        transactions = []
+        for e_id, text in texts:
+            info = headers[e_id]
+            transactions.extend(UPIx.parse_upi_transactions(
+                text, info["email_datetime"], info["message_id"], int(e_id), info.get("sender")
+            ))
+        return transactions
+    seconds, transactions = timed(parse)
+    assert len(transactions) == size, len(transactions)
+    results.append(result("parse", size, seconds))
+
+    # Teach the index every other merchant, then time pre-filling the batch
+    seen = {}
+    for txn in transactions:
+        seen.setdefault(txn["vpa_id"], txn)
+    teach = list(seen.values())[::2]
+    UPIx.learn_categories(teach, ["Food"] * len(teach))
+    seconds, filled = timed(lambda: UPIx.suggest_categories(transactions))
+    results.append(result("categorize", size, seconds, filled=filled))
+    return results
+
+def bench_ingest(size, rate):
+    """ingest_transactions cold, then again served from the cache."""
+    results = []
+    for scenario in ("ingest", "ingest_cached"):
+        reset_state("SYNC_STATE_FILE", "LAST_PROCESSED_FILE")
+        if scenario == "ingest":
+            reset_state("CACHE_DB_FILE")
+        pool = UPIx.IMAPConnectionPool(max_rate=rate)
+        try:
+            seconds, fetched = timed(lambda: UPIx.ingest_transactions(SINCE, pool=pool))
+        finally:
+            pool.close()
+        assert fetched["total"] == size and len(fetched["transactions"]) == size
+        results.append(result(scenario, size, seconds, variant=f"pool={pool.size}"))
+    return results, fetched["transactions"]
+
+def month_titles(count, before):
+    """`count` month sheet titles ending just before the month `before`."""
+    titles = []
+    month = before
+    for _ in range(count):
+        month = (month.replace(day=1) - datetime.timedelta(days=1)).replace(day=1)
+        titles.append(month.strftime(UPIx.MONTH_SHEET_FORMAT))
+    return titles[::-1]
+
+def build_history(workdir, history):
+    """
+    The sample workbook grown to `history` earlier months, as one workbook
+    and as a folder of monthly workbooks. Returns (file, folder).
+    """
+    single = os.path.join(workdir, f"single-{history}.xlsx")
+    folder = os.path.join(workdir, f"monthly-{history}")
+    os.makedirs(folder)
+    wb = load_workbook(SAMPLE_WORKBOOK)
+    template = wb["Feb 25"]
+    for title in month_titles(history, SINCE):
+        month = datetime.datetime.strptime(title, UPIx.MONTH_SHEET_FORMAT)
+        ws = wb.copy_worksheet(template)
+        ws.title = title
+        daily = month.strftime(UPIx.DAILY_SHEET_FORMAT)
+        if daily not in wb.sheetnames:
+            wb.copy_worksheet(wb["Daily 2025"]).title = daily
+        part = load_workbook(SAMPLE_WORKBOOK)
+        part["Feb 25"].title = title
+        part["Daily 2025"].title = daily
+        part.save(os.path.join(folder, f"{title}.xlsx"))
+    wb.save(single)
+    # The year being booked starts from the sample's own layout
+    shutil.copy(SAMPLE_WORKBOOK, os.path.join(folder, "Feb 25.xlsx"))
+    return single, folder
+
+def bench_update_excel(workdir, transactions, histories):
+    results = []
+    choices = [txn.get("category") or "Other Expenses" for txn in transactions]
+    for history in histories:
+        single, folder = build_history(workdir, history)
+        for variant, target in (("workbook", single), ("folder", folder)):
+            reset_state("LEDGER_DB_FILE", "RUN_JOURNAL_FILE", "RUN_LATEST_FILE")
+            size = os.path.getsize(target) if os.path.isfile(target) else sum(
+                os.path.getsize(os.path.join(target, name)) for name in os.listdir(target))
+            seconds, booked = timed(lambda: UPIx.update_excel(
+                transactions, choices, target, UPIx.AUTO_SHEET
+            ))
+            assert booked["status"] == "ok", booked
+            results.append(result(
+                "update_excel", len(transactions), seconds, variant=f"{variant},history={history}",
+                workbooks_saved=len(booked["workbooks"]), bytes_on_disk=size
+            ))
+    return results
+
+def run(sizes, histories, rate):
+    runs = []
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix="upix-bench-")
+        server = imap_stub.StubIMAPServer(password=PASSWORD).start()
+        try:
+            point_upix_at(server, workdir)
+            merchants = mailgen.merchant_pool(extra=max(size // 50, 10))
+            seconds, mailbox_bytes = fill_mailbox(server, size, merchants)
+            print(f"{size} messages generated in {seconds:.1f}s", file=sys.stderr)
+
+            results = bench_stages(size)
+            ingest_results, transactions = bench_ingest(size, rate)
+            results += ingest_results
+            results += bench_update_excel(workdir, transactions, histories)
+            for entry in results:
+                print(f"  {entry['scenario']:<14} {entry['variant']:<22} {entry['seconds']:>9.3f}s "
+                      f"{entry['per_second'] or 0:>12.1f}/s", file=sys.stderr)
+            runs.append({"messages": size, "mailbox_bytes": mailbox_bytes,
+                         "bytes_sent": server.bytes_sent, "results": results})
+        finally:
+            server.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+    return runs
+
+def regressions(report, baseline, tolerance):
+    """(scenario key, old rate, new rate) for every scenario that slowed beyond `tolerance`."""
+    def rates(doc):
+        return {
+            (entry["scenario"], entry["variant"], entry["messages"]): entry["per_second"]
+            for run_ in doc["runs"] for entry in run_["results"] if entry["per_second"]
+        }
+    old, new = rates(baseline), rates(report)
+    return [
+        (key, old[key], new[key]) for key in sorted(old.keys() & new.keys())
+        if new[key] < old[key] * (1 - tolerance)
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="1000,10000,100000", help="mailbox sizes, comma separated")
+    parser.add_argument("--history", default="0,24,60",
+                        help="earlier months already in the workbook, comma separated")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="IMAP commands per second per session in the ingest runs (0: unthrottled)")
+    parser.add_argument("--out", help="also write the JSON results here")
+    parser.add_argument("--baseline", help="earlier results to compare throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing")
+    args = parser.parse_args()
+
+    report = {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "runs": run([int(n) for n in args.sizes.split(",")], [int(n) for n in args.history.split(",")],
+                    args.rate),
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as out:
+            out.write(text + "\n")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        for (scenario, variant, messages), old, new in slower:
+            print(f"REGRESSION {scenario} {variant} @{messages}: {old:.1f}/s -> {new:.1f}/s", file=sys.stderr)
+        if slower:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
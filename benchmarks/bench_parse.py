@@ -0,0 +1,68 @@
+"""
+Micro-benchmark: time to get from a fetched alert to parsed transactions.
+
+    python benchmarks/bench_parse.py [messages per variant]
+
+For each MIME layout it times
+  email pkg  - email.message_from_bytes + walk (the old whole-message path)
+  fast path  - extract_body_text on the raw bytes (whole-message fallback)
+  section    - decoding just the BODY[section] bytes phase two downloads
+and prints microseconds per message, each including the regex parse.
+"""
+import email
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import UPIx
+import mailgen
+
+def section_payload(raw):
+    """What phase two would download for this message: (text part bytes, text_part info)."""
+    msg = email.message_from_bytes(raw)
+    part = msg
+    if msg.is_multipart():
+        part = next(p for p in msg.walk() if p.get_content_type() == "text/plain")
+    subtype = part.get_content_subtype().upper()
+    encoding = (part["Content-Transfer-Encoding"] or "7bit").upper()
+    return part.get_payload(decode=False).encode("ascii"), (subtype, encoding, part.get_content_charset())
+
+def via_email_package(raw):
+    return UPIx.parse_upi_transactions(UPIx.extract_email_text(email.message_from_bytes(raw)), None)
+
+def via_fast_path(raw):
+    return UPIx.parse_upi_transactions(UPIx.extract_body_text(raw), None)
+
+def via_section(sample):
+    payload, (subtype, encoding, charset) = sample
+    text = UPIx.decode_part(payload, encoding, charset)
+    if subtype == "HTML":
+        text = UPIx.html_to_text(text)
+    return UPIx.parse_upi_transactions(text, None)
+
+def per_message_us(func, samples, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for sample in samples:
+            func(sample)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(samples) * 1e6
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print(f"{'variant':<10} {'email pkg':>10} {'fast path':>10} {'section':>10}   (us/message, best of 5)")
+    for variant in mailgen.VARIANTS:
+        raws = [raw for _, raw in mailgen.generate(count, variants=[variant])]
+        sections = [section_payload(raw) for raw in raws]
+        for raw in raws[:50]:
+            assert via_fast_path(raw) == via_email_package(raw) != []
+        print(f"{variant:<10} {per_message_us(via_email_package, raws):>10.1f} "
+              f"{per_message_us(via_fast_path, raws):>10.1f} {per_message_us(via_section, sections):>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Regression checks for headless syncs against the local IMAP stub.
+
+    python benchmarks/check_sync.py
+
+Each check runs `UPIx sync` a few times over a small mailbox, with every
+state file in a temporary folder, and asserts what the sync state, cache
+and workbook end up holding. Exits 1 on the first failed check.
+"""
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import UPIx
+import bench_e2e
+import imap_stub
+import mailgen
+
+def sync(workbook, *extra):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(io.StringIO()):
+        code = UPIx.main(["sync", "--since", "01-01-2025", "--excel", workbook,
+                          "--sheet", UPIx.AUTO_SHEET, *extra])
+    return code, json.loads(out.getvalue())
+
+def last_uid():
+    with open(UPIx.SYNC_STATE_FILE, encoding="utf-8") as f:
+        return next(iter(json.load(f).values()))["last_uid"]
+
+def check_held_row_survives(server, workdir):
+    """An unknown merchant held back by one sync is still held by the next, then booked."""
+    start = datetime.datetime(2025, 2, 3, 10, tzinfo=mailgen.IST)
+    server.add_message(mailgen.make_alert(start, 250.0, "newshop@okaxis", "NEW SHOP"), start.timestamp())
+    later = start + datetime.timedelta(hours=1)
+    server.add_message(mailgen.make_alert(later, 100.0, "swiggy@icici", "SWIGGY"), later.timestamp())
+    UPIx.learn_categories([UPIx.Transaction("", 1, "swiggy@icici", "SWIGGY")], ["Food"])
+    workbook = os.path.join(workdir, "held.xlsx")
+    shutil.copy(bench_e2e.SAMPLE_WORKBOOK, workbook)
+
+    code, summary = sync(workbook)
+    assert code == UPIx.EXIT_OK and summary["held"] == 1, summary
+    assert last_uid() == 0, last_uid()
+    code, summary = sync(workbook)
+    assert code == UPIx.EXIT_OK and summary["held"] == 1, summary
+    assert last_uid() == 0, last_uid()
+    code, summary = sync(workbook, "--default-category", "Travel")
+    assert code == UPIx.EXIT_OK and summary["held"] == 0, summary
+    assert summary["added"] == 250.0, summary
+    assert last_uid() == 2, last_uid()
+
+def check_duplicate_across_folders(server, workdir):
+    """An alert a mail filter filed into two folders of one account is booked once."""
+    when = datetime.datetime(2025, 2, 3, 10, tzinfo=mailgen.IST)
+    raw = mailgen.make_alert(when, 250.0, "newshop@okaxis", "NEW SHOP")
+    for folder in ("inbox", "Banks/HDFC"):
+        server.add_message(raw, when.timestamp(), mailbox=folder)
+    with open(UPIx.ACCOUNTS_FILE, "w", encoding="utf-8") as f:
+        json.dump([{"user": UPIx.EMAIL_USER, "password": bench_e2e.PASSWORD,
+                    "folders": ["INBOX", "Banks/HDFC"]}], f)
+    workbook = os.path.join(workdir, "copies.xlsx")
+    shutil.copy(bench_e2e.SAMPLE_WORKBOOK, workbook)
+
+    code, summary = sync(workbook, "--default-category", "Travel")
+    assert code == UPIx.EXIT_OK and summary["added"] == 250.0, summary
+    code, summary = sync(workbook, "--default-category", "Travel")
+    assert code == UPIx.EXIT_OK and not summary.get("added"), summary
+
+CHECKS = [check_held_row_survives, check_duplicate_across_folders]
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        workdir = tempfile.mkdtemp(prefix="upix-check-")
+        server = imap_stub.StubIMAPServer(password=bench_e2e.PASSWORD).start()
+        try:
+            bench_e2e.point_upix_at(server, workdir)
+            check(server, workdir)
+            print(f"ok    {check.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL  {check.__name__}: {e}")
+        finally:
+            server.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,443 @@
+"""
+A tiny in-process IMAP4rev1 server that serves a synthetic mailbox.
+
+Only the subset of the protocol UPIx uses is implemented: LOGIN, SELECT,
+STATUS, (UID) SEARCH, (UID) FETCH, NOOP, IDLE and LOGOUT. Messages live in
+memory; append more with ``server.add_message()`` while it is running.
+
+Point UPIx at it with IMAP_HOST = "127.0.0.1", IMAP_PORT = server.port and
+IMAP_SSL = False. Call ``server.warm()`` before timing anything, so the
+server's own MIME parsing doesn't end up in the client's numbers.
+"""
+
+import datetime
+import email
+import email.utils
+import re
+import select
+import socketserver
+import threading
+import time
+
+_TOKEN_RE = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()\[]+(?:\[[^\]]*\](?:<[\d.]+>)?)?')
+
+def _quote(value):
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def _tokenize(text):
+    tokens = _TOKEN_RE.findall(text)
+    stack = [[]]
+    for tok in tokens:
+        if tok == "(":
+            stack.append([])
+        elif tok == ")":
+            inner = stack.pop()
+            stack[-1].append(inner)
+        else:
+            if tok.startswith('"'):
+                tok = tok[1:-1]
+            stack[-1].append(tok)
+    return stack[0]
+
+def _seq_set(spec, maximum):
+    result = []
+    for piece in spec.split(","):
+        if ":" in piece:
+            lo, hi = piece.split(":")
+            lo = maximum if lo == "*" else int(lo)
+            hi = maximum if hi == "*" else int(hi)
+            if lo > hi:
+                lo, hi = hi, lo
+            result.append((lo, hi))
+        else:
+            n = maximum if piece == "*" else int(piece)
+            result.append((n, n))
+    return result
+
+def _in_set(n, ranges):
+    return any(lo <= n <= hi for lo, hi in ranges)
+
+class StubMessage:
+    def __init__(self, uid, raw, internaldate):
+        self.uid = uid
+        self.raw = raw
+        self.internaldate = internaldate
+        self._parsed = None
+        self._memo = {}
+
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = email.message_from_bytes(self.raw)
+        return self._parsed
+
+    def _cached(self, key, compute):
+        if key not in self._memo:
+            self._memo[key] = compute()
+        return self._memo[key]
+
+    def warm(self, header_names=("DATE", "FROM", "MESSAGE-ID")):
+        """Work out every answer UPIx will ask for, then drop the parsed message to save memory."""
+        self.sender
+        self.date
+        self.bodystructure()
+        self.section("HEADER.FIELDS (" + " ".join(header_names) + ")")
+        for spec in _leaf_sections(self.parsed):
+            self.section(spec)
+        self._parsed = None
+
+    @property
+    def sender(self):
+        return self._cached("from", lambda: (self.parsed.get("From") or "").lower())
+
+    @property
+    def date(self):
+        return self._cached("date", lambda: _msg_date(self))
+
+    def header_fields(self, names):
+        msg = self.parsed
+        out = []
+        for name in names:
+            value = msg.get(name)
+            if value is not None:
+                out.append(f"{name.title()}: {value}\r\n")
+        out.append("\r\n")
+        return "".join(out).encode("utf-8")
+
+    def _split(self):
+        raw = self.raw
+        idx = raw.find(b"\r\n\r\n")
+        sep = 4
+        if idx < 0:
+            idx = raw.find(b"\n\n")
+            sep = 2
+        return raw[:idx + sep], raw[idx + sep:]
+
+    def section(self, spec):
+        spec = spec.upper()
+        return self._cached(("section", spec), lambda: self._section(spec))
+
+    def _section(self, spec):
+        if spec == "":
+            return self.raw
+        if spec == "HEADER":
+            return self._split()[0]
+        if spec == "TEXT":
+            return self._split()[1]
+        if spec.startswith("HEADER.FIELDS"):
+            names = re.findall(r"[\w-]+", spec[len("HEADER.FIELDS"):])
+            return self.header_fields(names)
+        part = self.parsed
+        for num in spec.split("."):
+            if num == "MIME":
+                return b"".join(
+                    f"{k}: {v}\r\n".encode() for k, v in part.items()
+                ) + b"\r\n"
+            index = int(num) - 1
+            if part.is_multipart():
+                part = part.get_payload()[index]
+            elif index != 0:
+                return b""
+        payload = part.get_payload(decode=False)
+        if isinstance(payload, list):
+            return b""
+        return payload.encode("latin-1", errors="replace") if isinstance(payload, str) else payload
+
+    def bodystructure(self):
+        return self._cached("bodystructure", self._bodystructure)
+
+    def _bodystructure(self):
+        def render(part):
+            if part.is_multipart():
+                children = "".join(render(p) for p in part.get_payload())
+                return f'({children} {_quote(part.get_content_subtype().upper())})'
+            maintype = part.get_content_maintype().upper()
+            subtype = part.get_content_subtype().upper()
+            charset = part.get_content_charset()
+            params = f'("CHARSET" {_quote(charset)})' if charset else "NIL"
+            encoding = (part.get("Content-Transfer-Encoding") or "7BIT").upper()
+            payload = part.get_payload(decode=False)
+            size = len(payload) if isinstance(payload, str) else 0
+            lines = payload.count("\n") if isinstance(payload, str) else 0
+            return (f'({_quote(maintype)} {_quote(subtype)} {params} NIL NIL '
+                    f'{_quote(encoding)} {size} {lines})')
+        return render(self.parsed)
+
+def _leaf_sections(part, prefix=""):
+    """The BODY[...] section numbers of every non-multipart part."""
+    if not part.is_multipart():
+        return [prefix or "1"] + ([] if prefix else ["TEXT"])
+    specs = []
+    for number, child in enumerate(part.get_payload(), start=1):
+        specs.extend(_leaf_sections(child, f"{prefix}.{number}" if prefix else str(number)))
+    return specs
+
+class StubMailbox:
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.seq_of_uid = {}
+        self.next_uid = 1
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def add(self, raw, internaldate=None):
+        with self.changed:
+            msg = StubMessage(self.next_uid, raw, internaldate or time.time())
+            self.next_uid += 1
+            self.messages.append(msg)
+            self.seq_of_uid[msg.uid] = len(self.messages)
+            self.changed.notify_all()
+            return msg.uid
+
+def _msg_date(msg):
+    try:
+        return email.utils.parsedate_to_datetime(msg.parsed["Date"]).date()
+    except Exception:
+        return datetime.date.fromtimestamp(msg.internaldate)
+
+def _match(criteria, msg, seq, count):
+    """True if `msg` matches every search key in `criteria` (implicit AND)."""
+    i = 0
+    ok = True
+    while i < len(criteria):
+        matched, i = _match_key(criteria, i, msg, seq, count)
+        ok = ok and matched
+    return ok
+
+def _match_key(criteria, i, msg, seq, count):
+    """Evaluate the single search key starting at criteria[i]; return (matched, next index)."""
+    key = criteria[i]
+    if isinstance(key, list):
+        return _match(key, msg, seq, count), i + 1
+    key = key.upper()
+    if key == "ALL":
+        return True, i + 1
+    if key == "FROM":
+        return criteria[i + 1].lower() in msg.sender, i + 2
+    if key == "SINCE":
+        since = datetime.datetime.strptime(criteria[i + 1], "%d-%b-%Y").date()
+        return msg.date >= since, i + 2
+    if key == "BEFORE":
+        before = datetime.datetime.strptime(criteria[i + 1], "%d-%b-%Y").date()
+        return msg.date < before, i + 2
+    if key == "UID":
+        matched = _in_set(msg.uid, _seq_set(criteria[i + 1], 1 << 31)) or (
+            criteria[i + 1].endswith("*") and msg.uid == count)
+        return matched, i + 2
+    if key == "OR":
+        left, i = _match_key(criteria, i + 1, msg, seq, count)
+        right, i = _match_key(criteria, i, msg, seq, count)
+        return left or right, i
+    if key == "NOT":
+        matched, i = _match_key(criteria, i + 1, msg, seq, count)
+        return not matched, i
+    if re.match(r"^[\d*:,]+$", key):
+        return _in_set(seq, _seq_set(key, count)), i + 1
+    return True, i + 1
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Unbuffered, so select() on the socket during IDLE sees every pending byte
+    rbufsize = 0
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.wfile.write(data)
+
+    def handle(self):
+        server = self.server
+        self.selected = None
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE] UPIx stub ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode("utf-8", errors="replace").rstrip("\r\n")
+            if not line:
+                continue
+            parts = line.split(" ", 2)
+            tag = parts[0]
+            cmd = parts[1].upper() if len(parts) > 1 else ""
+            rest = parts[2] if len(parts) > 2 else ""
+            server.commands.append(cmd if cmd != "UID" else "UID " + rest.split(" ", 1)[0].upper())
+            try:
+                if not self.dispatch(tag, cmd, rest):
+                    return
+            except Exception as exc:
+                self.send(f"{tag} BAD {exc}\r\n")
+
+    def dispatch(self, tag, cmd, rest):
+        server = self.server
+        if cmd == "CAPABILITY":
+            self.send("* CAPABILITY IMAP4rev1 IDLE\r\n")
+        elif cmd == "LOGIN":
+            args = _tokenize(rest)
+            if server.password is not None and args[1] != server.password:
+                self.send(f"{tag} NO [AUTHENTICATIONFAILED] Invalid credentials\r\n")
+                return True
+        elif cmd in ("SELECT", "EXAMINE"):
+            name = _tokenize(rest)[0]
+            box = server.mailboxes.get(name.lower())
+            if box is None:
+                self.send(f"{tag} NO Unknown mailbox\r\n")
+                return True
+            self.selected = box
+            self.send(f"* {len(box.messages)} EXISTS\r\n")
+            self.send(f"* OK [UIDVALIDITY {box.uidvalidity}] UIDs valid\r\n")
+            self.send(f"* OK [UIDNEXT {box.next_uid}] Predicted next UID\r\n")
+        elif cmd == "STATUS":
+            args = _tokenize(rest)
+            box = server.mailboxes.get(args[0].lower())
+            if box is None:
+                self.send(f"{tag} NO Unknown mailbox\r\n")
+                return True
+            self.send(f'* STATUS "{args[0]}" (MESSAGES {len(box.messages)} '
+                      f'UIDNEXT {box.next_uid} UIDVALIDITY {box.uidvalidity})\r\n')
+        elif cmd == "NOOP":
+            pass
+        elif cmd == "LOGOUT":
+            self.send("* BYE logging out\r\n")
+            self.send(f"{tag} OK LOGOUT completed\r\n")
+            return False
+        elif cmd == "IDLE":
+            self.idle(tag)
+            return True
+        elif cmd == "SEARCH":
+            self.search(rest, by_uid=False)
+        elif cmd == "FETCH":
+            self.fetch(rest, by_uid=False)
+        elif cmd == "UID":
+            sub, _, args = rest.partition(" ")
+            sub = sub.upper()
+            if sub == "SEARCH":
+                self.search(args, by_uid=True)
+            elif sub == "FETCH":
+                self.fetch(args, by_uid=True)
+            else:
+                self.send(f"{tag} BAD unsupported UID {sub}\r\n")
+                return True
+        else:
+            self.send(f"{tag} BAD unsupported {cmd}\r\n")
+            return True
+        self.send(f"{tag} OK {cmd} completed\r\n")
+        return True
+
+    def idle(self, tag):
+        box = self.selected
+        self.send("+ idling\r\n")
+        seen = len(box.messages)
+        while True:
+            with box.changed:
+                if len(box.messages) == seen:
+                    box.changed.wait(0.05)
+                now = len(box.messages)
+            if now != seen:
+                seen = now
+                self.send(f"* {now} EXISTS\r\n")
+            if not select.select([self.connection], [], [], 0)[0]:
+                continue
+            line = self.rfile.readline()
+            if not line:
+                return
+            if line.strip().upper() == b"DONE":
+                break
+        self.send(f"{tag} OK IDLE terminated\r\n")
+
+    def search(self, text, by_uid):
+        box = self.selected
+        criteria = _tokenize(text)
+        if criteria and isinstance(criteria[0], str) and criteria[0].upper() == "CHARSET":
+            criteria = criteria[2:]
+        hits = []
+        count = len(box.messages)
+        last_uid = box.messages[-1].uid if box.messages else 0
+        for seq, msg in enumerate(list(box.messages), start=1):
+            if _match(criteria, msg, seq, last_uid if by_uid else count):
+                hits.append(str(msg.uid if by_uid else seq))
+        self.send("* SEARCH" + "".join(" " + h for h in hits) + "\r\n")
+
+    def fetch(self, text, by_uid):
+        box = self.selected
+        spec, _, items = text.partition(" ")
+        items = items.strip()
+        if items.startswith("(") and items.endswith(")"):
+            items = items[1:-1]
+        wanted = _TOKEN_RE.findall(items)
+        messages = list(box.messages)
+        maximum = messages[-1].uid if (by_uid and messages) else len(messages)
+        # Look each number up rather than scanning the mailbox once per range
+        picked = set()
+        for lo, hi in _seq_set(spec, maximum):
+            for key in range(lo, min(hi, maximum) + 1):
+                seq = box.seq_of_uid.get(key) if by_uid else key
+                if seq and seq <= len(messages):
+                    picked.add(seq)
+        for seq in sorted(picked):
+            msg = messages[seq - 1]
+            self.server.fetched_messages += 1
+            pieces = []
+            if by_uid and "UID" not in [w.upper() for w in wanted]:
+                pieces.append(f"UID {msg.uid}".encode())
+            for item in wanted:
+                up = item.upper()
+                if up == "UID":
+                    pieces.append(f"UID {msg.uid}".encode())
+                elif up == "FLAGS":
+                    pieces.append(b"FLAGS (\\Seen)")
+                elif up == "INTERNALDATE":
+                    stamp = time.strftime("%d-%b-%Y %H:%M:%S +0000", time.gmtime(msg.internaldate))
+                    pieces.append(f'INTERNALDATE "{stamp}"'.encode())
+                elif up == "RFC822.SIZE":
+                    pieces.append(f"RFC822.SIZE {len(msg.raw)}".encode())
+                elif up == "BODYSTRUCTURE":
+                    pieces.append(b"BODYSTRUCTURE " + msg.bodystructure().encode())
+                elif up in ("RFC822", "BODY[]", "BODY.PEEK[]"):
+                    name = "RFC822" if up == "RFC822" else "BODY[]"
+                    pieces.append(f"{name} {{{len(msg.raw)}}}\r\n".encode() + msg.raw)
+                elif up.startswith("BODY"):
+                    section = item[item.index("[") + 1:item.index("]")]
+                    data = msg.section(section)
+                    pieces.append(f"BODY[{section.upper()}] {{{len(data)}}}\r\n".encode() + data)
+            self.server.bytes_sent += sum(len(p) for p in pieces)
+            self.send(f"* {seq} FETCH (".encode() + b" ".join(pieces) + b")\r\n")
+
+class StubIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0, password=None, uidvalidity=1):
+        super().__init__((host, port), _Handler)
+        self.password = password
+        self.mailboxes = {"inbox": StubMailbox(uidvalidity)}
+        self.commands = []
+        self.fetched_messages = 0
+        self.bytes_sent = 0
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def mailbox(self, name="inbox"):
+        return self.mailboxes.setdefault(name.lower(), StubMailbox())
+
+    def add_message(self, raw, internaldate=None, mailbox="inbox"):
+        return self.mailbox(mailbox).add(raw, internaldate)
+
+    def warm(self):
+        """Precompute the answers for every message held so far."""
+        for box in self.mailboxes.values():
+            for msg in list(box.messages):
+                msg.warm()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,82 @@
+"""
+Synthetic HDFC-style UPI debit alerts for the benchmarks.
+
+The wording follows the InstaAlerts mails UPIx parses; amounts, merchants
+and MIME layouts are randomised from a seed so runs are repeatable.
+"""
+import datetime
+import random
+from email import charset
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime, make_msgid
+
+MERCHANTS = [
+    ("swiggy@icici", "SWIGGY"),
+    ("zomato-order@ptybl", "Zomato Ltd"),
+    ("landlord.rent@okhdfcbank", "RAMESH KUMAR"),
+    ("uber.rides@axisbank", "UBER INDIA"),
+    ("paytm-98765@ptys", "Chai Point"),
+    ("netflix@hdfcbank", "NETFLIX"),
+]
+
+# text: plain only; html: base64 html only; qp: quoted-printable html only; multipart: plain + html
+VARIANTS = ["text", "html", "multipart", "qp"]
+
+QP_UTF8 = charset.Charset("utf-8")
+QP_UTF8.body_encoding = charset.QP
+
+IST = datetime.timezone(datetime.timedelta(hours=5, minutes=30))
+
+def alert_text(amount, vpa, party, day):
+    return (
+        "Dear Customer,\n\n"
+        f"Rs.{amount:.2f} has been debited from account **1234 to VPA {vpa} {party} on {day}. "
+        "Your UPI transaction reference number is 503812345678.\n\n"
+        "If you did not authorize this transaction, please report it immediately.\n\n"
+        "Warm Regards,\nHDFC Bank\n"
+    )
+
+def alert_html(text):
+    rows = "".join(f"<tr><td style=\"font-family:Arial\">{line}</td></tr>\n" for line in text.split("\n") if line)
+    return (
+        "<html><head><style>td { font-size: 13px; }</style></head>\n"
+        f"<body><table width=\"600\" cellpadding=\"0\">\n{rows}</table></body></html>\n"
+    )
+
+def make_alert(when, amount, vpa, party, variant="text", sender="alerts@hdfcbank.net"):
+    """One alert as raw RFC822 bytes."""
+    text = alert_text(amount, vpa, party, when.strftime("%d-%m-%y"))
+    if variant == "text":
+        msg = MIMEText(text, "plain", "utf-8")
+    elif variant == "multipart":
+        msg = MIMEMultipart("alternative")
+        msg.attach(MIMEText(text, "plain", "utf-8"))
+        msg.attach(MIMEText(alert_html(text), "html", "utf-8"))
+    elif variant == "qp":
+        msg = MIMEText(alert_html(text), "html", QP_UTF8)
+    else:
+        msg = MIMEText(alert_html(text), "html", "utf-8")
+    msg["From"] = f"HDFC Bank InstaAlerts <{sender}>"
+    msg["To"] = "me@example.com"
+    msg["Subject"] = "You have done a UPI txn. Check details!"
+    msg["Date"] = format_datetime(when)
+    msg["Message-ID"] = make_msgid(domain="hdfcbank.net")
+    return msg.as_bytes()
+
+def merchant_pool(extra=0):
+    """MERCHANTS plus `extra` made-up small merchants, for a realistic spread of payees."""
+    return MERCHANTS + [(f"q{700000 + k}@ybl", f"STORE {k}") for k in range(extra)]
+
+def generate(n, start=None, seed=1, variants=None, step=None, merchants=None):
+    """Yield (datetime, raw bytes) for `n` alerts, `step` (default 37 minutes) apart."""
+    rnd = random.Random(seed)
+    start = start or datetime.datetime(2025, 2, 1, 9, 0, tzinfo=IST)
+    variants = variants or VARIANTS[:3]
+    step = step or datetime.timedelta(minutes=37)
+    merchants = merchants or MERCHANTS
+    for i in range(n):
+        when = start + step * i
+        vpa, party = rnd.choice(merchants)
+        variant = rnd.choice(variants)
+        yield when, make_alert(when, rnd.randint(100, 99999) / 100, vpa, party, variant)